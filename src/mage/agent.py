@@ -1,16 +1,37 @@
+import contextvars
+import functools
 import os
-import re
+import shutil
 import sys
+import threading
 import traceback
-from typing import List, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple
 
 from llama_index.core.llms import LLM
 
-from .log_utils import get_logger, set_log_dir, switch_log_to_file, switch_log_to_stdout
+from .llm_ledger import LEDGER_FILE_NAME, llm_ledger
+from .log_utils import (
+    get_logger,
+    switch_log_to_file,
+    switch_log_to_stdout,
+    task_log_context,
+)
+from .mutation_repair import MutationRepair
+from .patch_library import PATCH_LIBRARY_PATH, PatchLibrary
 from .rtl_editor import RTLEditor
 from .rtl_generator import RTLGenerator
+from .run_checkpoint import (
+    CandidateRecord,
+    EditorRecord,
+    JudgeRecord,
+    RunCheckpointer,
+    get_run_key,
+)
+from .sim_backend import TypeSimulator
 from .sim_judge import SimJudge
 from .sim_reviewer import SimReviewer
+from .span_trace import SPAN_FILE_NAME, span, span_trace
 from .tb_generator import TBGenerator
 from .token_counter import TokenCounter, TokenCounterCached
 
@@ -28,17 +49,25 @@ class TopAgent:
         self.sim_max_retry = 4
         self.rtl_max_candidates = 20
         self.rtl_selected_candidates = 2
+        self.editor_speculative_cnt = 1
+        self.use_mutation_repair = False
+        self.use_patch_library = False
+        self.use_patch_repair = True
         self.is_ablation = False
         self.redirect_log = False
         self.output_path = "./output"
         self.log_path = "./log"
         self.golden_tb_path: str | None = None
         self.golden_rtl_blackbox_path: str | None = None
+        self.sim_type = TypeSimulator.IVERILOG
+        self.use_checkpoint = True
+        self.checkpointer: RunCheckpointer | None = None
         self.tb_gen: TBGenerator | None = None
         self.rtl_gen: RTLGenerator | None = None
         self.sim_reviewer: SimReviewer | None = None
         self.sim_judge: SimJudge | None = None
         self.rtl_edit: RTLEditor | None = None
+        self.mutation_repair: MutationRepair | None = None
 
     def set_output_path(self, output_path: str) -> None:
         self.output_path = output_path
@@ -49,6 +78,31 @@ class TopAgent:
     def set_ablation(self, is_ablation: bool) -> None:
         self.is_ablation = is_ablation
 
+    def set_sim_type(self, sim_type: TypeSimulator) -> None:
+        self.sim_type = sim_type
+
+    def set_use_checkpoint(self, use_checkpoint: bool) -> None:
+        self.use_checkpoint = use_checkpoint
+
+    def set_editor_speculative_cnt(self, editor_speculative_cnt: int) -> None:
+        """Alternative edits RTLEditor tries in parallel per round, 1 to disable"""
+        self.editor_speculative_cnt = editor_speculative_cnt
+
+    def set_use_mutation_repair(self, use_mutation_repair: bool) -> None:
+        """Try single-token mutations of the best candidate before the editor"""
+        self.use_mutation_repair = use_mutation_repair
+
+    def set_use_patch_library(self, use_patch_library: bool) -> None:
+        """Mine successful edits across runs and try them before the editor"""
+        self.use_patch_library = use_patch_library
+
+    def set_use_patch_repair(self, use_patch_repair: bool) -> None:
+        """
+        Fix syntax errors and testbenches judged wrong with line patches before
+        regenerating them
+        """
+        self.use_patch_repair = use_patch_repair
+
     def set_redirect_log(self, new_value: bool) -> None:
         self.redirect_log = new_value
         if self.redirect_log:
@@ -56,6 +110,11 @@ class TopAgent:
         else:
             switch_log_to_stdout()
 
+    def is_properly_finished(self, benchmark_type_name: str, task_id: str) -> bool:
+        return os.path.exists(
+            f"{self.output_path}/{benchmark_type_name}_{task_id}/properly_finished.tag"
+        )
+
     def write_output(self, content: str, file_name: str) -> None:
         assert self.output_dir_per_run
         with open(f"{self.output_dir_per_run}/{file_name}", "w") as f:
@@ -74,11 +133,21 @@ class TopAgent:
         assert self.sim_judge
         assert self.rtl_edit
 
+        assert self.checkpointer
+        ckpt = self.checkpointer.ckpt
+
         self.tb_gen.reset()
         self.tb_gen.set_golden_tb_path(self.golden_tb_path)
         if not self.golden_tb_path:
             logger.info("No golden testbench provided")
-        testbench, interface = self.tb_gen.chat(spec)
+        if ckpt.testbench is None or ckpt.interface is None:
+            with span("tb_gen"):
+                testbench, interface = self.tb_gen.chat(spec)
+            ckpt.testbench, ckpt.interface = testbench, interface
+            self.checkpointer.save(self.token_counter)
+        else:
+            testbench, interface = ckpt.testbench, ckpt.interface
+            logger.info("Restored initial tb and if from checkpoint")
         logger.info("Initial tb:")
         logger.info(testbench)
         logger.info("Initial if:")
@@ -88,12 +157,19 @@ class TopAgent:
         self.rtl_gen.reset()
         logger.info(spec)
 
-        is_syntax_pass, rtl_code = self.rtl_gen.chat(
-            input_spec=spec,
-            testbench=testbench,
-            interface=interface,
-            rtl_path=os.path.join(self.output_dir_per_run, "rtl.sv"),
-        )
+        if ckpt.initial_rtl is None or ckpt.is_initial_syntax_pass is None:
+            with span("initial_rtl"):
+                is_syntax_pass, rtl_code = self.rtl_gen.chat(
+                    input_spec=spec,
+                    testbench=testbench,
+                    interface=interface,
+                    rtl_path=os.path.join(self.output_dir_per_run, "rtl.sv"),
+                )
+            ckpt.is_initial_syntax_pass, ckpt.initial_rtl = is_syntax_pass, rtl_code
+            self.checkpointer.save(self.token_counter)
+        else:
+            is_syntax_pass, rtl_code = ckpt.is_initial_syntax_pass, ckpt.initial_rtl
+            logger.info("Restored initial rtl from checkpoint")
         if not is_syntax_pass:
             return False, rtl_code
         self.write_output(rtl_code, "rtl.sv")
@@ -103,7 +179,28 @@ class TopAgent:
         tb_need_fix = True
         rtl_need_fix = True
         sim_log = ""
-        for i in range(self.sim_max_retry):
+        # Replay judge decisions of a previous run, so tb_gen gets the same state
+        for i, judge_record in enumerate(ckpt.judge_records):
+            self.tb_gen.reset()
+            if i == 0:
+                self.tb_gen.gen_display_queue = False
+            else:
+                self.tb_gen.set_failed_trial(
+                    judge_record.sim_log, rtl_code, judge_record.testbench
+                )
+            testbench = judge_record.revised_testbench
+            self.write_output(testbench, "tb.sv")
+            logger.info(f"Restored revised tb {i + 1} from checkpoint")
+        if ckpt.is_judge_done:
+            assert ckpt.is_sim_pass is not None
+            assert ckpt.sim_mismatch_cnt is not None and ckpt.sim_log is not None
+            is_sim_pass = ckpt.is_sim_pass
+            sim_mismatch_cnt, sim_log = ckpt.sim_mismatch_cnt, ckpt.sim_log
+            tb_need_fix = False
+            rtl_need_fix = not is_sim_pass
+        for i in range(len(ckpt.judge_records), self.sim_max_retry):
+            if ckpt.is_judge_done:
+                break
             # run simulation judge, overwrite is_sim_pass
             is_sim_pass, sim_mismatch_cnt, sim_log = self.sim_reviewer.review()
             if is_sim_pass:
@@ -111,7 +208,8 @@ class TopAgent:
                 rtl_need_fix = False
                 break
             self.sim_judge.reset()
-            tb_need_fix = self.sim_judge.chat(spec, sim_log, rtl_code, testbench)
+            with span("judge"):
+                tb_need_fix = self.sim_judge.chat(spec, sim_log, rtl_code, testbench)
             if tb_need_fix:
                 self.tb_gen.reset()
                 if i == 0:
@@ -120,7 +218,37 @@ class TopAgent:
                 else:
                     self.tb_gen.set_failed_trial(sim_log, rtl_code, testbench)
 
-                testbench, _ = self.tb_gen.chat(spec)
+                revised_testbench: str | None = None
+                # The first fix falls back to a new display moment testbench, and
+                # a patched testbench judged wrong again is regenerated instead
+                if (
+                    self.use_patch_repair
+                    and i > 0
+                    and not (ckpt.judge_records and ckpt.judge_records[-1].is_patched)
+                ):
+                    with span("tb_patch"):
+                        revised_testbench = self.tb_gen.repair(
+                            spec,
+                            testbench,
+                            sim_log,
+                            self.sim_judge.reasoning,
+                            tb_path=os.path.join(self.output_dir_per_run, "tb.sv"),
+                            rtl_path=os.path.join(self.output_dir_per_run, "rtl.sv"),
+                        )
+                is_patched = revised_testbench is not None
+                if revised_testbench is None:
+                    with span("tb_revise"):
+                        revised_testbench, _ = self.tb_gen.chat(spec)
+                ckpt.judge_records.append(
+                    JudgeRecord(
+                        sim_log=sim_log,
+                        testbench=testbench,
+                        revised_testbench=revised_testbench,
+                        is_patched=is_patched,
+                    )
+                )
+                self.checkpointer.save(self.token_counter)
+                testbench = revised_testbench
                 self.write_output(testbench, "tb.sv")
                 logger.info("Revised tb:")
                 logger.info(testbench)
@@ -128,52 +256,87 @@ class TopAgent:
                 break
 
         assert not tb_need_fix, f"tb_need_fix should be False. sim_log: {sim_log}"
+        if not ckpt.is_judge_done:
+            ckpt.is_judge_done = True
+            ckpt.is_sim_pass = is_sim_pass
+            ckpt.sim_mismatch_cnt, ckpt.sim_log = sim_mismatch_cnt, sim_log
+            self.checkpointer.save(self.token_counter)
 
         candidates_info: List[Tuple[str, int, str]] = []
-        if rtl_need_fix:
+        if rtl_need_fix and ckpt.passed_candidate:
+            rtl_code = ckpt.passed_candidate.rtl_code
+            sim_mismatch_cnt = ckpt.passed_candidate.sim_mismatch_cnt
+            sim_log = ckpt.passed_candidate.sim_log
+            self.write_output(rtl_code, "rtl.sv")
+            rtl_need_fix = False
+            logger.info("Restored passing candidate from checkpoint")
+        elif rtl_need_fix and ckpt.candidates is not None:
+            candidates_info = [
+                (c.rtl_code, c.sim_mismatch_cnt, c.sim_log) for c in ckpt.candidates
+            ]
+            logger.info(f"Restored {len(candidates_info)} candidates from checkpoint")
+        elif rtl_need_fix:
             # Candidates Generation
             assert (
                 sim_mismatch_cnt > 0
             ), f"rtl_need_fix should be True only when sim_mismatch_cnt > 0. sim_log: {sim_log}"
             self.rtl_gen.reset()
-            candidates = [
-                self.rtl_gen.chat(
-                    input_spec=spec,
-                    testbench=testbench,
-                    interface=interface,
-                    rtl_path=os.path.join(self.output_dir_per_run, "rtl.sv"),
-                    enable_cache=True,
-                )
-            ]  # Write Cache
-            if self.rtl_max_candidates > 1:
-                candidates += self.rtl_gen.gen_candidates(
-                    input_spec=spec,
-                    testbench=testbench,
-                    interface=interface,
-                    rtl_path=os.path.join(self.output_dir_per_run, "rtl.sv"),
-                    candidates_num=self.rtl_max_candidates - 1,
-                    enable_cache=True,
-                )
-            for i in range(self.rtl_max_candidates):
-                logger.info(
-                    f"Candidate generation: round {i + 1} / {self.rtl_max_candidates}"
-                )
-                is_syntax_pass_candiate, rtl_code_candidate = candidates[i]
-                if not is_syntax_pass_candiate:
-                    continue
-                self.write_output(rtl_code_candidate, "rtl.sv")
-                is_sim_pass_candidate, sim_mismatch_cnt_candidate, sim_log_candidate = (
-                    self.sim_reviewer.review()
-                )
-                if is_sim_pass_candidate:
-                    rtl_code = rtl_code_candidate
-                    sim_mismatch_cnt = sim_mismatch_cnt_candidate
-                    sim_log = sim_log_candidate
-                    rtl_need_fix = False
-                    break
-                candidates_info.append(
-                    (rtl_code_candidate, sim_mismatch_cnt_candidate, sim_log_candidate)
-                )
+            with span("candidate_gen"):
+                candidates = [
+                    self.rtl_gen.chat(
+                        input_spec=spec,
+                        testbench=testbench,
+                        interface=interface,
+                        rtl_path=os.path.join(self.output_dir_per_run, "rtl.sv"),
+                        enable_cache=True,
+                    )
+                ]  # Write Cache
+                if self.rtl_max_candidates > 1:
+                    candidates += self.rtl_gen.gen_candidates(
+                        input_spec=spec,
+                        testbench=testbench,
+                        interface=interface,
+                        rtl_path=os.path.join(self.output_dir_per_run, "rtl.sv"),
+                        candidates_num=self.rtl_max_candidates - 1,
+                        enable_cache=True,
+                    )
+            with span("candidate_sims"):
+                for i in range(self.rtl_max_candidates):
+                    logger.info(
+                        f"Candidate generation: round {i + 1} / {self.rtl_max_candidates}"
+                    )
+                    is_syntax_pass_candiate, rtl_code_candidate = candidates[i]
+                    if not is_syntax_pass_candiate:
+                        continue
+                    self.write_output(rtl_code_candidate, "rtl.sv")
+                    (
+                        is_sim_pass_candidate,
+                        sim_mismatch_cnt_candidate,
+                        sim_log_candidate,
+                    ) = self.sim_reviewer.review()
+                    if is_sim_pass_candidate:
+                        rtl_code = rtl_code_candidate
+                        sim_mismatch_cnt = sim_mismatch_cnt_candidate
+                        sim_log = sim_log_candidate
+                        rtl_need_fix = False
+                        ckpt.passed_candidate = CandidateRecord(
+                            rtl_code=rtl_code,
+                            sim_mismatch_cnt=sim_mismatch_cnt,
+                            sim_log=sim_log,
+                        )
+                        break
+                    candidates_info.append(
+                        (
+                            rtl_code_candidate,
+                            sim_mismatch_cnt_candidate,
+                            sim_log_candidate,
+                        )
+                    )
+            ckpt.candidates = [
+                CandidateRecord(rtl_code=c[0], sim_mismatch_cnt=c[1], sim_log=c[2])
+                for c in candidates_info
+            ]
+            self.checkpointer.save(self.token_counter)
 
         candidates_info.sort(key=lambda x: x[1])
         candidates_info_unique_sign = set()
@@ -183,32 +346,168 @@ class TopAgent:
                 candidates_info_unique_sign.add(candidate[1])
                 candidates_info_unique.append(candidate)
 
-        if rtl_need_fix:
-            # Editor iteration
-            for i in range(self.rtl_selected_candidates):
-                logger.info(
-                    f"Selected candidate: round {i + 1} / {self.rtl_selected_candidates}"
-                )
-                i = i % len(candidates_info_unique)
-                rtl_code, sim_mismatch_cnt, sim_log = candidates_info_unique[i]
-                with open(f"{self.output_dir_per_run}/rtl.sv", "w") as f:
-                    f.write(rtl_code)
-                self.rtl_edit.reset()
-                is_sim_pass, rtl_code = self.rtl_edit.chat(
-                    spec=spec,
-                    output_dir_per_run=self.output_dir_per_run,
-                    sim_failed_log=sim_log,
+        if rtl_need_fix and self.use_mutation_repair and candidates_info_unique:
+            if ckpt.mutation_candidate is None or ckpt.is_mutation_pass is None:
+                assert self.mutation_repair
+                rtl_code, sim_mismatch_cnt, sim_log = candidates_info_unique[0]
+                with span("mutation_repair"):
+                    (
+                        is_sim_pass,
+                        rtl_code,
+                        sim_mismatch_cnt,
+                        sim_log,
+                    ) = self.mutation_repair.run(
+                        self.output_dir_per_run, rtl_code, sim_mismatch_cnt, sim_log
+                    )
+                ckpt.is_mutation_pass = is_sim_pass
+                ckpt.mutation_candidate = CandidateRecord(
+                    rtl_code=rtl_code,
                     sim_mismatch_cnt=sim_mismatch_cnt,
+                    sim_log=sim_log,
+                )
+                self.checkpointer.save(self.token_counter)
+            else:
+                is_sim_pass = ckpt.is_mutation_pass
+                rtl_code = ckpt.mutation_candidate.rtl_code
+                sim_mismatch_cnt = ckpt.mutation_candidate.sim_mismatch_cnt
+                sim_log = ckpt.mutation_candidate.sim_log
+                logger.info("Restored mutation repair result from checkpoint")
+            if is_sim_pass:
+                self.write_output(rtl_code, "rtl.sv")
+                rtl_need_fix = False
+            else:
+                # The editor starts from the improved best candidate
+                candidates_info_unique[0] = (rtl_code, sim_mismatch_cnt, sim_log)
+
+        if rtl_need_fix:
+            # Editor iteration, resuming the sessions finished by a previous run
+            with span("editor_sessions"):
+                is_sim_pass, rtl_code = self.run_editor_sessions(
+                    spec, candidates_info_unique
                 )
-                if is_sim_pass:
-                    rtl_need_fix = False
-                    break
 
         if not is_sim_pass:  # Run if keep failing before last try
             is_sim_pass, _, _ = self.sim_reviewer.review()
 
         return is_sim_pass, rtl_code
 
+    def run_editor_session(
+        self,
+        spec: str,
+        session_id: int,
+        candidate: Tuple[str, int, str],
+        cancel_event: threading.Event,
+    ) -> Tuple[bool, str, int]:
+        """Edit one candidate in its own workspace with its own SimReviewer"""
+        assert self.rtl_edit
+        assert self.sim_reviewer
+        rtl_code, sim_mismatch_cnt, sim_log = candidate
+        workspace = os.path.join(
+            self.output_dir_per_run, "editor_sessions", str(session_id)
+        )
+        os.makedirs(workspace, exist_ok=True)
+        shutil.copyfile(
+            os.path.join(self.output_dir_per_run, "tb.sv"),
+            os.path.join(workspace, "tb.sv"),
+        )
+        with open(os.path.join(workspace, "rtl.sv"), "w") as f:
+            f.write(rtl_code)
+        rtl_edit = self.rtl_edit.spawn(self.sim_reviewer.for_dir(workspace))
+        with span("editor_session", session=session_id):
+            is_sim_pass, rtl_code = rtl_edit.chat(
+                spec=spec,
+                output_dir_per_run=workspace,
+                sim_failed_log=sim_log,
+                sim_mismatch_cnt=sim_mismatch_cnt,
+                cancel_event=cancel_event,
+            )
+        logger.info(
+            f"Editor session {session_id + 1} / {self.rtl_selected_candidates}: "
+            f"is_sim_pass = {is_sim_pass}, mismatch_cnt = {rtl_edit.last_mismatch_cnt}"
+        )
+        assert rtl_edit.last_mismatch_cnt is not None
+        return is_sim_pass, rtl_code, rtl_edit.last_mismatch_cnt
+
+    def run_editor_sessions(
+        self,
+        spec: str,
+        candidates: List[Tuple[str, int, str]],
+    ) -> Tuple[bool, str]:
+        """
+        Edit the selected candidates concurrently, session i on candidates[i].
+        The first session to pass cancels the others; they stop before their next
+        round and are waited for, so the tokens they spent are still counted.
+        Each finished session is checkpointed at once, and sessions finished by a
+        previous run are not run again.
+        Return the passing result, or else the one with the fewest mismatches.
+        """
+        assert self.checkpointer
+        ckpt = self.checkpointer.ckpt
+        results: Dict[int, Tuple[bool, str, int]] = {}
+        winner: int | None = None
+        for record in ckpt.editor_records:
+            results[record.session_id] = (
+                record.is_sim_pass,
+                record.rtl_code,
+                record.sim_mismatch_cnt,
+            )
+            logger.info(
+                f"Restored editor session {record.session_id + 1} from checkpoint"
+            )
+            if record.is_sim_pass and winner is None:
+                winner = record.session_id
+        session_ids = [
+            i for i in range(self.rtl_selected_candidates) if i not in results
+        ]
+        cancel_event = threading.Event()
+        lock = threading.Lock()
+
+        def record_session(i: int, future: Future) -> None:
+            nonlocal winner
+            if future.cancelled() or future.exception() is not None:
+                return
+            is_sim_pass, rtl_code, sim_mismatch_cnt = future.result()
+            with lock:
+                results[i] = (is_sim_pass, rtl_code, sim_mismatch_cnt)
+                ckpt.editor_records.append(
+                    EditorRecord(
+                        session_id=i,
+                        is_sim_pass=is_sim_pass,
+                        rtl_code=rtl_code,
+                        sim_mismatch_cnt=sim_mismatch_cnt,
+                    )
+                )
+                self.checkpointer.save(self.token_counter)
+                if is_sim_pass and winner is None:
+                    winner = i
+                    cancel_event.set()
+
+        if winner is None and session_ids:
+            with ThreadPoolExecutor(max_workers=len(session_ids)) as executor:
+                futures = []
+                for i in session_ids:
+                    future = executor.submit(
+                        contextvars.copy_context().run,
+                        self.run_editor_session,
+                        spec,
+                        i,
+                        candidates[i % len(candidates)],
+                        cancel_event,
+                    )
+                    future.add_done_callback(functools.partial(record_session, i))
+                    futures.append(future)
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                finally:
+                    # Also stops the remaining sessions early if one raised
+                    cancel_event.set()
+        if winner is None:
+            winner = min(results, key=lambda i: (results[i][2], i))
+        is_sim_pass, rtl_code, _ = results[winner]
+        self.write_output(rtl_code, "rtl.sv")
+        return is_sim_pass, rtl_code
+
     def run_instance_ablation(self, spec: str) -> Tuple[bool, str]:
         """
         Run a single instance of the benchmark in ablation mode
@@ -232,24 +531,53 @@ class TopAgent:
             if os.path.exists(f"{self.output_dir_per_run}/properly_finished.tag"):
                 os.remove(f"{self.output_dir_per_run}/properly_finished.tag")
             self.token_counter.reset()
+            # Resume from the last finished stage of an interrupted run
+            self.checkpointer = RunCheckpointer(
+                self.output_dir_per_run,
+                get_run_key(
+                    spec,
+                    self.llm.metadata.model_name,
+                    str(self.golden_tb_path),
+                    str(self.golden_rtl_blackbox_path),
+                    self.sim_type.name,
+                    f"{self.sim_max_retry},{self.rtl_max_candidates},{self.rtl_selected_candidates}",
+                    f"{self.use_patch_repair},{self.use_mutation_repair},"
+                    f"{self.use_patch_library},{self.editor_speculative_cnt}",
+                ),
+                enabled=self.use_checkpoint and not self.is_ablation,
+            )
+            self.checkpointer.restore_token_cnts(self.token_counter)
             self.sim_reviewer = SimReviewer(
                 self.output_dir_per_run,
                 self.golden_rtl_blackbox_path,
+                self.sim_type,
             )
             self.rtl_gen = RTLGenerator(self.token_counter)
+            self.rtl_gen.set_use_patch_repair(self.use_patch_repair)
             self.tb_gen = TBGenerator(self.token_counter)
             self.sim_judge = SimJudge(self.token_counter)
             self.rtl_edit = RTLEditor(
                 self.token_counter, sim_reviewer=self.sim_reviewer
             )
+            self.rtl_edit.set_speculative_cnt(self.editor_speculative_cnt)
+            self.rtl_edit.set_patch_library(
+                PatchLibrary(PATCH_LIBRARY_PATH) if self.use_patch_library else None
+            )
+            self.mutation_repair = MutationRepair(self.sim_reviewer)
             ret = (
                 self.run_instance(spec)
                 if not self.is_ablation
                 else self.run_instance_ablation(spec)
             )
             self.token_counter.log_token_stats()
+            self.rtl_gen.syntax_fix_stats.log_stats()
+            logger.info(
+                f"{'Sim judge calls saved':<40}: {self.sim_judge.saved_call_cnt}"
+            )
             with open(f"{self.output_dir_per_run}/properly_finished.tag", "w") as f:
                 f.write("1")
+            # Nothing left to resume; a later run of this task starts from scratch
+            self.checkpointer.clear()
         except Exception:
             exc_info = sys.exc_info()
             traceback.print_exception(*exc_info)
@@ -270,22 +598,17 @@ class TopAgent:
         self.output_dir_per_run = f"{self.output_path}/{benchmark_type_name}_{task_id}"
         os.makedirs(self.output_path, exist_ok=True)
         os.makedirs(self.output_dir_per_run, exist_ok=True)
-        set_log_dir(log_dir_per_run)
-        if self.redirect_log:
-            with open(f"{log_dir_per_run}/mage_rtl.log", "w") as f:
-                sys.stdout = f
-                sys.stderr = f
+        # Logs and stdout of this run are routed by context, not by swapping
+        # process-global handlers, so concurrent runs keep separate log dirs.
+        self.log_dir_per_run = log_dir_per_run
+        with (
+            task_log_context(log_dir_per_run, redirect_stdout=self.redirect_log),
+            span_trace(os.path.join(log_dir_per_run, SPAN_FILE_NAME)),
+            llm_ledger(
+                os.path.join(log_dir_per_run, LEDGER_FILE_NAME),
+                task_id=f"{benchmark_type_name}_{task_id}",
+            ),
+        ):
+            with span("task"):
                 result = self._run(spec)
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
-        else:
-            result = self._run(spec)
-        # Redirect log contains format with rich text.
-        # Provide a rich-free version for log parsing or less viewing.
-        if self.redirect_log:
-            with open(f"{log_dir_per_run}/mage_rtl.log", "r") as f:
-                content = f.read()
-            content = re.sub(r"\[.*?m", "", content)
-            with open(f"{log_dir_per_run}/mage_rtl_rich_free.log", "w") as f:
-                f.write(content)
         return result
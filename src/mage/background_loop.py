@@ -0,0 +1,98 @@
+import asyncio
+import atexit
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Coroutine, TypeVar
+
+T = TypeVar("T")
+
+
+class BackgroundEventLoop:
+    """
+    Process-wide asyncio loop on a daemon thread, started on first use.
+    Sync entry points submit coroutines to it instead of driving a loop of their
+    own, so they work from any thread or from inside a running loop (notebooks).
+    Async LLM clients are created on first use on this loop and keep living on it,
+    so every caller shares their connection pools and concurrency limits.
+    Coroutines run in a copy of the submitting context, carrying its contextvars
+    (log dir, span trace, LLM ledger, token tag).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: threading.Thread | None = None
+        self.max_blocking_workers = 64
+        atexit.register(self.stop)
+        os.register_at_fork(after_in_child=self.reset)
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                # For blocking LLM clients run via to_thread, which wait on the
+                # network; the default pool is sized for CPU work
+                loop.set_default_executor(
+                    ThreadPoolExecutor(
+                        max_workers=self.max_blocking_workers,
+                        thread_name_prefix="mage-blocking",
+                    )
+                )
+                self.thread = threading.Thread(
+                    target=loop.run_forever, name="mage-event-loop", daemon=True
+                )
+                self.thread.start()
+                self.loop = loop
+            return self.loop
+
+    def in_loop_thread(self) -> bool:
+        return self.thread is threading.current_thread()
+
+    def run(self, coro: Coroutine[Any, Any, T], timeout: float | None = None) -> T:
+        """Run coro on the loop and block the caller until it is done"""
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError(
+                "Blocking on the background loop from its own thread would deadlock, "
+                "await the coroutine instead"
+            )
+        # call_soon_threadsafe copies the caller's context into the new task
+        future = asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+        return future.result(timeout)
+
+    async def run_async(self, coro: Coroutine[Any, Any, T]) -> T:
+        """Await coro on the loop from a coroutine of any other loop"""
+        if self.in_loop_thread():
+            return await coro
+        future = asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+        return await asyncio.wrap_future(future)
+
+    def stop(self) -> None:
+        with self.lock:
+            loop, thread = self.loop, self.thread
+            self.loop = self.thread = None
+        if loop is None or thread is None:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+
+    def reset(self) -> None:
+        """The loop thread does not survive fork, the child starts its own"""
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+
+
+# Global BackgroundEventLoop instance
+background_loop = BackgroundEventLoop()
+
+
+def run_in_background_loop(
+    coro: Coroutine[Any, Any, T], timeout: float | None = None
+) -> T:
+    return background_loop.run(coro, timeout)
+
+
+async def await_in_background_loop(coro: Coroutine[Any, Any, T]) -> T:
+    return await background_loop.run_async(coro)
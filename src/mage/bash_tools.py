@@ -1,10 +1,12 @@
 import json
+import os
 from subprocess import PIPE, Popen, TimeoutExpired
 from typing import Tuple
 
 from pydantic import BaseModel
 
 from .log_utils import get_logger
+from .span_trace import span
 
 logger = get_logger(__name__)
 
@@ -14,13 +16,17 @@ class CommandResult(BaseModel):
     stderr: str
 
 
-def run_bash_command(cmd: str, timeout: float | None = None) -> Tuple[bool, str]:
+def run_bash_command(
+    cmd: str, timeout: float | None = None, span_name: str | None = None
+) -> Tuple[bool, str]:
     logger.info(f"Running command: {cmd}")
+    span_name = span_name or os.path.basename(cmd.split(maxsplit=1)[0])
     process = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, text=True)
     try:
-        stdout, stderr = process.communicate(
-            timeout=timeout
-        )  # Set your desired timeout in seconds
+        with span(span_name, category="subprocess"):
+            stdout, stderr = process.communicate(
+                timeout=timeout
+            )  # Set your desired timeout in seconds
     except TimeoutExpired:
         process.kill()
         err_msg = f"Timeout {timeout}s reached."
@@ -1,13 +1,21 @@
+import hashlib
 import json
 import os
 import re
+from collections.abc import Mapping
 from enum import Enum
-from typing import Dict, Tuple
+from typing import Dict, Iterator, List
+
+from pydantic import BaseModel
 
 from .log_utils import get_logger
 
 logger = get_logger(__name__)
 
+BENCHMARK_CACHE_DIR = os.path.expanduser(
+    os.environ.get("MAGE_BENCHMARK_CACHE_DIR", "~/.cache/mage/benchmark")
+)
+
 
 class TypeBenchmark(Enum):
     VERILOG_EVAL_V1 = 1
@@ -29,6 +37,227 @@ def load_json(filename):
     return des_data
 
 
+FILE_SUFFIXES = {
+    TypeBenchmarkFile.SPEC: "_prompt.txt",
+    TypeBenchmarkFile.TEST_PATH: "_test.sv",
+    TypeBenchmarkFile.GOLDEN_PATH: "_ref.sv",
+}
+
+
+def get_benchmark_folder(benchmark_type: TypeBenchmark, benchmark_repo: str) -> str:
+    if benchmark_type == TypeBenchmark.VERILOG_EVAL_V1:
+        return os.path.join(benchmark_repo, "dataset_code-complete-iccad2023")
+    if benchmark_type == TypeBenchmark.VERILOG_EVAL_V2:
+        return os.path.join(benchmark_repo, "dataset_spec-to-rtl")
+    raise ValueError(f"Invalid benchmark_type: {benchmark_type}")
+
+
+class BenchmarkFileRecord(BaseModel):
+    path: str
+    size: int
+    mtime_ns: int
+    sha256: str | None = None  # Hashed on first get_sha256
+
+    def is_stale(self, stat: os.stat_result) -> bool:
+        return (self.size, self.mtime_ns) != (stat.st_size, stat.st_mtime_ns)
+
+
+class BenchmarkRecord(BaseModel):
+    """All files of one benchmark task"""
+
+    task_id: str
+    files: Dict[str, BenchmarkFileRecord] = {}  # TypeBenchmarkFile name -> file
+
+    def get_path(self, file_type: TypeBenchmarkFile) -> str | None:
+        file = self.files.get(file_type.name)
+        return file.path if file else None
+
+
+class BenchmarkManifest(BaseModel):
+    folder: str
+    dir_mtime_ns: int
+    records: Dict[str, BenchmarkRecord]
+
+
+class BenchmarkSpecs(Mapping):
+    """Read-only {task_id: spec} mapping, reading each spec on first access"""
+
+    def __init__(self, index: "BenchmarkIndex", task_ids: List[str]):
+        self.index = index
+        self.task_ids = task_ids
+
+    def __getitem__(self, task_id: str) -> str:
+        if task_id not in self.task_ids:
+            raise KeyError(task_id)
+        return self.index.get_spec(task_id)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.task_ids)
+
+    def __len__(self) -> int:
+        return len(self.task_ids)
+
+
+class BenchmarkIndex:
+    """
+    One-pass index of a benchmark dataset: a record per task with the paths,
+    sizes and mtimes of its spec / test / ref files, content hashes on demand.
+    The manifest is cached on disk. The dataset dir is listed again only when
+    its mtime changes. Files edited in place keep the dir mtime, so they are
+    caught only with check_files, which stats every file at startup.
+    """
+
+    def __init__(
+        self,
+        benchmark_type: TypeBenchmark,
+        benchmark_repo: str,
+        cache_dir: str = BENCHMARK_CACHE_DIR,
+        check_files: bool = False,
+    ):
+        self.benchmark_type = benchmark_type
+        self.check_files = check_files
+        self.folder = os.path.abspath(
+            get_benchmark_folder(benchmark_type, benchmark_repo)
+        )
+        folder_digest = hashlib.sha256(self.folder.encode()).hexdigest()[:16]
+        self.manifest_path = os.path.join(
+            cache_dir, f"{benchmark_type.name}_{folder_digest}.json"
+        )
+        self.spec_cache: Dict[str, str] = {}
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self) -> BenchmarkManifest:
+        dir_mtime_ns = os.stat(self.folder).st_mtime_ns
+        manifest = self.read_manifest()
+        if manifest is not None and manifest.dir_mtime_ns == dir_mtime_ns:
+            if not self.check_files:
+                return manifest
+            try:
+                if self.refresh(manifest):
+                    self.save_manifest(manifest)
+                return manifest
+            except FileNotFoundError:
+                pass  # Removed without changing the dir mtime, list it again
+        manifest = self.scan(dir_mtime_ns, manifest)
+        self.save_manifest(manifest)
+        return manifest
+
+    def read_manifest(self) -> BenchmarkManifest | None:
+        if not os.path.isfile(self.manifest_path):
+            return None
+        try:
+            with open(self.manifest_path, "r") as f:
+                return BenchmarkManifest.model_validate_json(f.read())
+        except ValueError as e:
+            logger.warning(f"Ignore broken manifest {self.manifest_path}: {e}")
+            return None
+
+    def save_manifest(self, manifest: BenchmarkManifest) -> None:
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(manifest.model_dump_json())
+        os.replace(tmp_path, self.manifest_path)
+
+    def refresh(self, manifest: BenchmarkManifest) -> bool:
+        """Update the stat of files edited in place, dropping their hash"""
+        changed = False
+        for record in manifest.records.values():
+            for file in record.files.values():
+                stat = os.stat(file.path)
+                if file.is_stale(stat):
+                    logger.info(f"Benchmark file changed: {file.path}")
+                    file.size, file.mtime_ns = stat.st_size, stat.st_mtime_ns
+                    file.sha256 = None
+                    changed = True
+        return changed
+
+    def scan(
+        self, dir_mtime_ns: int, old_manifest: BenchmarkManifest | None = None
+    ) -> BenchmarkManifest:
+        """List the dataset dir, keeping hashes of files unchanged since old_manifest"""
+        logger.info(f"Indexing benchmark folder {self.folder}")
+        old_files = (
+            {
+                file.path: file
+                for record in old_manifest.records.values()
+                for file in record.files.values()
+            }
+            if old_manifest
+            else {}
+        )
+        records: Dict[str, BenchmarkRecord] = {}
+        for entry in sorted(os.scandir(self.folder), key=lambda e: e.name):
+            if not entry.is_file():
+                continue
+            for file_type, suffix in FILE_SUFFIXES.items():
+                if not entry.name.endswith(suffix) or entry.name == suffix:
+                    continue
+                task_id = entry.name[: -len(suffix)]
+                stat = entry.stat()
+                old_file = old_files.get(entry.path)
+                record = records.setdefault(task_id, BenchmarkRecord(task_id=task_id))
+                record.files[file_type.name] = BenchmarkFileRecord(
+                    path=entry.path,
+                    size=stat.st_size,
+                    mtime_ns=stat.st_mtime_ns,
+                    sha256=(
+                        old_file.sha256
+                        if old_file and not old_file.is_stale(stat)
+                        else None
+                    ),
+                )
+        return BenchmarkManifest(
+            folder=self.folder, dir_mtime_ns=dir_mtime_ns, records=records
+        )
+
+    def task_ids(
+        self,
+        filter_instance: str = r"^(.*)$",
+        file_type: TypeBenchmarkFile = TypeBenchmarkFile.SPEC,
+    ) -> List[str]:
+        return [
+            task_id
+            for task_id, record in sorted(self.manifest.records.items())
+            if file_type.name in record.files and re.match(filter_instance, task_id)
+        ]
+
+    def get_record(self, task_id: str) -> BenchmarkRecord:
+        return self.manifest.records[task_id]
+
+    def get_path(self, task_id: str, file_type: TypeBenchmarkFile) -> str | None:
+        return self.manifest.records[task_id].get_path(file_type)
+
+    def get_sha256(self, task_id: str, file_type: TypeBenchmarkFile) -> str:
+        file = self.manifest.records[task_id].files[file_type.name]
+        if file.sha256 is None:
+            with open(file.path, "rb") as f:
+                file.sha256 = hashlib.sha256(f.read()).hexdigest()
+            self.save_manifest(self.manifest)
+        return file.sha256
+
+    def get_spec(self, task_id: str) -> str:
+        if task_id not in self.spec_cache:
+            spec_path = self.get_path(task_id, TypeBenchmarkFile.SPEC)
+            assert spec_path, f"No spec found for {task_id}"
+            with open(spec_path, "r") as f:
+                self.spec_cache[task_id] = f.read()
+        return self.spec_cache[task_id]
+
+    def specs(self, filter_instance: str = r"^(.*)$") -> BenchmarkSpecs:
+        return BenchmarkSpecs(self, self.task_ids(filter_instance))
+
+    def paths(
+        self, file_type: TypeBenchmarkFile, filter_instance: str = r"^(.*)$"
+    ) -> Dict[str, str]:
+        ret: Dict[str, str] = {}
+        for task_id in self.task_ids(filter_instance, file_type):
+            path = self.get_path(task_id, file_type)
+            assert path
+            ret[task_id] = path
+        return ret
+
+
 def get_benchmark_contents(
     benchmark_type: TypeBenchmark,
     file_type: TypeBenchmarkFile,
@@ -38,57 +267,9 @@ def get_benchmark_contents(
     """
     Get Dict of {problem_name: problem_content/testbench_content} for given benchmark
     """
-    if (
-        benchmark_type == TypeBenchmark.VERILOG_EVAL_V1
-        or benchmark_type == TypeBenchmark.VERILOG_EVAL_V2
-    ):
-        folder = os.path.join(
-            benchmark_repo,
-            (
-                "dataset_code-complete-iccad2023"
-                if benchmark_type == TypeBenchmark.VERILOG_EVAL_V1
-                else "dataset_spec-to-rtl"
-            ),
-        )
-        files = os.listdir(folder)
-        files.sort()
-        re_str = r"$^"  # dummy
-        if file_type == TypeBenchmarkFile.SPEC:
-            re_str = r"(.*)_prompt.txt"
-        elif file_type == TypeBenchmarkFile.TEST_PATH:
-            re_str = r"(.*)_test.sv"
-        elif file_type == TypeBenchmarkFile.GOLDEN_PATH:
-            re_str = r"(.*)_ref.sv"
-        else:
-            raise ValueError(f"Invalid file_type: {file_type}")
-
-        def is_target(file_name: str) -> Tuple[str, str] | None:
-            full_path = os.path.join(folder, file_name)
-            if not os.path.isfile(full_path):
-                return None
-            m = re.match(re_str, file_name)
-            if not m:
-                return None
-            if not re.match(filter_instance, m[1]):
-                return None
-            return (m[1], full_path)
-
-        ret = {}
-
-        for file in files:
-
-            p = is_target(file)
-            if not p:
-                continue
-
-            if file_type == TypeBenchmarkFile.SPEC:
-                with open(p[1], "r") as f:
-                    ret[p[0]] = f.read()
-            elif (
-                file_type == TypeBenchmarkFile.TEST_PATH
-                or file_type == TypeBenchmarkFile.GOLDEN_PATH
-            ):
-                ret[p[0]] = p[1]
-
-        return ret
-    raise ValueError(f"Invalid benchmark_type: {benchmark_type}")
+    index = BenchmarkIndex(benchmark_type, benchmark_repo)
+    if file_type == TypeBenchmarkFile.SPEC:
+        return dict(index.specs(filter_instance))
+    if file_type in (TypeBenchmarkFile.TEST_PATH, TypeBenchmarkFile.GOLDEN_PATH):
+        return index.paths(file_type, filter_instance)
+    raise ValueError(f"Invalid file_type: {file_type}")
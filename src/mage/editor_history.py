@@ -0,0 +1,98 @@
+import bisect
+from typing import Callable, List, Tuple
+
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+
+HISTORY_SUMMARY_PROMPT = r"""
+Summary of earlier editing rounds, whose full action outputs are omitted:
+<history_summary>
+{summary}
+</history_summary>
+"""
+
+# (round index, messages, summary line, token count, is success, state before it)
+EditorRound = Tuple[int, List[ChatMessage], str, int, bool, str]
+
+
+class EditorHistory:
+    """
+    Rounds of an editor session as prompt messages, kept within a token budget.
+    Rounds are sent in full until they exceed the budget. Then the oldest ones
+    are folded into one-line records of a summary message, down to half the
+    budget at once. A successful round also folds the failed rounds since the
+    last success. Between folds, messages are only appended, so provider
+    prefix caches keep hitting.
+    A round may carry the state it starts from, e.g. the code being edited. When
+    the first round kept in full starts from a state other than init_state, the
+    summary message also holds that state.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        token_budget: int,
+        init_state: str = "",
+    ):
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+        self.init_state = init_state
+        # (round index, summary line) of folded rounds, in round order
+        self.folded_rounds: List[Tuple[int, str]] = []
+        self.rounds: List[EditorRound] = []
+        self.round_cnt = 0
+        self.fold_cnt = 0
+
+    @property
+    def summary_lines(self) -> List[str]:
+        return [line for _, line in self.folded_rounds]
+
+    def get_token_cnt(self) -> int:
+        return sum(r[3] for r in self.rounds)
+
+    def fold(self, rounds: List[EditorRound]) -> None:
+        for r in rounds:
+            bisect.insort(self.folded_rounds, (r[0], r[2]))
+        folded = set(r[0] for r in rounds)
+        self.rounds = [r for r in self.rounds if r[0] not in folded]
+        self.fold_cnt += 1
+
+    def add_round(
+        self,
+        messages: List[ChatMessage],
+        summary_line: str,
+        is_success: bool = True,
+        state: str = "",
+    ) -> None:
+        if is_success:
+            failed_rounds = [r for r in self.rounds if not r[4]]
+            if failed_rounds:
+                self.fold(failed_rounds)
+        token_cnt = sum(self.count_tokens(str(m.content)) for m in messages)
+        self.rounds.append(
+            (self.round_cnt, messages, summary_line, token_cnt, is_success, state)
+        )
+        self.round_cnt += 1
+        if self.get_token_cnt() <= self.token_budget:
+            return
+        # Keep the latest round in full, however long it is
+        token_cnt = self.get_token_cnt()
+        fold_cnt = 0
+        while fold_cnt < len(self.rounds) - 1 and token_cnt > self.token_budget // 2:
+            token_cnt -= self.rounds[fold_cnt][3]
+            fold_cnt += 1
+        if fold_cnt:
+            self.fold(self.rounds[:fold_cnt])
+
+    def get_messages(self) -> List[ChatMessage]:
+        messages = []
+        if self.folded_rounds:
+            content = HISTORY_SUMMARY_PROMPT.format(
+                summary="\n".join(self.summary_lines)
+            )
+            state = self.rounds[0][5]
+            if state != self.init_state:
+                content += state
+            messages.append(ChatMessage(content=content, role=MessageRole.USER))
+        for r in self.rounds:
+            messages.extend(r[1])
+        return messages
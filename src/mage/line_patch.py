@@ -0,0 +1,69 @@
+import json
+import re
+from typing import Dict, List
+
+from pydantic import BaseModel
+
+PATCH_EXAMPLE_OUTPUT = {
+    "reasoning": "Brief one-sentence reasoning",
+    "patches": [
+        {
+            "start_line": 12,
+            "end_line": 13,
+            "content": "Code replacing lines 12 to 13",
+        }
+    ],
+}
+
+LINENO_PREFIX_RE = re.compile(r"^\d+: ?")
+
+
+class LinePatch(BaseModel):
+    """Replace lines start_line to end_line (1-based, inclusive) with content"""
+
+    start_line: int
+    end_line: int
+    content: str
+
+
+def parse_line_patches(output: str) -> List[LinePatch]:
+    """Patches of a JSON response in the PATCH_EXAMPLE_OUTPUT format"""
+    output_json_obj: Dict = json.loads(output, strict=False)
+    patches = output_json_obj["patches"]
+    if not isinstance(patches, list) or not patches:
+        raise ValueError("No patches given")
+    return [LinePatch.model_validate(patch) for patch in patches]
+
+
+def apply_line_patches(code: str, patches: List[LinePatch]) -> str:
+    """
+    Apply patches against the lines of code as numbered by add_lineno.
+    Raise ValueError if a patch is out of range or overlaps another one.
+    """
+    lines = code.split("\n")
+    patches = sorted(patches, key=lambda p: (p.start_line, p.end_line))
+    last_end = 0
+    for patch in patches:
+        if not (
+            1 <= patch.start_line <= len(lines) + 1
+            and patch.start_line - 1 <= patch.end_line <= len(lines)
+        ):
+            raise ValueError(
+                f"Patch of lines {patch.start_line}-{patch.end_line} is out of "
+                f"range 1-{len(lines)}"
+            )
+        if patch.start_line <= last_end:
+            raise ValueError(
+                f"Patch of lines {patch.start_line}-{patch.end_line} overlaps "
+                "another patch"
+            )
+        last_end = max(last_end, patch.end_line)
+    for patch in reversed(patches):
+        new_lines = patch.content.split("\n") if patch.content else []
+        # Line numbers copied from the line-numbered code
+        if new_lines and all(
+            LINENO_PREFIX_RE.match(line) for line in new_lines if line.strip()
+        ):
+            new_lines = [LINENO_PREFIX_RE.sub("", line) for line in new_lines]
+        lines[patch.start_line - 1 : patch.end_line] = new_lines
+    return "\n".join(lines)
@@ -0,0 +1,243 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse
+from pydantic import BaseModel
+
+from .span_trace import current_stage_var, percentile
+
+LEDGER_FILE_NAME = "llm_calls.jsonl"
+
+
+class LLMCallRecord(BaseModel):
+    """One LLM call. Times are in seconds."""
+
+    timestamp: float
+    task_id: str
+    agent: str
+    stage: str
+    model: str
+    prompt_hash: str
+    prompt_chars: int
+    in_token_cnt: int = 0
+    out_token_cnt: int = 0
+    cache_write_cnt: int = 0
+    cache_read_cnt: int = 0
+    cost: float = 0.0
+    queue_time: float = 0.0
+    # Calls are not streamed, so the first token arrives with the whole response
+    time_to_first_token: float | None = None
+    latency: float = 0.0
+    finish_reason: str | None = None
+    error: str | None = None
+    retry_cnt: int = 0
+
+
+class LLMLedger:
+    """Per-task JSONL ledger of LLM calls"""
+
+    def __init__(self, path: str, task_id: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.task_id = task_id
+        self.f = open(path, "w")
+        self.lock = threading.Lock()
+        # Consecutive failed calls per agent, counted as retries of the next call
+        self.failed_cnts: Dict[str, int] = {}
+
+    def write(self, record: LLMCallRecord) -> None:
+        with self.lock:
+            if record.error:
+                self.failed_cnts[record.agent] = (
+                    self.failed_cnts.get(record.agent, 0) + 1
+                )
+            else:
+                self.failed_cnts[record.agent] = 0
+            self.f.write(record.model_dump_json() + "\n")
+            self.f.flush()
+
+    def get_retry_cnt(self, agent: str) -> int:
+        with self.lock:
+            return self.failed_cnts.get(agent, 0)
+
+    def close(self) -> None:
+        with self.lock:
+            self.f.close()
+
+
+llm_ledger_var: ContextVar[LLMLedger | None] = ContextVar("llm_ledger", default=None)
+
+
+@contextmanager
+def llm_ledger(path: str, task_id: str) -> Iterator[LLMLedger]:
+    """Record LLM calls of the current context to path"""
+    ledger = LLMLedger(path, task_id)
+    token = llm_ledger_var.set(ledger)
+    try:
+        yield ledger
+    finally:
+        llm_ledger_var.reset(token)
+        ledger.close()
+
+
+def get_finish_reason(response: ChatResponse) -> str | None:
+    raw = response.raw
+    if raw is None:
+        return None
+    if isinstance(raw, dict):
+        # Anthropic
+        if raw.get("stop_reason"):
+            return str(raw["stop_reason"])
+        choices = raw.get("choices")
+    else:
+        choices = getattr(raw, "choices", None)
+    if choices:
+        # OpenAI compatible
+        choice = choices[0]
+        reason = (
+            choice.get("finish_reason")
+            if isinstance(choice, dict)
+            else getattr(choice, "finish_reason", None)
+        )
+        return str(reason) if reason is not None else None
+    return None
+
+
+class PendingLLMCall:
+    """Timing of one call in flight; does nothing without a ledger in context"""
+
+    def __init__(
+        self,
+        agent: str,
+        model: str,
+        messages: Sequence[ChatMessage],
+        enqueue_time: float | None = None,
+    ):
+        self.ledger = llm_ledger_var.get()
+        self.start_time = time.time()
+        if self.ledger is None:
+            return
+        prompt = "\0".join(f"{m.role.value}\0{m.content}" for m in messages)
+        self.record = LLMCallRecord(
+            timestamp=self.start_time,
+            task_id=self.ledger.task_id,
+            agent=agent,
+            stage=current_stage_var.get() or "",
+            model=model,
+            prompt_hash=hashlib.sha256(prompt.encode()).hexdigest(),
+            prompt_chars=len(prompt),
+            queue_time=self.start_time - enqueue_time if enqueue_time else 0.0,
+            retry_cnt=self.ledger.get_retry_cnt(agent),
+        )
+
+    def finish(self, response: ChatResponse, token_cnt: Any, cost: float) -> None:
+        if self.ledger is None:
+            return
+        self.record.latency = time.time() - self.start_time
+        self.record.time_to_first_token = self.record.latency
+        self.record.finish_reason = get_finish_reason(response)
+        self.record.in_token_cnt = token_cnt.in_token_cnt
+        self.record.out_token_cnt = token_cnt.out_token_cnt
+        self.record.cache_write_cnt = getattr(token_cnt, "cache_write_cnt", 0)
+        self.record.cache_read_cnt = getattr(token_cnt, "cache_read_cnt", 0)
+        self.record.cost = cost
+        self.ledger.write(self.record)
+
+    def fail(self, e: BaseException) -> None:
+        if self.ledger is None:
+            return
+        self.record.latency = time.time() - self.start_time
+        self.record.error = f"{type(e).__name__}: {e}"
+        self.ledger.write(self.record)
+
+
+def load_ledger_records(paths: Sequence[str]) -> List[LLMCallRecord]:
+    records = []
+    for path in paths:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    records.append(LLMCallRecord.model_validate_json(line))
+                except ValueError:
+                    continue  # Cut by a crash
+    return records
+
+
+def summarize_ledger(
+    records: Sequence[LLMCallRecord], group_by: Sequence[str] = ("agent", "stage")
+) -> Dict[str, Dict[str, Any]]:
+    """Calls, tokens, cost and latency p50/p95 per group"""
+    groups: Dict[Tuple[str, ...], List[LLMCallRecord]] = {}
+    for record in records:
+        key = tuple(getattr(record, field) or "-" for field in group_by)
+        groups.setdefault(key, []).append(record)
+    summary = {}
+    for key in sorted(groups):
+        group = groups[key]
+        latencies = sorted(r.latency for r in group)
+        queue_times = sorted(r.queue_time for r in group)
+        summary["/".join(key)] = {
+            "calls": len(group),
+            "errors": sum(r.error is not None for r in group),
+            "tasks": len({r.task_id for r in group}),
+            "in_token_cnt": sum(r.in_token_cnt for r in group),
+            "out_token_cnt": sum(r.out_token_cnt for r in group),
+            "cache_read_cnt": sum(r.cache_read_cnt for r in group),
+            "cost": round(sum(r.cost for r in group), 4),
+            "latency_p50": round(percentile(latencies, 0.5), 3),
+            "latency_p95": round(percentile(latencies, 0.95), 3),
+            "latency_total": round(sum(latencies), 3),
+            "queue_time_p95": round(percentile(queue_times, 0.95), 3),
+        }
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Break down LLM cost and latency of a sweep by agent and stage"
+    )
+    parser.add_argument(
+        "log_paths", nargs="+", help="Log dirs, searched recursively for ledgers"
+    )
+    parser.add_argument(
+        "--group-by",
+        default="agent,stage",
+        help="Comma separated LLMCallRecord fields, e.g. agent / stage / model",
+    )
+    parser.add_argument("--json", action="store_true", help="Print as JSON")
+    args = parser.parse_args()
+
+    paths = sorted(
+        path
+        for log_path in args.log_paths
+        for path in glob.glob(
+            os.path.join(log_path, "**", LEDGER_FILE_NAME), recursive=True
+        )
+    )
+    records = load_ledger_records(paths)
+    summary = summarize_ledger(records, args.group_by.split(","))
+    if args.json:
+        print(json.dumps(summary, indent=4))
+        return
+    print(f"{len(records)} calls in {len(paths)} ledgers")
+    header = f"{args.group_by:<40} {'calls':>6} {'err':>4} {'in_tok':>10} {'out_tok':>9} {'cost$':>8} {'p50 s':>7} {'p95 s':>7} {'total s':>9}"
+    print(header)
+    for key, row in summary.items():
+        print(
+            f"{key:<40} {row['calls']:>6} {row['errors']:>4} "
+            f"{row['in_token_cnt']:>10} {row['out_token_cnt']:>9} "
+            f"{row['cost']:>8.2f} {row['latency_p50']:>7.2f} "
+            f"{row['latency_p95']:>7.2f} {row['latency_total']:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
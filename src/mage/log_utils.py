@@ -1,32 +1,277 @@
+import atexit
+import copy
 import logging
 import os
-from typing import Dict
+import re
+import sys
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+from typing import IO, Dict, Iterator, List
 
 from rich.logging import RichHandler
 
 logging.basicConfig(level=logging.INFO)
 
+LOG_FORMAT = "[%(asctime)s - %(name)s - %(levelname)s] %(message)s"
+
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+
+
+class RichFreeTee:
+    """
+    Write everything to log_path, and an ANSI-stripped copy to rich_free_path
+    as it is produced. An escape sequence split over two writes is held back
+    until it is complete.
+    """
+
+    def __init__(self, log_path: str, rich_free_path: str):
+        self.raw: IO[str] = open(log_path, "w")
+        self.rich_free: IO[str] = open(rich_free_path, "w")
+        self.pending = ""
+        self.lock = threading.Lock()
+
+    def write(self, s: str) -> int:
+        with self.lock:
+            self.raw.write(s)
+            text = self.pending + s
+            cut = text.rfind("\x1b")
+            if cut != -1 and not ANSI_ESCAPE.match(text, cut):
+                text, self.pending = text[:cut], text[cut:]
+            else:
+                self.pending = ""
+            self.rich_free.write(ANSI_ESCAPE.sub("", text))
+        return len(s)
+
+    def flush(self) -> None:
+        with self.lock:
+            self.raw.flush()
+            self.rich_free.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            self.rich_free.write(self.pending)
+            self.raw.close()
+            self.rich_free.close()
+
+
+class TaskLogContext:
+    """
+    Log destination of one task, carried by a contextvar.
+    Records are written to {log_dir}/mage_rtl_total.log and {log_dir}/{logger}.log,
+    file handlers are opened on first use and closed with the context.
+    to_file=None follows the stdout/file mode of the LoggingManager.
+    """
+
+    def __init__(
+        self,
+        log_dir: str,
+        to_file: bool | None = None,
+        per_module_logs: bool = True,
+        redirect_stdout: bool = False,
+    ):
+        self.log_dir = log_dir
+        self.to_file = to_file
+        self.per_module_logs = per_module_logs
+        os.makedirs(log_dir, exist_ok=True)
+        self.handlers: Dict[str, logging.Handler] = {}
+        self.spill_cnt = 0
+        self.lock = threading.Lock()
+        self.stdout: RichFreeTee | None = None
+        if redirect_stdout:
+            # Provide a rich-free version for log parsing or less viewing.
+            self.stdout = RichFreeTee(
+                os.path.join(log_dir, "mage_rtl.log"),
+                os.path.join(log_dir, "mage_rtl_rich_free.log"),
+            )
+
+    def get_handler(self, file_name: str) -> logging.Handler:
+        with self.lock:
+            if file_name not in self.handlers:
+                handler = logging.FileHandler(
+                    os.path.join(self.log_dir, file_name), mode="w"
+                )
+                handler.setLevel(logging.DEBUG)
+                handler.setFormatter(logging.Formatter(LOG_FORMAT))
+                self.handlers[file_name] = handler
+            return self.handlers[file_name]
+
+    def spill(self, name: str, message: str) -> str:
+        """Keep an oversized record in full in its own file"""
+        with self.lock:
+            self.spill_cnt += 1
+            spill_path = os.path.join(
+                self.log_dir, "spill", f"{name}.{self.spill_cnt:06d}.log"
+            )
+        os.makedirs(os.path.dirname(spill_path), exist_ok=True)
+        with open(spill_path, "w") as f:
+            f.write(message)
+        return spill_path
+
+    def handle(self, record: logging.LogRecord) -> None:
+        self.get_handler("mage_rtl_total.log").handle(record)
+        if self.per_module_logs:
+            self.get_handler(f"{record.name}.log").handle(record)
+
+    def close(self) -> None:
+        with self.lock:
+            for handler in self.handlers.values():
+                handler.close()
+            self.handlers = {}
+        if self.stdout:
+            self.stdout.close()
+
+
+task_log_context_var: ContextVar[TaskLogContext | None] = ContextVar(
+    "task_log_context", default=None
+)
+
+
+class ContextQueueHandler(QueueHandler):
+    """
+    Single handler of all loggers. On the calling thread it only tags the record
+    with the current task context and enqueues it, formatting and disk writes
+    happen on the writer thread of the LoggingManager.
+    """
+
+    def __init__(self, queue: Queue, manager: "LoggingManager"):
+        super().__init__(queue)
+        self.manager = manager
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.manager.queue.put_nowait(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # Formatting is deferred, snapshot lists (e.g. chat histories) that the
+        # caller may keep appending to
+        if isinstance(record.args, tuple):
+            record.args = tuple(
+                list(arg) if isinstance(arg, list) else arg for arg in record.args
+            )
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.task_log_context = task_log_context_var.get()
+        record.to_file = self.manager.get_file_context() is not None
+        return record
+
+
+class ContextWriterHandler(logging.Handler):
+    """Runs on the writer thread, sends records to the files of their task"""
+
+    def __init__(self, manager: "LoggingManager"):
+        super().__init__(logging.DEBUG)
+        self.manager = manager
+
+    def emit(self, record: logging.LogRecord) -> None:
+        ctx: TaskLogContext | None = getattr(record, "task_log_context", None)
+        max_chars = self.manager.record_max_chars
+        if ctx is not None and max_chars:
+            message = record.getMessage()
+            if len(message) > max_chars:
+                spill_path = ctx.spill(record.name, message)
+                record.msg = (
+                    f"{message[:max_chars]}\n... [{len(message) - max_chars} more "
+                    f"chars, full record in {os.path.relpath(spill_path, ctx.log_dir)}]"
+                )
+                record.args = None
+        if getattr(record, "to_file", False):
+            assert ctx
+            ctx.handle(record)
+            return
+        # Rich writes to sys.stdout, which follows the task context
+        token = task_log_context_var.set(ctx)
+        try:
+            self.manager.rich_handler.handle(record)
+        finally:
+            task_log_context_var.reset(token)
+
+
+class ContextStream:
+    """
+    Installed once as sys.stdout / sys.stderr. Writes go to the stdout copy of
+    the current task context if it redirects stdout, else to the original stream.
+    """
+
+    def __init__(self, stream: IO[str]):
+        self.stream = stream
+
+    def target(self) -> IO[str]:
+        ctx = task_log_context_var.get()
+        if ctx is not None and ctx.stdout is not None:
+            return ctx.stdout  # type: ignore[return-value]
+        return self.stream
+
+    def write(self, s: str) -> int:
+        return self.target().write(s)
+
+    def writelines(self, lines: List[str]) -> None:
+        for line in lines:
+            self.write(line)
+
+    def flush(self) -> None:
+        self.target().flush()
+
+    def isatty(self) -> bool:
+        target = self.target()
+        return target is self.stream and self.stream.isatty()
+
+    def __getattr__(self, name: str):
+        return getattr(self.stream, name)
+
 
 class LoggingManager:
     def __init__(self):
         self.loggers: Dict[str, logging.Logger] = {}
-        self.current_log_dir = ""
         self.use_stdout = True
         self.rich_handler = RichHandler(
             show_time=bool(os.environ.get("LLM4RTL_LOG_TIME", False)),
             show_path=bool(os.environ.get("LLM4RTL_LOG_PATH", False)),
         )
         self.rich_handler.setLevel(logging.DEBUG)
+        self.level = logging.getLevelName(os.environ.get("MAGE_LOG_LEVEL", "DEBUG"))
+        # Longer records are truncated in the log and spilled to a file, 0 for no cap
+        self.record_max_chars = int(
+            os.environ.get("MAGE_LOG_RECORD_MAX_CHARS", 64 * 1024)
+        )
+        self.stream_lock = threading.Lock()
+        self.start_writer()
+        self.queue_handler = ContextQueueHandler(self.queue, self)
+        atexit.register(self.stop_writer)
+        os.register_at_fork(after_in_child=self.start_writer)
+
+    def start_writer(self) -> None:
+        """Background thread that formats and writes all log records"""
+        self.queue: Queue = Queue()
+        self.listener = QueueListener(self.queue, ContextWriterHandler(self))
+        self.listener.start()
+
+    def stop_writer(self) -> None:
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def flush(self) -> None:
+        """Wait until every record logged so far is written"""
+        self.queue.join()
+
+    def set_level(self, level: int | str) -> None:
+        """e.g. INFO to drop prompt logs, which are logged at DEBUG"""
+        self.level = logging.getLevelName(level) if isinstance(level, str) else level
+        for logger in self.loggers.values():
+            logger.setLevel(self.level)
 
     def get_logger(self, name: str) -> logging.Logger:
         if name in self.loggers:
             return self.loggers[name]
 
         logger = logging.getLogger(name)
-        logger.setLevel(logging.DEBUG)
+        logger.setLevel(self.level)
 
         # Add the handler to the logger
-        logger.addHandler(self.rich_handler)
+        logger.addHandler(self.queue_handler)
         logger.propagate = False
 
         # Store the logger in our dictionary
@@ -34,67 +279,63 @@ class LoggingManager:
 
         return logger
 
-    def set_log_dir(self, new_dir: str) -> None:
-        if self.current_log_dir == new_dir:
-            return
-        self.current_log_dir = new_dir
+    def get_file_context(self) -> TaskLogContext | None:
+        """Task context of the caller, if its logs go to files"""
+        ctx = task_log_context_var.get()
+        if ctx is None:
+            return None
+        to_file = ctx.to_file if ctx.to_file is not None else not self.use_stdout
+        return ctx if to_file else None
 
-        # Ensure the new directory exists
-        os.makedirs(self.current_log_dir, exist_ok=True)
+    def install_context_streams(self) -> None:
+        with self.stream_lock:
+            if not isinstance(sys.stdout, ContextStream):
+                sys.stdout = ContextStream(sys.stdout)
+            if not isinstance(sys.stderr, ContextStream):
+                sys.stderr = ContextStream(sys.stderr)
 
-        if not self.use_stdout:
-            self._update_handlers()
+    @contextmanager
+    def task_log_context(
+        self,
+        log_dir: str,
+        to_file: bool | None = None,
+        per_module_logs: bool = True,
+        redirect_stdout: bool = False,
+    ) -> Iterator[TaskLogContext]:
+        """
+        Route logs (and optionally stdout/stderr) of the current context to log_dir.
+        Tasks running concurrently in their own contexts log to their own dirs.
+        """
+        if redirect_stdout:
+            self.install_context_streams()
+        ctx = TaskLogContext(log_dir, to_file, per_module_logs, redirect_stdout)
+        token = task_log_context_var.set(ctx)
+        try:
+            yield ctx
+        finally:
+            task_log_context_var.reset(token)
+            self.flush()
+            ctx.close()
 
-    def switch_to_file(self) -> None:
-        if not self.use_stdout:
+    def set_log_dir(self, new_dir: str) -> None:
+        """Route logs of the current context to new_dir until changed again"""
+        ctx = task_log_context_var.get()
+        if ctx is not None and ctx.log_dir == new_dir:
             return
+        if ctx is not None:
+            self.flush()
+            ctx.close()
+        task_log_context_var.set(TaskLogContext(new_dir))
+
+    def switch_to_file(self) -> None:
         self.use_stdout = False
-        if self.current_log_dir:
-            self._update_handlers()
 
     def switch_to_stdout(self) -> None:
-        if self.use_stdout:
-            return
         self.use_stdout = True
-        self._update_handlers()
 
-    def _update_handlers(self) -> None:
-        assert self.current_log_dir and os.path.isdir(self.current_log_dir)
-
-        formatter = logging.Formatter(
-            "[%(asctime)s - %(name)s - %(levelname)s] %(message)s"
-        )
-
-        if self.use_stdout:
-            for _, logger in self.loggers.items():
-                # Remove existing handlers
-                for handler in logger.handlers[:]:
-                    logger.removeHandler(handler)
-                logger.addHandler(self.rich_handler)
-            return
-
-        unified_log_file = os.path.join(self.current_log_dir, f"mage_rtl_total.log")
-        if os.path.exists(unified_log_file):
-            os.remove(unified_log_file)
-        unified_file_handler = logging.FileHandler(unified_log_file)
-        unified_file_handler.setLevel(logging.DEBUG)
-        unified_file_handler.setFormatter(formatter)
-
-        for name, logger in self.loggers.items():
-            # Remove existing handlers
-            for handler in logger.handlers[:]:
-                logger.removeHandler(handler)
-
-            # Add new handler
-            new_log_file = os.path.join(self.current_log_dir, f"{name}.log")
-            if os.path.exists(new_log_file):
-                os.remove(new_log_file)
-            new_handler = logging.FileHandler(new_log_file)
-            new_handler.setLevel(logging.DEBUG)
-            new_handler.setFormatter(formatter)
-
-            logger.addHandler(new_handler)
-            logger.addHandler(unified_file_handler)
+    def redirect_to_dir(self, log_dir: str):
+        """Send all logs of the current context to {log_dir}/mage_rtl_total.log"""
+        return self.task_log_context(log_dir, to_file=True, per_module_logs=False)
 
 
 # Global LoggingManager instance
@@ -110,6 +351,29 @@ def set_log_dir(new_dir: str) -> None:
     logging_manager.set_log_dir(new_dir)
 
 
+def task_log_context(
+    log_dir: str,
+    to_file: bool | None = None,
+    per_module_logs: bool = True,
+    redirect_stdout: bool = False,
+):
+    return logging_manager.task_log_context(
+        log_dir, to_file, per_module_logs, redirect_stdout
+    )
+
+
+def redirect_log_to_dir(log_dir: str):
+    return logging_manager.redirect_to_dir(log_dir)
+
+
+def get_file_log_context() -> TaskLogContext | None:
+    return logging_manager.get_file_context()
+
+
+def set_log_level(level: int | str) -> None:
+    logging_manager.set_level(level)
+
+
 def switch_log_to_file() -> None:
     logging_manager.switch_to_file()
 
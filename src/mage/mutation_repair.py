@@ -0,0 +1,394 @@
+import contextvars
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
+
+from .log_utils import get_logger
+from .sim_reviewer import SimReviewer, check_syntax_batch
+from .span_trace import span
+
+logger = get_logger(__name__)
+
+# (description, mutated code)
+Mutation = Tuple[str, str]
+
+TOKEN_RE = re.compile(
+    r"(?P<skip>//[^\n]*|/\*.*?\*/|\"(?:\\.|[^\"\\\n])*\"|^[ \t]*`[^\n]*|`\w+)"
+    r"|(?P<num>(?:\d+\s*)?'[sS]?[bBoOdDhH]\s*[0-9a-fA-F_xXzZ?]+|\d[\d_]*)"
+    r"|(?P<ident>[A-Za-z_$][\w$]*)"
+    r"|(?P<op>===|!==|==|!=|<=|>=|&&|\|\||<<|>>|[-+*/%<>=!~&|^?:;()\[\]{},.#@'])"
+    r"|(?P<ws>\s+)",
+    re.MULTILINE | re.DOTALL,
+)
+
+# Operators swapped inside expressions (parenthesized), e.g. conditions
+EXPR_OP_SWAPS: Dict[str, List[str]] = {
+    "==": ["!="],
+    "!=": ["=="],
+    "===": ["!=="],
+    "!==": ["==="],
+    "<": ["<="],
+    "<=": ["<"],
+    ">": [">="],
+    ">=": [">"],
+}
+# Binary operators swapped anywhere
+BINARY_OP_SWAPS: Dict[str, List[str]] = {
+    "&&": ["||"],
+    "||": ["&&"],
+    "&": ["|"],
+    "|": ["&"],
+    "+": ["-"],
+    "-": ["+"],
+}
+EDGE_SWAPS = {"posedge": "negedge", "negedge": "posedge"}
+# Statements whose "=" is not a procedural assignment
+DECL_KEYWORDS = {"assign", "localparam", "parameter", "genvar", "integer", "wire"}
+# Statements declaring signals, whose [...] ranges are widths, not logic
+SIGNAL_DECL_KEYWORDS = {
+    "input",
+    "output",
+    "inout",
+    "wire",
+    "reg",
+    "logic",
+    "integer",
+    "genvar",
+}
+# Statements whose values are encodings, e.g. of FSM states
+PARAM_KEYWORDS = {"localparam", "parameter"}
+
+
+class Token:
+    __slots__ = ("kind", "text", "start", "end", "depth")
+
+    def __init__(self, kind: str, text: str, start: int, end: int, depth: int):
+        self.kind = kind
+        self.text = text
+        self.start = start
+        self.end = end
+        self.depth = depth
+
+
+def tokenize(code: str) -> List[Token]:
+    """Code tokens outside comments, strings and directives, with paren depth"""
+    tokens: List[Token] = []
+    depth = 0
+    for m in TOKEN_RE.finditer(code):
+        kind = m.lastgroup
+        if kind is None or kind in ("skip", "ws"):
+            continue
+        text = m.group()
+        if text == ")":
+            depth = max(depth - 1, 0)
+        tokens.append(Token(kind, text, m.start(), m.end(), depth))
+        if text == "(":
+            depth += 1
+    return tokens
+
+
+def mutate_number(text: str) -> List[str]:
+    """Off-by-one values, and single bit flips of short binary literals"""
+    m = re.fullmatch(r"(?:(\d+)\s*)?'([sS]?)([bBoOdDhH])\s*([0-9a-fA-F_]+)", text)
+    if m is None:
+        if not re.fullmatch(r"\d[\d_]*", text):
+            return []  # x / z / ? literals
+        value = int(text.replace("_", ""))
+        return [str(v) for v in (value - 1, value + 1) if v >= 0]
+    width, signed, base, digits = m.groups()
+    digits = digits.replace("_", "")
+    radix = {"b": 2, "o": 8, "d": 10, "h": 16}[base.lower()]
+    try:
+        value = int(digits, radix)
+    except ValueError:
+        return []
+    prefix = f"{width or ''}'{signed}{base}"
+    if radix == 2 and len(digits) <= 8:
+        return [
+            prefix + digits[:i] + ("1" if digits[i] == "0" else "0") + digits[i + 1 :]
+            for i in range(len(digits))
+        ]
+    max_value = 2 ** int(width) if width else None
+    fmt = {2: "b", 8: "o", 10: "d", 16: "x"}[radix]
+    return [
+        prefix + format(v, fmt).zfill(len(digits) if radix != 10 else 0)
+        for v in (value - 1, value + 1)
+        if v >= 0 and (max_value is None or v < max_value)
+    ]
+
+
+def get_param_groups(tokens: List[Token]) -> Tuple[List[List[str]], Set[int]]:
+    """
+    Names of each localparam / parameter statement, e.g. the states of an FSM,
+    and the indices of the tokens declaring them
+    """
+    groups: List[List[str]] = []
+    decl_indices: Set[int] = set()
+    for i, token in enumerate(tokens):
+        if token.text not in ("localparam", "parameter"):
+            continue
+        names = []
+        j = i + 1
+        while j < len(tokens) and tokens[j].text not in (";", ")"):
+            if (
+                tokens[j].kind == "ident"
+                and j + 1 < len(tokens)
+                and tokens[j + 1].text == "="
+            ):
+                names.append(tokens[j].text)
+                decl_indices.add(j)
+            j += 1
+        if len(names) > 1:
+            groups.append(names)
+    return groups, decl_indices
+
+
+def generate_mutations(rtl_code: str) -> List[Mutation]:
+    """
+    Single-token mutations of rtl_code covering common small mistakes:
+    wrong edge, inverted condition, blocking vs nonblocking assignment,
+    off-by-one comparison, swapped logic / arithmetic operator,
+    off-by-one constant and swapped parameter (e.g. state transition).
+    Widths of declarations and parameter values are kept, as changing them
+    resizes signals or gives two states the same encoding.
+    Mutants that don't change the code or repeat an earlier one are dropped.
+    """
+    tokens = tokenize(rtl_code)
+    lineno = [0] * (len(rtl_code) + 1)
+    line = 1
+    for i, c in enumerate(rtl_code):
+        lineno[i] = line
+        if c == "\n":
+            line += 1
+    lineno[len(rtl_code)] = line
+
+    # Ordered by how often such a mutation fixes a near miss
+    edges: List[Mutation] = []
+    conditions: List[Mutation] = []
+    assignments: List[Mutation] = []
+    comparisons: List[Mutation] = []
+    operators: List[Mutation] = []
+    constants: List[Mutation] = []
+    params: List[Mutation] = []
+
+    def replace(token: Token, new_text: str) -> Mutation:
+        return (
+            f"line {lineno[token.start]}: {token.text} -> {new_text}",
+            rtl_code[: token.start] + new_text + rtl_code[token.end :],
+        )
+
+    param_groups, decl_indices = get_param_groups(tokens)
+    in_header = False
+    in_decl = False
+    # Keyword starting the current statement, if it declares signals / params
+    decl_keyword: str | None = None
+    is_stmt_start = True
+    bracket_depth = 0
+    for i, token in enumerate(tokens):
+        prev = tokens[i - 1] if i > 0 else None
+        if is_stmt_start and (
+            token.text in SIGNAL_DECL_KEYWORDS or token.text in PARAM_KEYWORDS
+        ):
+            decl_keyword = token.text
+        is_stmt_start = token.text in (";", "begin", "end") or (
+            token.text == ")" and token.depth == 0
+        )
+        if token.text == "[":
+            bracket_depth += 1
+        elif token.text == "]":
+            bracket_depth = max(bracket_depth - 1, 0)
+        if token.text == "module":
+            in_header = True
+        elif token.text in DECL_KEYWORDS:
+            in_decl = True
+        elif token.text == ";":
+            in_header = in_decl = False
+            decl_keyword = None
+        if in_header:
+            continue
+        if token.text in EDGE_SWAPS:
+            edges.append(replace(token, EDGE_SWAPS[token.text]))
+        elif token.text == "if" and i + 1 < len(tokens) and tokens[i + 1].text == "(":
+            close = next(
+                (
+                    t
+                    for t in tokens[i + 2 :]
+                    if t.text == ")" and t.depth == tokens[i + 1].depth
+                ),
+                None,
+            )
+            if close is not None:
+                cond_start, cond_end = tokens[i + 1].end, close.start
+                conditions.append(
+                    (
+                        f"line {lineno[token.start]}: invert if condition",
+                        rtl_code[:cond_start]
+                        + "!("
+                        + rtl_code[cond_start:cond_end]
+                        + ")"
+                        + rtl_code[cond_end:],
+                    )
+                )
+        elif (
+            token.kind == "op"
+            and token.depth == 0
+            and token.text in ("=", "<=")
+            and not in_decl
+        ):
+            assignments.append(replace(token, "<=" if token.text == "=" else "="))
+        elif token.kind == "op" and token.depth > 0 and token.text in EXPR_OP_SWAPS:
+            comparisons.extend(replace(token, op) for op in EXPR_OP_SWAPS[token.text])
+        elif token.kind == "op" and token.text in BINARY_OP_SWAPS:
+            # Unary reduction / sign, or a +: / -: part select
+            is_binary = prev is not None and (
+                prev.kind in ("ident", "num") or prev.text in (")", "]", "}")
+            )
+            next_text = tokens[i + 1].text if i + 1 < len(tokens) else ""
+            if is_binary and next_text != ":":
+                operators.extend(
+                    replace(token, op) for op in BINARY_OP_SWAPS[token.text]
+                )
+        elif token.text == "!" and token.kind == "op":
+            operators.append(
+                (
+                    f"line {lineno[token.start]}: drop !",
+                    rtl_code[: token.start] + rtl_code[token.end :],
+                )
+            )
+        elif token.kind == "num":
+            if prev is not None and prev.text == "#":
+                continue  # Delay
+            if decl_keyword in PARAM_KEYWORDS or (
+                decl_keyword in SIGNAL_DECL_KEYWORDS and bracket_depth > 0
+            ):
+                continue
+            constants.extend(replace(token, num) for num in mutate_number(token.text))
+        elif token.kind == "ident" and i not in decl_indices:
+            for group in param_groups:
+                if token.text in group:
+                    params.extend(
+                        replace(token, name) for name in group if name != token.text
+                    )
+
+    mutations: List[Mutation] = []
+    seen = {rtl_code}
+    for mutation in (
+        edges + conditions + assignments + comparisons + operators + constants + params
+    ):
+        if mutation[1] not in seen:
+            seen.add(mutation[1])
+            mutations.append(mutation)
+    return mutations
+
+
+class MutationRepair:
+    """
+    LLM-free local search before the editor: hill-climb the mismatch count of a
+    candidate over its single-token mutations, simulated in parallel.
+    """
+
+    def __init__(self, sim_reviewer: SimReviewer):
+        self.sim_reviewer = sim_reviewer
+        self.max_rounds = 3
+        self.max_mutants = 128
+        # Guard against overfitting the generated testbench: if more single
+        # token variants than this pass it, it cannot tell them apart and
+        # none is trusted as the fix
+        self.max_passing_mutants = 2
+        self.max_workers = os.cpu_count() or 4
+
+    def set_max_rounds(self, max_rounds: int) -> None:
+        self.max_rounds = max_rounds
+
+    def set_max_passing_mutants(self, max_passing_mutants: int) -> None:
+        self.max_passing_mutants = max_passing_mutants
+
+    def evaluate(
+        self, output_dir_per_run: str, mutations: List[Mutation]
+    ) -> List[Tuple[bool, int, str] | None]:
+        """Sim result of every mutant, None if it fails the syntax check"""
+        workspaces = [
+            os.path.join(output_dir_per_run, "mutation", str(i))
+            for i in range(len(mutations))
+        ]
+        for workspace, (_, rtl_code) in zip(workspaces, mutations):
+            os.makedirs(workspace, exist_ok=True)
+            shutil.copyfile(
+                os.path.join(output_dir_per_run, "tb.sv"),
+                os.path.join(workspace, "tb.sv"),
+            )
+            with open(os.path.join(workspace, "rtl.sv"), "w") as f:
+                f.write(rtl_code)
+        syntax_results = check_syntax_batch(
+            [os.path.join(workspace, "rtl.sv") for workspace in workspaces],
+            self.max_workers,
+        )
+        results: List[Tuple[bool, int, str] | None] = [None] * len(mutations)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                i: executor.submit(
+                    contextvars.copy_context().run,
+                    self.sim_reviewer.for_dir(workspaces[i]).review,
+                )
+                for i, (is_syntax_pass, _) in enumerate(syntax_results)
+                if is_syntax_pass
+            }
+            for i, future in futures.items():
+                results[i] = future.result()
+        return results
+
+    def run(
+        self,
+        output_dir_per_run: str,
+        rtl_code: str,
+        sim_mismatch_cnt: int,
+        sim_log: str,
+    ) -> Tuple[bool, str, int, str]:
+        """
+        Return (is_sim_pass, rtl_code, sim_mismatch_cnt, sim_log) of the best
+        code found, which is the input if no mutant lowers the mismatch count.
+        Passing mutants are ignored if more than max_passing_mutants pass.
+        """
+        for i in range(self.max_rounds):
+            mutations = generate_mutations(rtl_code)[: self.max_mutants]
+            if not mutations:
+                break
+            with span("mutation_round", mutants=len(mutations)):
+                results = self.evaluate(output_dir_per_run, mutations)
+            # Same acceptance rule as the editor: mismatch 0 only counts with a pass
+            improved = [
+                (result[1], j)
+                for j, result in enumerate(results)
+                if result is not None
+                and (result[0] or 0 < result[1] < sim_mismatch_cnt)
+            ]
+            passing_cnt = sum(r is not None and r[0] for r in results)
+            logger.info(
+                f"Mutation repair: round {i + 1} / {self.max_rounds}, "
+                f"{len(mutations)} mutants, "
+                f"{sum(r is not None for r in results)} syntax pass, "
+                f"{passing_cnt} sim pass, "
+                f"{len(improved)} improved on mismatch_cnt {sim_mismatch_cnt}"
+            )
+            if passing_cnt > self.max_passing_mutants:
+                logger.info(
+                    f"Mutation repair: {passing_cnt} mutants pass the testbench, "
+                    f"more than {self.max_passing_mutants}, none is accepted"
+                )
+                break
+            if not improved:
+                break
+            _, best = min(improved)
+            result = results[best]
+            assert result is not None
+            is_sim_pass, sim_mismatch_cnt, sim_log = result
+            description, rtl_code = mutations[best]
+            logger.info(
+                f"Mutation repair: accepted {description}, "
+                f"mismatch_cnt {sim_mismatch_cnt}"
+            )
+            if is_sim_pass:
+                return True, rtl_code, sim_mismatch_cnt, sim_log
+        return False, rtl_code, sim_mismatch_cnt, sim_log
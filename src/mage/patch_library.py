@@ -0,0 +1,333 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+from pydantic import BaseModel
+
+from .bash_tools import CommandResult
+from .log_utils import get_logger
+from .mutation_repair import Token, tokenize
+
+logger = get_logger(__name__)
+
+# Library shared by the runs of a user
+PATCH_LIBRARY_PATH = os.path.expanduser(
+    os.environ.get("MAGE_PATCH_LIBRARY", "~/.cache/mage/patch_library.sqlite")
+)
+
+# Kept literal in patterns, like system names ($signed, ...); other identifiers
+# are abstracted to $0, $1, ...
+VERILOG_KEYWORDS = {
+    "always",
+    "always_comb",
+    "always_ff",
+    "assign",
+    "begin",
+    "case",
+    "casez",
+    "default",
+    "else",
+    "end",
+    "endcase",
+    "for",
+    "if",
+    "initial",
+    "input",
+    "integer",
+    "localparam",
+    "logic",
+    "negedge",
+    "output",
+    "parameter",
+    "posedge",
+    "reg",
+    "signed",
+    "wire",
+}
+PLACEHOLDER_RE = re.compile(r"\$\d+")
+# Shorter old_content patterns match almost anywhere
+MIN_PATTERN_TOKENS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patches (
+    pattern_key TEXT PRIMARY KEY,
+    old_pattern TEXT NOT NULL,
+    anchor TEXT NOT NULL DEFAULT '',
+    old_content TEXT NOT NULL,
+    new_content TEXT NOT NULL,
+    mined_cnt INTEGER NOT NULL DEFAULT 1,
+    tried_cnt INTEGER NOT NULL DEFAULT 0,
+    helped_cnt INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS patches_anchor ON patches (anchor);
+CREATE TABLE IF NOT EXISTS patch_signatures (
+    pattern_key TEXT NOT NULL,
+    signature TEXT NOT NULL,
+    PRIMARY KEY (pattern_key, signature)
+);
+"""
+
+
+class PatchMatch(BaseModel):
+    """A library patch instantiated for a given RTL"""
+
+    pattern_key: str
+    old_content: str
+    new_content: str
+
+
+def is_abstracted(kind: str, text: str) -> bool:
+    return kind == "ident" and text not in VERILOG_KEYWORDS and text[0] != "$"
+
+
+def abstract_code(code: str, names: Dict[str, str] | None = None) -> List[str]:
+    """
+    Tokens of code with identifiers renamed to $0, $1, ... by first appearance.
+    names maps identifiers to placeholders, shared across calls and extended.
+    """
+    names = {} if names is None else names
+    pattern = []
+    for token in tokenize(code):
+        if is_abstracted(token.kind, token.text):
+            if token.text not in names:
+                names[token.text] = f"${len(names)}"
+            pattern.append(names[token.text])
+        else:
+            pattern.append(token.text)
+    return pattern
+
+
+def get_anchor(pattern: List[str]) -> str:
+    """
+    Longest literal token of a pattern, the most selective one that code must
+    contain for the pattern to match. Empty if all tokens are placeholders.
+    """
+    return max(
+        (p for p in pattern if not PLACEHOLDER_RE.fullmatch(p)), key=len, default=""
+    )
+
+
+def get_sim_log_signature(sim_log: str) -> str:
+    """Shape of the mismatch report of a sim log, without values and times"""
+    try:
+        stdout = CommandResult.model_validate_json(sim_log).stdout
+    except ValueError:
+        stdout = sim_log
+    shapes = sorted(
+        {
+            re.sub(r"'[bBoOdDhH][0-9a-fA-FxXzZ_]+|\d+", "#", line).strip()
+            for line in stdout.splitlines()
+            if "mismatch" in line.lower()
+        }
+    )[:5]
+    return hashlib.sha256("\n".join(shapes).encode()).hexdigest()[:16]
+
+
+def rename_identifiers(code: str, renames: Dict[str, str]) -> str:
+    return re.sub(
+        r"[A-Za-z_$][\w$]*", lambda m: renames.get(m.group(), m.group()), code
+    )
+
+
+def match_pattern(
+    rtl_code: str, tokens: List[Token], old_pattern: List[str]
+) -> List[Tuple[str, Dict[str, str]]]:
+    """
+    Places in rtl_code, given as its tokens too, matching old_pattern with a
+    consistent renaming.
+    Return the concrete old content and the {placeholder: identifier} map of each.
+    """
+    n = len(old_pattern)
+    matches = []
+    for k in range(len(tokens) - n + 1):
+        bindings: Dict[str, str] = {}
+        bound: set[str] = set()
+        for p, token in zip(old_pattern, tokens[k : k + n]):
+            if PLACEHOLDER_RE.fullmatch(p):
+                if not is_abstracted(token.kind, token.text):
+                    break
+                if p in bindings:
+                    if bindings[p] != token.text:
+                        break
+                elif token.text in bound:
+                    break
+                else:
+                    bindings[p] = token.text
+                    bound.add(token.text)
+            elif p != token.text:
+                break
+        else:
+            start, end = tokens[k].start, tokens[k + n - 1].end
+            matches.append((rtl_code[start:end], bindings))
+    return matches
+
+
+class PatchLibrary:
+    """
+    Edits that lowered the sim mismatch count, mined from editor sessions and
+    kept across runs in SQLite. Patches are keyed by their identifier-abstracted
+    old / new content, so a fix found in one task applies to the same shape of
+    code in another. Patches tried often without ever helping are evicted.
+    """
+
+    def __init__(self, path: str):
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.max_patches = 5000
+        self.max_tried_without_help = 5
+        # Patches matched against the code per find, after the anchor filter
+        self.max_find_rows = 500
+        with self.connect() as conn:
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(patches)")}
+            if columns and "anchor" not in columns:
+                self.add_anchor_column(conn)
+            conn.executescript(SCHEMA)
+        self.evict()
+
+    @staticmethod
+    def add_anchor_column(conn: sqlite3.Connection) -> None:
+        """Migrate a library written before patches had anchors"""
+        conn.execute("ALTER TABLE patches ADD COLUMN anchor TEXT NOT NULL DEFAULT ''")
+        conn.executemany(
+            "UPDATE patches SET anchor = ? WHERE pattern_key = ?",
+            [
+                (get_anchor(json.loads(old_pattern)), pattern_key)
+                for pattern_key, old_pattern in conn.execute(
+                    "SELECT pattern_key, old_pattern FROM patches"
+                )
+            ],
+        )
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        with self.lock:
+            # Runs of other processes may write at the same time
+            conn = sqlite3.connect(self.path, timeout=60)
+            try:
+                with conn:
+                    yield conn
+            finally:
+                conn.close()
+
+    def add(self, old_content: str, new_content: str, sim_log: str) -> None:
+        names: Dict[str, str] = {}
+        old_pattern = abstract_code(old_content, names)
+        if len(old_pattern) < MIN_PATTERN_TOKENS:
+            return
+        new_pattern = abstract_code(new_content, names)
+        if old_pattern == new_pattern:
+            return
+        old_pattern_str = json.dumps(old_pattern)
+        pattern_key = hashlib.sha256(
+            f"{old_pattern_str}\0{json.dumps(new_pattern)}".encode()
+        ).hexdigest()[:32]
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT INTO patches (pattern_key, old_pattern, anchor, old_content, "
+                "new_content, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(pattern_key) DO UPDATE SET "
+                "mined_cnt = mined_cnt + 1, last_used = excluded.last_used",
+                (
+                    pattern_key,
+                    old_pattern_str,
+                    get_anchor(old_pattern),
+                    old_content,
+                    new_content,
+                    now,
+                    now,
+                ),
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO patch_signatures VALUES (?, ?)",
+                (pattern_key, get_sim_log_signature(sim_log)),
+            )
+        logger.info(f"Patch library: mined {pattern_key}: {' '.join(old_pattern)}")
+
+    def find(self, rtl_code: str, sim_log: str, limit: int) -> List[PatchMatch]:
+        """
+        Patches applicable to rtl_code, those seen with the same sim log signature
+        first, then by success rate. Only patches whose anchor token occurs in
+        rtl_code are matched, at most max_find_rows of them.
+        """
+        tokens = tokenize(rtl_code)
+        token_texts = sorted(
+            {t.text for t in tokens if not is_abstracted(t.kind, t.text)}
+        )
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT p.pattern_key, p.old_pattern, p.old_content, p.new_content "
+                "FROM patches p LEFT JOIN patch_signatures s "
+                "ON s.pattern_key = p.pattern_key AND s.signature = ? "
+                "WHERE p.anchor = '' OR p.anchor IN (SELECT value FROM json_each(?)) "
+                "ORDER BY s.signature IS NULL, "
+                "(p.helped_cnt + 1.0) / (p.tried_cnt + 2.0) DESC, p.mined_cnt DESC "
+                "LIMIT ?",
+                (
+                    get_sim_log_signature(sim_log),
+                    json.dumps(token_texts),
+                    self.max_find_rows,
+                ),
+            ).fetchall()
+        matches: List[PatchMatch] = []
+        for pattern_key, old_pattern, old_content, new_content in rows:
+            names: Dict[str, str] = {}
+            abstract_code(old_content, names)
+            for concrete_old, bindings in match_pattern(
+                rtl_code, tokens, json.loads(old_pattern)
+            ):
+                matches.append(
+                    PatchMatch(
+                        pattern_key=pattern_key,
+                        old_content=concrete_old,
+                        new_content=rename_identifiers(
+                            new_content,
+                            {name: bindings[p] for name, p in names.items()},
+                        ),
+                    )
+                )
+                break  # One place per patch
+            if len(matches) >= limit:
+                break
+        return matches
+
+    def record_tries(self, tried_keys: List[str], helped_keys: List[str]) -> None:
+        now = time.time()
+        with self.connect() as conn:
+            conn.executemany(
+                "UPDATE patches SET tried_cnt = tried_cnt + 1, last_used = ? "
+                "WHERE pattern_key = ?",
+                [(now, key) for key in tried_keys],
+            )
+            conn.executemany(
+                "UPDATE patches SET helped_cnt = helped_cnt + 1 WHERE pattern_key = ?",
+                [(key,) for key in helped_keys],
+            )
+
+    def evict(self) -> None:
+        """Drop patches that never help, then the least useful past max_patches"""
+        with self.connect() as conn:
+            conn.execute(
+                "DELETE FROM patches WHERE helped_cnt = 0 AND tried_cnt >= ?",
+                (self.max_tried_without_help,),
+            )
+            conn.execute(
+                "DELETE FROM patches WHERE pattern_key IN ("
+                "SELECT pattern_key FROM patches "
+                "ORDER BY helped_cnt DESC, last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_patches,),
+            )
+            conn.execute(
+                "DELETE FROM patch_signatures WHERE pattern_key NOT IN "
+                "(SELECT pattern_key FROM patches)"
+            )
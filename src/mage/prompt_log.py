@@ -0,0 +1,155 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Sequence
+from weakref import WeakKeyDictionary
+
+from llama_index.core.base.llms.types import ChatMessage
+
+from .log_utils import TaskLogContext, get_file_log_context
+
+BLOB_FILE_NAME = "prompt_blobs.jsonl"
+CALL_FILE_NAME = "prompt_calls.jsonl"
+
+
+def message_to_blob(message: ChatMessage) -> Dict[str, Any]:
+    return {
+        "role": message.role.value,
+        "content": message.content,
+        "additional_kwargs": message.additional_kwargs,
+    }
+
+
+def hash_blob(blob: Dict[str, Any]) -> str:
+    return hashlib.sha256(
+        json.dumps(blob, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class PromptBlobStore:
+    """
+    Per-task store of chat messages keyed by content hash.
+    Every message body is written once to prompt_blobs.jsonl;
+    every LLM call is a list of hashes in prompt_calls.jsonl.
+    """
+
+    def __init__(self, log_dir: str):
+        self.blob_path = os.path.join(log_dir, BLOB_FILE_NAME)
+        self.call_path = os.path.join(log_dir, CALL_FILE_NAME)
+        # A task log dir starts fresh, same as its log files
+        for path in (self.blob_path, self.call_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.hashes: set[str] = set()
+        self.last_call: Dict[str, tuple[int, List[str]]] = {}
+        self.call_cnt = 0
+        self.lock = threading.Lock()
+
+    def add_call(self, tag: str, messages: Sequence[ChatMessage]) -> str:
+        """Store the messages of a call, return its summary for the log line"""
+        blobs = [message_to_blob(message) for message in messages]
+        hashes = [hash_blob(blob) for blob in blobs]
+        with self.lock:
+            self.call_cnt += 1
+            call_id = self.call_cnt
+            new_blobs = [
+                (h, blob) for h, blob in zip(hashes, blobs) if h not in self.hashes
+            ]
+            with open(self.blob_path, "a") as f:
+                for h, blob in new_blobs:
+                    f.write(json.dumps({"hash": h, **blob}, default=str) + "\n")
+                    self.hashes.add(h)
+            with open(self.call_path, "a") as f:
+                f.write(
+                    json.dumps({"call": call_id, "tag": tag, "hashes": hashes}) + "\n"
+                )
+            prev = self.last_call.get(tag)
+            self.last_call[tag] = (call_id, hashes)
+        shared = 0
+        if prev:
+            for prev_h, h in zip(prev[1], hashes):
+                if prev_h != h:
+                    break
+                shared += 1
+        delta = " ".join(h[:12] for h in hashes[shared:])
+        base = f"first {shared} of call {prev[0]} + " if prev else ""
+        return (
+            f"call {call_id}, {len(hashes)} messages, {len(new_blobs)} new: "
+            f"{base}[{delta}]"
+        )
+
+
+prompt_blob_stores: "WeakKeyDictionary[TaskLogContext, PromptBlobStore]" = (
+    WeakKeyDictionary()
+)
+prompt_blob_stores_lock = threading.Lock()
+
+
+def log_prompt_messages(
+    logger: logging.Logger, tag: str, messages: Sequence[ChatMessage]
+) -> None:
+    """
+    Log the input messages of an LLM call at DEBUG.
+    When logging to files, message bodies go to the task's blob store once and
+    the log line only lists hashes; rebuild with `python -m mage.prompt_log`.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    ctx = get_file_log_context()
+    if ctx is None:
+        logger.debug("%s: %s", tag, list(messages))
+        return
+    with prompt_blob_stores_lock:
+        if ctx not in prompt_blob_stores:
+            prompt_blob_stores[ctx] = PromptBlobStore(ctx.log_dir)
+        store = prompt_blob_stores[ctx]
+    logger.debug("%s: %s", tag, store.add_call(tag, messages))
+
+
+def load_conversations(log_dir: str) -> List[Dict[str, Any]]:
+    """Rebuild the full input messages of every logged call in log_dir"""
+    blobs: Dict[str, Dict[str, Any]] = {}
+    with open(os.path.join(log_dir, BLOB_FILE_NAME), "r") as f:
+        for line in f:
+            blob = json.loads(line)
+            blobs[blob.pop("hash")] = blob
+    calls = []
+    with open(os.path.join(log_dir, CALL_FILE_NAME), "r") as f:
+        for line in f:
+            call = json.loads(line)
+            call["messages"] = [blobs[h] for h in call.pop("hashes")]
+            calls.append(call)
+    return calls
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Print LLM input messages rebuilt from a task log dir"
+    )
+    parser.add_argument("log_dir", help="Task log dir, e.g. log/<benchmark>_<task>")
+    parser.add_argument("--call", type=int, help="Only print this call id")
+    parser.add_argument("--tag", help="Only print calls with this tag")
+    parser.add_argument("--json", action="store_true", help="Print as JSON")
+    args = parser.parse_args()
+
+    calls = [
+        call
+        for call in load_conversations(args.log_dir)
+        if (args.call is None or call["call"] == args.call)
+        and (args.tag is None or call["tag"] == args.tag)
+    ]
+    if args.json:
+        print(json.dumps(calls, indent=4))
+        return
+    for call in calls:
+        print(f"===== call {call['call']}: {call['tag']} =====")
+        for message in call["messages"]:
+            print(f"----- {message['role']} -----")
+            print(message["content"])
+
+
+if __name__ == "__main__":
+    main()
@@ -128,3 +128,15 @@ Generate ONLY the required JSON object. Be concise and direct.
 IMPORTANT: The "module" field must contain ONLY the complete Verilog code, starting with "module TopModule" and ending with "endmodule". Do NOT include descriptions, explanations, or comments about the code in the "module" field.
 DO NOT include any other information in your response, like 'json', 'reasoning' or '<output_format>'.
 """
+
+PATCH_ORDER_PROMPT = r"""
+Fix the error above by patching the line-numbered code, instead of writing it again.
+Generate ONLY the required JSON object. Be concise and direct.
+<output_format>
+{output_format}
+</output_format>
+Each patch replaces the lines from "start_line" to "end_line" (1-based, inclusive, as numbered above) with "content", which has no line numbers.
+Use an empty "content" to delete lines, or "end_line" = "start_line" - 1 to insert "content" before "start_line".
+Patches must not overlap. Keep them as small as possible.
+DO NOT include any other information in your response, like 'json', 'reasoning' or '<output_format>'.
+"""
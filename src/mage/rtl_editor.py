@@ -1,13 +1,23 @@
+import contextvars
+import difflib
 import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from inspect import signature
 from typing import Any, Dict, List, Tuple
 
 from llama_index.core.base.llms.types import ChatMessage, ChatResponse, MessageRole
 from pydantic import BaseModel
 
+from .editor_history import EditorHistory
 from .log_utils import get_logger
+from .patch_library import PatchLibrary
+from .prompt_log import log_prompt_messages
 from .prompts import ORDER_PROMPT
 from .sim_reviewer import SimReviewer, check_syntax
+from .span_trace import span
 from .token_counter import TokenCounter, TokenCounterCached
 
 logger = get_logger(__name__)
@@ -69,10 +79,8 @@ EXTRA_ORDER_PROMPT = r"""
 10. In sequence logic, if the expected output is asserted but the dut output is not,
     carefully examine whether the input signal should affect current output (with comb logic) or next-cycle output (with seq logic).
 
-The file content which is going to be edited is given below:
-<rtl_code>
-{rtl_code}
-</rtl_code>
+The file content which is going to be edited is the latest rtl_code given above,
+with the rtl_diff of each later action output applied.
 """
 # The prompt above comes from:
 # @misc{ho2024verilogcoderautonomousverilogcoding,
@@ -85,6 +93,20 @@ The file content which is going to be edited is given below:
 #       url={https://arxiv.org/abs/2408.08927},
 # }
 
+RTL_CODE_PROMPT = r"""
+The file content which is going to be edited is given below:
+<rtl_code>
+{rtl_code}
+</rtl_code>
+"""
+
+RTL_STATE_PROMPT = r"""
+The rtl_code before the rounds below:
+<rtl_code>
+{rtl_code}
+</rtl_code>
+"""
+
 ACTION_OUTPUT_PROMPT = r"""
 Output after running given action:
 <action_output>
@@ -92,6 +114,18 @@ Output after running given action:
 </action_output>
 """
 
+RTL_DIFF_PROMPT = r"""
+The action changed the rtl_code as below:
+<rtl_diff>
+{rtl_diff}
+</rtl_diff>
+"""
+
+SPECULATIVE_HINT_PROMPT = r"""
+Other alternatives of this action are tried in parallel. This is alternative {index}:
+propose a different plausible fix than the most obvious one.
+"""
+
 EXAMPLE_OUTPUT = {
     "reasoning": "Brief one-sentence reasoning",
     "action_input": {
@@ -103,6 +137,25 @@ EXAMPLE_OUTPUT = {
     },
 }
 
+MULTI_EXAMPLE_OUTPUT = {
+    "reasoning": "Brief one-sentence reasoning",
+    "action_input": {
+        "command": "replace_contents_by_matching",
+        "args": {
+            "replacements": [
+                {
+                    "old_content": "first content to be replaced",
+                    "new_content": "content to replace it",
+                },
+                {
+                    "old_content": "second content to be replaced",
+                    "new_content": "content to replace it",
+                },
+            ],
+        },
+    },
+}
+
 
 class ActionInput(BaseModel):
     command: str
@@ -123,17 +176,50 @@ class RTLEditor:
         self.token_counter = token_counter
         self.history: List[ChatMessage] = []
         self.max_trials = 15
-        self.succeed_history_max_length = 10
-        self.fail_history_max_length = 6
+        # Tokens of full rounds kept in the prompt, older rounds are summarized
+        self.history_token_budget = 6000
         self.is_done = False
         self.last_mismatch_cnt: int | None = None
         self.sim_reviewer = sim_reviewer
+        # Alternative actions sampled per round and simulated in parallel,
+        # 1 for strictly sequential rounds
+        self.speculative_cnt = 1
+        # Learned patches tried before the first LLM round, None to disable
+        self.patch_library: PatchLibrary | None = None
+        self.max_library_patches = 8
 
     def reset(self):
         self.is_done = False
         self.history = []
         self.last_mismatch_cnt: int | None = None
 
+    def set_speculative_cnt(self, speculative_cnt: int) -> None:
+        self.speculative_cnt = speculative_cnt
+
+    def set_patch_library(self, patch_library: PatchLibrary | None) -> None:
+        self.patch_library = patch_library
+
+    def spawn(self, sim_reviewer: SimReviewer) -> "RTLEditor":
+        """New editor with the same settings, e.g. for another workspace"""
+        editor = RTLEditor(self.token_counter, sim_reviewer)
+        editor.max_trials = self.max_trials
+        editor.history_token_budget = self.history_token_budget
+        editor.speculative_cnt = self.speculative_cnt
+        editor.patch_library = self.patch_library
+        editor.max_library_patches = self.max_library_patches
+        return editor
+
+    def fork(self, workspace_dir: str) -> "RTLEditor":
+        """Editor acting on a copy of the current tb and rtl in workspace_dir"""
+        os.makedirs(workspace_dir, exist_ok=True)
+        editor = self.spawn(self.sim_reviewer.for_dir(workspace_dir))
+        editor.tb_path = os.path.join(workspace_dir, "tb.sv")
+        editor.rtl_path = os.path.join(workspace_dir, "rtl.sv")
+        shutil.copyfile(self.tb_path, editor.tb_path)
+        shutil.copyfile(self.rtl_path, editor.rtl_path)
+        editor.last_mismatch_cnt = self.last_mismatch_cnt
+        return editor
+
     def write_rtl(self, content: str) -> None:
         with open(self.rtl_path, "w") as f:
             f.write(content)
@@ -292,13 +378,115 @@ class RTLEditor:
         # ret["new_file_content"] = new_file_content
         return ret
 
+    def replace_contents_by_matching(
+        self, replacements: List[Dict[str, str]]
+    ) -> Dict[str, Any]:
+        """
+        Apply several replacements in order, then run one syntax check and one simulation.
+        Use it instead of replace_content_by_matching when a fix touches several places.
+        Each replacement works like replace_content_by_matching on the result of the previous ones:
+        its old_content must occur exactly once at that point.
+        The replacements are atomic: if any of them fails, none is applied.
+        Input:
+            replacements: A list of {"old_content": ..., "new_content": ...}.
+        Output:
+            A dictionary containing :
+                1. Whether the action is executed.
+                2. The error message if the action is not executed.
+                3. The result of every replacement in hunk_results.
+                4. Other information like syntax check result and simulation check result.
+        Example:
+            Before:
+            <example_rtl>
+                1 module test;
+                2   reg a;
+                3   reg b;
+                4   reg c;
+                5 endmodule
+            </example_rtl>
+            Action:
+            <action_input>
+                "command": "replace_contents_by_matching",
+                "args": {
+                    "replacements": [
+                        {"old_content": "  reg a;", "new_content": "  wire a;"},
+                        {"old_content": "  reg c;", "new_content": "  wire c;"}
+                    ]
+                },
+            </action_input>
+            Now:
+            <example_rtl>
+                1 module test;
+                2   wire a;
+                3   reg b;
+                4   wire c;
+                5 endmodule
+            </example_rtl>
+        """
+        old_file_content = self.read_rtl().expandtabs(4)
+        new_file_content = old_file_content
+        hunk_results: List[Dict[str, Any]] = []
+        for i, replacement in enumerate(replacements):
+            old_content = replacement.get("old_content", "").expandtabs(4)
+            new_content = replacement.get("new_content", "").expandtabs(4)
+            logger.info("Replacement %d old content:\n%s", i + 1, old_content)
+            logger.info("Replacement %d new content:\n%s", i + 1, new_content)
+            occurrences = new_file_content.count(old_content) if old_content else 0
+            if occurrences == 1:
+                new_file_content = new_file_content.replace(old_content, new_content)
+                hunk_results.append({"index": i, "is_matched": True, "error_msg": ""})
+                continue
+            hunk_results.append(
+                {
+                    "index": i,
+                    "is_matched": False,
+                    "error_msg": (
+                        "Cannot find old_content in current RTL."
+                        if occurrences == 0
+                        else "Find multiple old_content in current RTL."
+                    ),
+                }
+            )
+        failed = [r["index"] for r in hunk_results if not r["is_matched"]]
+        if not replacements or failed:
+            return {
+                "is_action_executed": False,
+                "hunk_results": hunk_results,
+                "error_msg": (
+                    f"Replacements {failed} failed, none of the replacements applied. "
+                    "replace_contents_by_matching not executed."
+                    if replacements
+                    else "No replacements given. replace_contents_by_matching not executed."
+                ),
+            }
+
+        self.write_rtl(new_file_content)
+        ret = self.judge_replace_action_execution(
+            json.dumps([r.get("old_content", "") for r in replacements]),
+            json.dumps([r.get("new_content", "") for r in replacements]),
+            "replace_contents_by_matching",
+            old_file_content,
+        )
+        ret["hunk_results"] = hunk_results
+        return ret
+
     def generate(self, messages: List[ChatMessage]) -> ChatResponse:
-        logger.info(f"RTL editor input message: {messages}")
+        log_prompt_messages(logger, "RTL editor input message", messages)
         resp, token_cnt = self.token_counter.count_chat(messages)
-        logger.info(f"Token count: {token_cnt}")
-        logger.info(f"{resp.message.content}")
+        logger.info("Token count: %s", token_cnt)
+        logger.info("%s", resp.message.content)
         return resp
 
+    def batch_generate(
+        self, messages_list: List[List[ChatMessage]]
+    ) -> List[ChatResponse]:
+        log_prompt_messages(logger, "RTL editor input message", messages_list[0])
+        resp_token_cnt_list = self.token_counter.count_chat_batch(messages_list)
+        for i, (resp, token_cnt) in enumerate(resp_token_cnt_list):
+            logger.info("Alternative %d token count: %s", i + 1, token_cnt)
+            logger.info("%s", resp.message.content)
+        return [resp for resp, _ in resp_token_cnt_list]
+
     def gen_action_prompt(self, function) -> str:
         return ACTION_PROMPT.format(
             command=function.__name__,
@@ -307,7 +495,7 @@ class RTLEditor:
         )
 
     def get_init_prompt_messages(self) -> List[ChatMessage]:
-        actions = [self.replace_content_by_matching]
+        actions = [self.replace_content_by_matching, self.replace_contents_by_matching]
         actions_prompt = SYSTEM_PROMPT.format(
             actions="".join([self.gen_action_prompt(action) for action in actions])
         )
@@ -328,17 +516,24 @@ class RTLEditor:
             and self.token_counter.enable_cache
         ):
             self.token_counter.add_cache_tag(ret[-1])
+        # The full RTL is sent once, later rounds only add the diffs of their actions
+        ret.append(
+            ChatMessage(
+                content=RTL_CODE_PROMPT.format(rtl_code=self.read_rtl()),
+                role=MessageRole.USER,
+            )
+        )
         return ret
 
     def get_order_prompt_messages(self) -> List[ChatMessage]:
-        with open(self.rtl_path, "r") as f:
-            rtl_code = f.read()
         return [
             ChatMessage(
                 content=ORDER_PROMPT.format(
-                    output_format="".join(json.dumps(EXAMPLE_OUTPUT, indent=4))
+                    output_format=json.dumps(EXAMPLE_OUTPUT, indent=4)
+                    + "\nOr, for a fix touching several places:\n"
+                    + json.dumps(MULTI_EXAMPLE_OUTPUT, indent=4)
                 )
-                + EXTRA_ORDER_PROMPT.format(rtl_code=rtl_code),
+                + EXTRA_ORDER_PROMPT,
                 role=MessageRole.USER,
             ),
         ]
@@ -355,21 +550,212 @@ class RTLEditor:
         )
 
     def run_action(self, action_input: ActionInput) -> Dict[str, Any]:
-        logger.info(f"Action input: {action_input}")
+        logger.info("Action input: %s", action_input)
         action = getattr(self, action_input.command)
         action_output = action(**action_input.args)
-        logger.info(f"Action output: {action_output}")
+        logger.info("Action output: %s", action_output)
         return action_output
 
-    def get_action_output_message(self, output: Dict[str, Any]) -> List[ChatMessage]:
-        return [
-            ChatMessage(
-                content=ACTION_OUTPUT_PROMPT.format(
-                    action_output=json.dumps(output, indent=4)
-                ),
-                role=MessageRole.USER,
-            ),
+    def run_speculative_round(
+        self, messages: List[ChatMessage]
+    ) -> Tuple[ChatMessage, ActionInput, Dict[str, Any]]:
+        """
+        Sample speculative_cnt alternative actions in one batch and run the
+        distinct ones in parallel with run_actions_in_parallel. Alternatives after
+        the first are asked for a different fix, so they differ more than samples
+        of one prompt.
+        Return the chosen response message, its action input and output.
+        """
+        responses = self.batch_generate(
+            [messages]
+            + [
+                messages
+                + [
+                    ChatMessage(
+                        content=SPECULATIVE_HINT_PROMPT.format(index=i + 1),
+                        role=MessageRole.USER,
+                    )
+                ]
+                for i in range(1, self.speculative_cnt)
+            ]
+        )
+        alternatives: List[Tuple[ChatResponse, ActionInput]] = []
+        parse_error: Exception | None = None
+        seen_actions = set()
+        for i, response in enumerate(responses):
+            try:
+                action_input = self.parse_output(response).action_input
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Alternative {i + 1} is not a valid action: {e}")
+                parse_error = parse_error or e
+                continue
+            action_key = json.dumps(action_input.model_dump(), sort_keys=True)
+            if action_key in seen_actions:
+                logger.info(f"Alternative {i + 1} repeats an earlier action, skipped")
+                continue
+            seen_actions.add(action_key)
+            alternatives.append((response, action_input))
+        if not alternatives:
+            assert parse_error
+            raise parse_error
+
+        action_inputs = [action_input for _, action_input in alternatives]
+        best, outputs = self.run_actions_in_parallel(action_inputs, "speculative")
+        return alternatives[best][0].message, action_inputs[best], outputs[best]
+
+    def run_actions_in_parallel(
+        self, action_inputs: List[ActionInput], workspace_name: str
+    ) -> Tuple[int, List[Dict[str, Any]]]:
+        """
+        Run each action on its own copy of the RTL under workspace_name, in parallel.
+        Of the actions executed under the usual acceptance rules, the one with the
+        fewest mismatches is applied. Return its index and all action outputs.
+        """
+        editors = [
+            self.fork(os.path.join(self.output_dir_per_run, workspace_name, str(i)))
+            for i in range(len(action_inputs))
         ]
+        with ThreadPoolExecutor(max_workers=len(action_inputs)) as executor:
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run, editor.run_action, action_input
+                )
+                for editor, action_input in zip(editors, action_inputs)
+            ]
+            outputs = [future.result() for future in futures]
+
+        def rank(i: int) -> Tuple[bool, float, int]:
+            output = outputs[i]
+            mismatch_cnt = (
+                output["sim_mismatch_cnt"]
+                if output.get("is_syntax_pass")
+                else float("inf")
+            )
+            return (not output["is_action_executed"], mismatch_cnt, i)
+
+        best = min(range(len(action_inputs)), key=rank)
+        if outputs[best]["is_action_executed"]:
+            shutil.copyfile(editors[best].rtl_path, self.rtl_path)
+            self.last_mismatch_cnt = editors[best].last_mismatch_cnt
+            self.is_done = editors[best].is_done
+            logger.info(
+                f"Accepted {workspace_name} action {best + 1} / {len(action_inputs)}, "
+                f"mismatch_cnt {self.last_mismatch_cnt}"
+            )
+        else:
+            logger.info(
+                f"None of {len(action_inputs)} {workspace_name} actions executed"
+            )
+        return best, outputs
+
+    def apply_library_patches(self) -> None:
+        """Try matching patches of the library in parallel, keep the best one"""
+        assert self.patch_library
+        matches = self.patch_library.find(
+            self.read_rtl(), self.sim_failed_log, self.max_library_patches
+        )
+        logger.info(f"Patch library: {len(matches)} matching patches")
+        if not matches:
+            return
+        last_mismatch_cnt = self.last_mismatch_cnt
+        best, outputs = self.run_actions_in_parallel(
+            [
+                ActionInput(
+                    command="replace_content_by_matching",
+                    args={
+                        "old_content": match.old_content,
+                        "new_content": match.new_content,
+                    },
+                )
+                for match in matches
+            ],
+            "library",
+        )
+        self.patch_library.record_tries(
+            [match.pattern_key for match in matches],
+            [
+                match.pattern_key
+                for match, output in zip(matches, outputs)
+                if output["is_action_executed"]
+                and (
+                    last_mismatch_cnt is None
+                    or output["sim_mismatch_cnt"] < last_mismatch_cnt
+                )
+            ],
+        )
+        if outputs[best]["is_action_executed"] and not self.is_done:
+            # The editor starts from the patched RTL and its sim log
+            self.sim_failed_log = outputs[best]["error_msg"]
+
+    def mine_patches(self, action_input: ActionInput, sim_log: str) -> None:
+        """
+        Add the replacement of an action that lowered the mismatch count.
+        Library patches are applied one at a time, so the hunks of a multi-hunk
+        action are not added: each alone is not known to help.
+        """
+        assert self.patch_library
+        if action_input.command == "replace_content_by_matching":
+            replacements = [action_input.args]
+        elif action_input.command == "replace_contents_by_matching":
+            replacements = action_input.args.get("replacements", [])
+        else:
+            return
+        if len(replacements) != 1:
+            return
+        self.patch_library.add(
+            replacements[0].get("old_content", ""),
+            replacements[0].get("new_content", ""),
+            sim_log,
+        )
+
+    def get_rtl_diff(self, old_rtl_code: str, new_rtl_code: str) -> str:
+        return "\n".join(
+            difflib.unified_diff(
+                old_rtl_code.splitlines(),
+                new_rtl_code.splitlines(),
+                "rtl.sv",
+                "rtl.sv",
+                lineterm="",
+            )
+        )
+
+    def count_tokens(self, text: str) -> int:
+        # Rough estimate for models without a known tokenizer
+        return self.token_counter.count(text) or len(text) // 4
+
+    def summarize_round(
+        self,
+        round_idx: int,
+        message: ChatMessage,
+        action_input: ActionInput,
+        action_output: Dict[str, Any],
+    ) -> str:
+        """One-line record of a round for the history summary"""
+        try:
+            reasoning = json.loads(str(message.content), strict=False)["reasoning"]
+        except (ValueError, KeyError, TypeError):
+            reasoning = ""
+        if action_output["is_action_executed"]:
+            status = "executed"
+        elif action_output.get("is_syntax_pass") is False:
+            status = "not executed, syntax error"
+        elif "is_syntax_pass" in action_output:
+            status = "not executed, rejected by simulation"
+        else:
+            status = "not executed, old_content not matched"
+        if action_output.get("is_syntax_pass"):
+            status += f", mismatch_cnt {action_output['sim_mismatch_cnt']}"
+        return f"Round {round_idx}: {action_input.command} {status}. {reasoning}"
+
+    def get_action_output_message(
+        self, output: Dict[str, Any], rtl_diff: str = ""
+    ) -> List[ChatMessage]:
+        content = ACTION_OUTPUT_PROMPT.format(
+            action_output=json.dumps(output, indent=4)
+        )
+        if rtl_diff:
+            content += RTL_DIFF_PROMPT.format(rtl_diff=rtl_diff)
+        return [ChatMessage(content=content, role=MessageRole.USER)]
 
     def chat(
         self,
@@ -377,6 +763,7 @@ class RTLEditor:
         output_dir_per_run: str,
         sim_failed_log: str,
         sim_mismatch_cnt: int,
+        cancel_event: threading.Event | None = None,
     ) -> Tuple[bool, str]:
         # 1. Initialize the history
         # 2. Generate the initial prompt messages (with functool information)
@@ -385,6 +772,7 @@ class RTLEditor:
         #     - Generate & parse the response
         #     - Generate & parse the tool call
         #     - If called
+        # A set cancel_event stops the session before its next round
         if isinstance(self.token_counter, TokenCounterCached):
             self.token_counter.set_enable_cache(True)
         self.history = []
@@ -396,37 +784,71 @@ class RTLEditor:
         self.sim_failed_log = sim_failed_log
         self.last_mismatch_cnt = sim_mismatch_cnt
 
+        if self.patch_library is not None:
+            with span("library_patches"):
+                self.apply_library_patches()
+            if self.is_done:
+                return (True, self.read_rtl())
+
         self.history.extend(self.get_init_prompt_messages())
         is_pass = False
-        succeed_history: List[ChatMessage] = []
-        fail_history: List[ChatMessage] = []
+        # Sim log before the current round, the context of mined patches
+        sim_log = self.sim_failed_log
+        rtl_code = self.read_rtl()
+        editor_history = EditorHistory(
+            self.count_tokens,
+            self.history_token_budget,
+            RTL_STATE_PROMPT.format(rtl_code=rtl_code),
+        )
         for i in range(self.max_trials):
+            if cancel_event is not None and cancel_event.is_set():
+                logger.info("RTL Editing: cancelled")
+                break
             logger.info(f"RTL Editing: round {i + 1} / {self.max_trials}")
-            response = self.generate(
-                self.history
-                + succeed_history
-                + fail_history
-                + self.get_order_prompt_messages()
-            )
-            new_contents = [response.message]
-            action_input = self.parse_output(response).action_input
-            action_output = self.run_action(action_input)
+            with span("editor_round"):
+                messages = (
+                    self.history
+                    + editor_history.get_messages()
+                    + self.get_order_prompt_messages()
+                )
+                last_mismatch_cnt = self.last_mismatch_cnt
+                if self.speculative_cnt > 1:
+                    message, action_input, action_output = self.run_speculative_round(
+                        messages
+                    )
+                    new_contents = [message]
+                else:
+                    response = self.generate(messages)
+                    new_contents = [response.message]
+                    action_input = self.parse_output(response).action_input
+                    action_output = self.run_action(action_input)
+            if action_output["is_action_executed"]:
+                if (
+                    self.patch_library is not None
+                    and last_mismatch_cnt is not None
+                    and action_output["sim_mismatch_cnt"] < last_mismatch_cnt
+                ):
+                    self.mine_patches(action_input, sim_log)
+                sim_log = action_output["error_msg"]
             if self.is_done:
                 is_pass = True
                 break
-            new_contents.extend(self.get_action_output_message(action_output))
+            new_rtl_code = self.read_rtl()
+            new_contents.extend(
+                self.get_action_output_message(
+                    action_output, self.get_rtl_diff(rtl_code, new_rtl_code)
+                )
+            )
             assert len(new_contents) == 2, f"new_contents: {new_contents}"
-            if action_output["is_action_executed"]:
-                fail_history = []
-                succeed_history.extend(new_contents)
-                if len(succeed_history) > self.succeed_history_max_length:
-                    succeed_history = succeed_history[
-                        -self.succeed_history_max_length :
-                    ]
-            else:
-                fail_history.extend(new_contents)
-                if len(fail_history) > self.fail_history_max_length:
-                    fail_history = fail_history[-self.fail_history_max_length :]
+            editor_history.add_round(
+                new_contents,
+                self.summarize_round(
+                    i + 1, new_contents[0], action_input, action_output
+                ),
+                is_success=action_output["is_action_executed"],
+                state=RTL_STATE_PROMPT.format(rtl_code=rtl_code),
+            )
+            rtl_code = new_rtl_code
 
         with open(self.rtl_path, "r") as f:
             rtl_code = f.read()
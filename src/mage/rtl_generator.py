@@ -4,9 +4,17 @@ from typing import Dict, List, Tuple
 from llama_index.core.base.llms.types import ChatMessage, ChatResponse, MessageRole
 from pydantic import BaseModel
 
+from .line_patch import PATCH_EXAMPLE_OUTPUT, apply_line_patches, parse_line_patches
 from .log_utils import get_logger
-from .prompts import FAILED_TRIAL_PROMPT, ORDER_PROMPT, RTL_2_SHOT_EXAMPLES
+from .prompt_log import log_prompt_messages
+from .prompts import (
+    FAILED_TRIAL_PROMPT,
+    ORDER_PROMPT,
+    PATCH_ORDER_PROMPT,
+    RTL_2_SHOT_EXAMPLES,
+)
 from .sim_reviewer import check_syntax
+from .syntax_fixer import SyntaxFixStats, fix_syntax_by_rules
 from .token_counter import TokenCounter, TokenCounterCached
 from .utils import add_lineno
 
@@ -111,11 +119,20 @@ class RTLGenerator:
         self.failed_trial: List[ChatMessage] = []
         self.history: List[ChatMessage] = []
         self.max_trials = 5
+        # Syntax errors are first fixed by rules, then once by line patches, then by
+        # regeneration
+        self.use_fix_rules = True
+        self.syntax_fix_stats = SyntaxFixStats()
+        self.use_patch_repair = True
+        self.max_patch_trials = 2
         self.enable_cache = False
 
     def reset(self):
         self.history = []
 
+    def set_use_patch_repair(self, use_patch_repair: bool) -> None:
+        self.use_patch_repair = use_patch_repair
+
     def set_failed_trial(
         self, failed_sim_log: str, previous_code: str, previous_tb: str
     ) -> None:
@@ -129,10 +146,10 @@ class RTLGenerator:
         )
 
     def generate(self, messages: List[ChatMessage]) -> ChatResponse:
-        logger.info(f"RTL generator input message: {messages}")
+        log_prompt_messages(logger, "RTL generator input message", messages)
         resp, token_cnt = self.token_counter.count_chat(messages)
-        logger.info(f"Token count: {token_cnt}")
-        logger.info(f"{resp.message.content}")
+        logger.info("Token count: %s", token_cnt)
+        logger.info("%s", resp.message.content)
         return resp
 
     def batch_generate(
@@ -203,6 +220,61 @@ class RTLGenerator:
             ),
         ]
 
+    def get_patch_order_prompt_messages(self) -> List[ChatMessage]:
+        return [
+            ChatMessage(
+                content=PATCH_ORDER_PROMPT.format(
+                    output_format=json.dumps(PATCH_EXAMPLE_OUTPUT, indent=4)
+                ),
+                role=MessageRole.USER,
+            ),
+        ]
+
+    def repair_by_patches(
+        self,
+        messages: List[ChatMessage],
+        rtl_code: str,
+        syntax_output: str,
+        rtl_path: str,
+    ) -> Tuple[bool, str, str]:
+        """
+        Ask for line patches fixing the syntax errors of rtl_code, applied and
+        re-checked locally. Return (syntax_correct, rtl_code, syntax_output) of the
+        last patched code, which is rtl_code if no patch could be applied.
+        """
+        patch_history: List[ChatMessage] = []
+        for i in range(self.max_patch_trials):
+            patch_history.extend(
+                self.get_format_error_prompt_messages(syntax_output, rtl_code)
+            )
+            response = self.generate(
+                messages + patch_history + self.get_patch_order_prompt_messages()
+            )
+            self.syntax_fix_stats.add_llm_calls("added")
+            patch_history.append(response.message)
+            try:
+                patches = parse_line_patches(response.message.content)
+                patched_code = apply_line_patches(rtl_code, patches)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.info(f"Patch repair: invalid patches, {e}")
+                break
+            with open(rtl_path, "w") as f:
+                f.write(patched_code)
+            syntax_correct, syntax_output = check_syntax(rtl_path)
+            rtl_code = patched_code
+            logger.info(
+                f"Patch repair: trial {i + 1} / {self.max_patch_trials}, "
+                f"{len(patches)} patches, syntax_correct: {syntax_correct}"
+            )
+            if syntax_correct:
+                return (True, rtl_code, syntax_output)
+        return (False, rtl_code, syntax_output)
+
+    def add_saved_regeneration(self, trial: int) -> None:
+        """Code fixed locally at trial needs no regeneration, unless it was the last"""
+        if trial < self.max_trials - 1:
+            self.syntax_fix_stats.add_llm_calls("saved")
+
     def parse_output(self, response: ChatResponse) -> RTLOutputFormat:
         try:
             output_json_obj: Dict = json.loads(response.message.content, strict=False)
@@ -228,7 +300,9 @@ class RTLGenerator:
         self.generated_tb = testbench
         self.generated_if = interface
         self.history.extend(self.get_init_prompt_messages(input_spec))
-        for _ in range(self.max_trials):
+        # Line patches are asked for once, then failing code is regenerated
+        is_patch_tried = False
+        for j in range(self.max_trials):
             response = self.generate(self.history + self.get_order_prompt_messages())
             resp_obj = self.parse_output(response)
             if resp_obj.reasoning.startswith("Json Decode Error"):
@@ -239,12 +313,35 @@ class RTLGenerator:
             rtl_code = resp_obj.module
             with open(rtl_path, "w") as f:
                 f.write(rtl_code)
-            syntax_correct, syntax_output = check_syntax(rtl_path=rtl_path)
+            syntax_correct, syntax_output = check_syntax(rtl_path)
             if syntax_correct:
                 break
+            # The history continues from the code of the response, not the
+            # rule / patch fixed one, which the model never wrote
+            response_code, response_syntax_output = rtl_code, syntax_output
+            if self.use_fix_rules:
+                syntax_correct, rtl_code, syntax_output = fix_syntax_by_rules(
+                    rtl_code, syntax_output, rtl_path, self.syntax_fix_stats
+                )
+                if syntax_correct:
+                    self.add_saved_regeneration(j)
+                    break
+            if self.use_patch_repair and not is_patch_tried:
+                is_patch_tried = True
+                syntax_correct, rtl_code, syntax_output = self.repair_by_patches(
+                    self.history + [response.message],
+                    rtl_code,
+                    syntax_output,
+                    rtl_path,
+                )
+                if syntax_correct:
+                    self.add_saved_regeneration(j)
+                    break
             self.history.extend(
                 [response.message]
-                + self.get_format_error_prompt_messages(syntax_output, rtl_code)
+                + self.get_format_error_prompt_messages(
+                    response_syntax_output, response_code
+                )
             )
         return (syntax_correct, rtl_code)
 
@@ -269,25 +366,51 @@ class RTLGenerator:
             self.history + self.get_order_prompt_messages()
             for _ in range(candidates_num)
         ]
-        logger.info(f"gen_candidates init input message: {messages[0]}")
+        log_prompt_messages(logger, "gen_candidates init input message", messages[0])
         init_responses = self.batch_generate(messages)
         for i, response in enumerate(init_responses):
             rtl_code = self.parse_output(response).module
             candidate_history: List[ChatMessage] = [response.message]
+            is_patch_tried = False
             for j in range(self.max_trials):
                 with open(rtl_path, "w") as f:
                     f.write(rtl_code)
-                syntax_correct, syntax_output = check_syntax(rtl_path=rtl_path)
+                syntax_correct, syntax_output = check_syntax(rtl_path)
                 ret[i] = (syntax_correct, rtl_code)
                 logger.info(
                     f"Candidate {i + 1} / {candidates_num} trial {j + 1} / {self.max_trials} syntax_correct: {syntax_correct}"
                 )
-                logger.info(f"RTL code: {rtl_code}")
+                logger.info("RTL code: %s", rtl_code)
                 if syntax_correct:
                     break
-                elif j < self.max_trials - 1:
+                response_code, response_syntax_output = rtl_code, syntax_output
+                if self.use_fix_rules:
+                    syntax_correct, rtl_code, syntax_output = fix_syntax_by_rules(
+                        rtl_code, syntax_output, rtl_path, self.syntax_fix_stats
+                    )
+                    if syntax_correct:
+                        ret[i] = (syntax_correct, rtl_code)
+                        self.add_saved_regeneration(j)
+                        break
+                if j < self.max_trials - 1:
+                    if self.use_patch_repair and not is_patch_tried:
+                        is_patch_tried = True
+                        syntax_correct, rtl_code, syntax_output = (
+                            self.repair_by_patches(
+                                self.history + candidate_history,
+                                rtl_code,
+                                syntax_output,
+                                rtl_path,
+                            )
+                        )
+                        if syntax_correct:
+                            ret[i] = (syntax_correct, rtl_code)
+                            self.add_saved_regeneration(j)
+                            break
                     candidate_history.extend(
-                        self.get_format_error_prompt_messages(syntax_output, rtl_code)
+                        self.get_format_error_prompt_messages(
+                            response_syntax_output, response_code
+                        )
                     )
                     response = self.generate(
                         self.history
@@ -312,7 +435,7 @@ class RTLGenerator:
             rtl_code = self.parse_output(response).module
             with open(rtl_path, "w") as f:
                 f.write(rtl_code)
-            syntax_correct, syntax_output = check_syntax(rtl_path=rtl_path)
+            syntax_correct, syntax_output = check_syntax(rtl_path)
             if syntax_correct:
                 break
             self.history.extend(
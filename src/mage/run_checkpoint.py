@@ -0,0 +1,109 @@
+import hashlib
+import os
+from typing import Dict, List
+
+from pydantic import BaseModel
+
+from .log_utils import get_logger
+from .token_counter import TokenCounter
+
+logger = get_logger(__name__)
+
+CHECKPOINT_FILE_NAME = "checkpoint.json"
+
+
+class JudgeRecord(BaseModel):
+    """One round of the simulation / judge loop that decided to fix the testbench"""
+
+    sim_log: str
+    testbench: str
+    revised_testbench: str
+    # Revised by line patches instead of regeneration
+    is_patched: bool = False
+
+
+class CandidateRecord(BaseModel):
+    rtl_code: str
+    sim_mismatch_cnt: int
+    sim_log: str
+
+
+class EditorRecord(BaseModel):
+    """One finished editor session on a selected candidate"""
+
+    session_id: int
+    is_sim_pass: bool
+    rtl_code: str
+    sim_mismatch_cnt: int
+
+
+class RunCheckpoint(BaseModel):
+    """
+    Outputs of the finished stages of TopAgent.run_instance.
+    A field left as None means its stage has not completed yet.
+    """
+
+    run_key: str
+    testbench: str | None = None
+    interface: str | None = None
+    initial_rtl: str | None = None
+    is_initial_syntax_pass: bool | None = None
+    judge_records: List[JudgeRecord] = []
+    is_judge_done: bool = False
+    is_sim_pass: bool | None = None
+    sim_mismatch_cnt: int | None = None
+    sim_log: str | None = None
+    passed_candidate: CandidateRecord | None = None
+    candidates: List[CandidateRecord] | None = None
+    mutation_candidate: CandidateRecord | None = None
+    is_mutation_pass: bool | None = None
+    editor_records: List[EditorRecord] = []
+    token_tallies: Dict[str, Dict[str, int]] = {}
+
+
+def get_run_key(*parts: str) -> str:
+    """Checkpoints are only reused by runs with the same spec and settings"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class RunCheckpointer:
+    """Persist a RunCheckpoint in the per-run output dir after every stage"""
+
+    def __init__(self, output_dir_per_run: str, run_key: str, enabled: bool = True):
+        self.path = os.path.join(output_dir_per_run, CHECKPOINT_FILE_NAME)
+        self.enabled = enabled
+        self.ckpt = RunCheckpoint(run_key=run_key)
+        if not enabled or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                ckpt = RunCheckpoint.model_validate_json(f.read())
+        except ValueError as e:
+            logger.warning(f"Ignore broken checkpoint {self.path}: {e}")
+            return
+        if ckpt.run_key != run_key:
+            logger.info(f"Ignore checkpoint of a different run setting: {self.path}")
+            return
+        self.ckpt = ckpt
+        logger.info(f"Resume from checkpoint: {self.path}")
+
+    def save(self, token_counter: TokenCounter) -> None:
+        if not self.enabled:
+            return
+        self.ckpt.token_tallies = token_counter.snapshot()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.ckpt.model_dump_json(indent=4))
+        os.replace(tmp_path, self.path)
+
+    def restore_token_cnts(self, token_counter: TokenCounter) -> None:
+        """Tokens spent by resumed stages still count towards this run"""
+        token_counter.restore(self.ckpt.token_tallies)
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
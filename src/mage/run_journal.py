@@ -0,0 +1,49 @@
+import json
+import os
+from typing import Any, Dict
+
+from .log_utils import get_logger
+
+logger = get_logger(__name__)
+
+
+class RunJournal:
+    """
+    Append-only journal of per-task records of a benchmark run (one JSON per line).
+    Each record is flushed to disk as soon as its task completes, so a crashed
+    or preempted run can be resumed and its totals rebuilt from the journal.
+    """
+
+    def __init__(self, path: str, resume: bool = True):
+        self.path = path
+        self.records: Dict[str, Dict[str, Any]] = {}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if resume:
+            self.load()
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def load(self) -> None:
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    # Last line may be cut by a crash in the middle of a write
+                    logger.warning(f"Drop broken journal line in {self.path}")
+                    continue
+                # Later entries of the same task win, e.g. a rerun after resume
+                self.records[entry["task_id"]] = entry["record"]
+        logger.info(f"Loaded {len(self.records)} records from {self.path}")
+
+    def append(self, task_id: str, record: Dict[str, Any]) -> None:
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"task_id": task_id, "record": record}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.records[task_id] = record
+
+    def __contains__(self, task_id: str) -> bool:
+        return task_id in self.records
@@ -0,0 +1,217 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+from enum import Enum
+from typing import List, Tuple
+
+from .bash_tools import CommandResult, run_bash_command
+from .log_utils import get_logger
+
+logger = get_logger(__name__)
+
+SIM_CACHE_DIR = os.path.expanduser(
+    os.environ.get("MAGE_SIM_CACHE_DIR", "~/.cache/mage/sim")
+)
+SIM_CACHE_MAX_BYTES = int(os.environ.get("MAGE_SIM_CACHE_MAX_MB", "4096")) << 20
+
+
+class TypeSimulator(Enum):
+    IVERILOG = 1
+    VERILATOR = 2
+
+
+def hash_files(paths: List[str], extra: str = "") -> str:
+    """Content hash of the given files (order sensitive) plus extra build flags"""
+    h = hashlib.sha256(extra.encode())
+    for path in paths:
+        h.update(b"\0")
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def get_size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+class SimBackend:
+    """
+    Compile and run a simulation.
+    run() returns (is_returncode_ok, CommandResult json), same as run_bash_command,
+    so callers keep parsing sim output the way they do for iverilog.
+    dut is the source under test among sources, the one that changes between runs.
+    """
+
+    sim_type: TypeSimulator
+
+    def run(
+        self,
+        sources: List[str],
+        output_stem: str,
+        top: str | None = None,
+        extra_tops: List[str] | None = None,
+        dut: str | None = None,
+    ) -> Tuple[bool, str]:
+        raise NotImplementedError
+
+
+class IverilogBackend(SimBackend):
+    sim_type = TypeSimulator.IVERILOG
+
+    def run(
+        self,
+        sources: List[str],
+        output_stem: str,
+        top: str | None = None,
+        extra_tops: List[str] | None = None,
+        dut: str | None = None,
+    ) -> Tuple[bool, str]:
+        vvp_name = f"{output_stem}.vvp"
+        if os.path.isfile(vvp_name):
+            os.remove(vvp_name)
+        top_args = "".join(
+            f"-s {t} " for t in ([top] if top else []) + (extra_tops or [])
+        )
+        cmd = "iverilog -Wall -Winfloop -Wno-timescale -g2012 {}-o {} {}; vvp -n {}".format(
+            top_args, vvp_name, " ".join(sources), vvp_name
+        )
+        return run_bash_command(cmd, timeout=60)
+
+
+class VerilatorBackend(SimBackend):
+    """
+    Verilator (--binary --timing) backend with two levels of caching:
+    1. Executables are cached by the content hash of all sources,
+       so re-simulating an unchanged RTL variant does not rebuild at all.
+    2. The object dir is keyed by the sources but the DUT and shared by all RTL
+       variants of a task. Combined with ccache (OBJCACHE), the testbench and
+       golden translation units hit the cache and only the DUT is recompiled.
+    Past max_cache_bytes, the least recently used executables and object dirs
+    are removed after each build.
+    """
+
+    sim_type = TypeSimulator.VERILATOR
+
+    def __init__(
+        self, cache_dir: str = SIM_CACHE_DIR, max_cache_bytes: int = SIM_CACHE_MAX_BYTES
+    ):
+        self.cache_dir = os.path.join(cache_dir, "verilator")
+        self.max_cache_bytes = max_cache_bytes
+        self.flags = (
+            "--binary --timing -j 0 -Wno-fatal -Wno-lint -Wno-style "
+            "-Wno-TIMESCALEMOD -Wno-MULTITOP --prefix Vsim -o Vsim"
+        )
+        self.use_ccache = shutil.which("ccache") is not None
+
+    def run(
+        self,
+        sources: List[str],
+        output_stem: str,
+        top: str | None = None,
+        extra_tops: List[str] | None = None,
+        dut: str | None = None,
+    ) -> Tuple[bool, str]:
+        # Verilator elaborates a single top; extra_tops only make sense for iverilog
+        if extra_tops:
+            raise ValueError(
+                f"VerilatorBackend does not support extra_tops: {extra_tops}"
+            )
+        top_args = f"--top-module {top} " if top else ""
+        bin_digest = hash_files(sources, self.flags + top_args)
+        exe_path = os.path.join(self.cache_dir, "bin", bin_digest)
+        if not os.path.isfile(exe_path):
+            is_build_pass, build_output = self.build(sources, dut, top_args, exe_path)
+            self.evict(keep=exe_path)
+            if not is_build_pass:
+                return False, build_output
+        else:
+            logger.info(f"Verilator model cache hit: {bin_digest[:16]}")
+            os.utime(exe_path)  # Recently used, evicted last
+        return run_bash_command(exe_path, timeout=60, span_name="verilator_sim")
+
+    def build(
+        self, sources: List[str], dut: str | None, top_args: str, exe_path: str
+    ) -> Tuple[bool, str]:
+        # Without a dut, the object dir is only shared by runs of the same sources
+        shared_sources = [source for source in sources if source != dut]
+        obj_digest = hash_files(shared_sources, self.flags + top_args)
+        obj_dir = os.path.join(self.cache_dir, "obj", obj_digest[:32])
+        os.makedirs(obj_dir, exist_ok=True)
+        os.utime(obj_dir)
+        os.makedirs(os.path.dirname(exe_path), exist_ok=True)
+        env_prefix = "OBJCACHE=ccache " if self.use_ccache else ""
+        cmd = "{}verilator {} {}--Mdir {} {}".format(
+            env_prefix, self.flags, top_args, obj_dir, " ".join(sources)
+        )
+        # The object dir is shared between RTL variants, serialize builds on it
+        with open(os.path.join(obj_dir, ".lock"), "w") as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            is_pass, build_output = run_bash_command(
+                cmd, timeout=300, span_name="verilator_build"
+            )
+            if is_pass:
+                tmp_path = f"{exe_path}.{os.getpid()}.tmp"
+                shutil.copy2(os.path.join(obj_dir, "Vsim"), tmp_path)
+                os.replace(tmp_path, exe_path)
+        if not is_pass:
+            # Only report diagnostics; make's compile lines are noise for the LLM
+            build_output_obj = CommandResult.model_validate_json(build_output)
+            build_output = json.dumps(
+                CommandResult(stdout="", stderr=build_output_obj.stderr).model_dump(),
+                indent=4,
+            )
+        return is_pass, build_output
+
+    def evict(self, keep: str) -> None:
+        """
+        Remove least recently used cache entries until under max_cache_bytes,
+        except keep, the executable about to run
+        """
+        entries: List[Tuple[float, int, str]] = []
+        for sub_dir in ("bin", "obj"):
+            sub_path = os.path.join(self.cache_dir, sub_dir)
+            if not os.path.isdir(sub_path):
+                continue
+            for entry in os.scandir(sub_path):
+                if entry.name.endswith(".tmp") or entry.path == keep:
+                    continue
+                try:
+                    entries.append(
+                        (entry.stat().st_mtime, get_size(entry.path), entry.path)
+                    )
+                except FileNotFoundError:
+                    pass  # Evicted by another process
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_cache_bytes:
+                break
+            if os.path.isdir(path):
+                with open(os.path.join(path, ".lock"), "w") as lock_f:
+                    try:
+                        fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # Being built
+                    shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+            logger.info(f"Verilator cache evicted: {path}")
+
+
+def get_sim_backend(sim_type: TypeSimulator = TypeSimulator.IVERILOG) -> SimBackend:
+    if sim_type == TypeSimulator.IVERILOG:
+        return IverilogBackend()
+    if sim_type == TypeSimulator.VERILATOR:
+        return VerilatorBackend()
+    raise ValueError(f"Invalid sim_type: {sim_type}")
@@ -1,11 +1,15 @@
 import json
-from typing import Dict, List
+import os
+from typing import Dict, List, Tuple
 
 from llama_index.core.base.llms.types import ChatMessage, ChatResponse, MessageRole
 from pydantic import BaseModel
 
+from .bash_tools import CommandResult
 from .log_utils import get_logger
+from .prompt_log import log_prompt_messages
 from .prompts import ORDER_PROMPT
+from .syntax_fixer import parse_diagnostics
 from .token_counter import TokenCounter, TokenCounterCached
 from .utils import add_lineno
 
@@ -54,6 +58,42 @@ Even if the syntax error looks not related to the failed test case or the testbe
 """
 
 
+def pre_judge(failed_sim_log: str) -> Tuple[bool, str] | None:
+    """
+    Judge the failed simulation from its log alone where the answer is certain.
+    Return (tb_needs_fix, reasoning), or None if it needs the LLM.
+    """
+    try:
+        result = CommandResult.model_validate_json(failed_sim_log)
+    except ValueError:
+        return None
+    diags = [
+        d
+        for d in parse_diagnostics(failed_sim_log)
+        if "error" in d.message or "sorry" in d.message
+    ]
+    tb_diags = [d for d in diags if os.path.basename(d.file) == "tb.sv"]
+    if tb_diags:
+        return (
+            True,
+            f"Syntax / elaboration error in tb.sv line {tb_diags[0].line}: "
+            f"{tb_diags[0].message}",
+        )
+    if diags:
+        return None  # Errors of the rtl, maybe caused by how the tb uses it
+    if result.stderr.startswith("Timeout"):
+        return None  # A hanging rtl also stops the tb from finishing
+    if (
+        "SIMULATION PASSED" not in result.stdout
+        and "SIMULATION FAILED" not in result.stdout
+    ):
+        return (
+            True,
+            "The testbench finished without displaying SIMULATION PASSED / FAILED",
+        )
+    return None
+
+
 class SimJudge:
     def __init__(
         self,
@@ -61,15 +101,21 @@ class SimJudge:
     ):
         self.token_counter = token_counter
         self.history: List[ChatMessage] = []
+        # Reasoning of the last judgement, guiding the testbench repair
+        self.reasoning = ""
+        # Decide clear cases by pre_judge without calling the LLM
+        self.use_pre_judge = True
+        self.saved_call_cnt = 0
 
     def reset(self):
         self.history = []
+        self.reasoning = ""
 
     def generate(self, messages: List[ChatMessage]) -> ChatResponse:
-        logger.info(f"Sim judge input message: {messages}")
+        log_prompt_messages(logger, "Sim judge input message", messages)
         resp, token_cnt = self.token_counter.count_chat(messages)
-        logger.info(f"Token count: {token_cnt}")
-        logger.info(f"{resp.message.content}")
+        logger.info("Token count: %s", token_cnt)
+        logger.info("%s", resp.message.content)
         return resp
 
     def get_init_prompt_messages(
@@ -118,6 +164,16 @@ class SimJudge:
         failed_rtl: str,
         failed_testbench: str,
     ) -> bool:
+        if self.use_pre_judge:
+            judgement = pre_judge(failed_sim_log)
+            if judgement is not None:
+                tb_needs_fix, self.reasoning = judgement
+                self.saved_call_cnt += 1
+                logger.info(
+                    f"Sim judge: decided without LLM, tb_needs_fix: {tb_needs_fix}, "
+                    f"{self.reasoning}; {self.saved_call_cnt} calls saved"
+                )
+                return tb_needs_fix
         if isinstance(self.token_counter, TokenCounterCached):
             self.token_counter.set_enable_cache(False)
         self.history = []
@@ -130,4 +186,5 @@ class SimJudge:
         self.history.extend(self.get_order_prompt_messages())
         response = self.generate(self.history)
         resp_obj = self.parse_output(response)
+        self.reasoning = resp_obj.reasoning
         return resp_obj.tb_needs_fix
@@ -1,11 +1,17 @@
+import contextvars
+import copy
 import json
 import os
 import re
+import shlex
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from typing import Dict, List, Tuple
 
 from .bash_tools import CommandResult, run_bash_command
 from .benchmark_read_helper import TypeBenchmark
-from .log_utils import get_logger, set_log_dir
+from .log_utils import get_logger, redirect_log_to_dir
+from .sim_backend import SimBackend, TypeSimulator, get_sim_backend
+from .span_trace import SPAN_FILE_NAME, span, span_trace
 
 logger = get_logger(__name__)
 
@@ -21,8 +27,14 @@ def stderr_all_lines_benign(stderr: str) -> bool:
     )
 
 
-def check_syntax(rtl_path: str) -> Tuple[bool, str]:
-    cmd = f"iverilog -t null -Wall -Winfloop -Wno-timescale -g2012 -o /dev/null {rtl_path}"
+def check_syntax(paths: str | List[str]) -> Tuple[bool, str]:
+    """Syntax check of one file, or of files elaborated together"""
+    if isinstance(paths, str):
+        paths = [paths]
+    cmd = (
+        "iverilog -t null -Wall -Winfloop -Wno-timescale -g2012 -o /dev/null "
+        + " ".join(shlex.quote(path) for path in paths)
+    )
     is_pass, sim_output = run_bash_command(cmd, timeout=60)
     sim_output_obj = CommandResult.model_validate_json(sim_output)
     is_pass = (
@@ -33,10 +45,29 @@ def check_syntax(rtl_path: str) -> Tuple[bool, str]:
             or stderr_all_lines_benign(sim_output_obj.stderr)
         )
     )
-    logger.info(f"Syntax check is_pass: {is_pass}, \noutput: {sim_output}")
+    logger.info("Syntax check is_pass: %s, \noutput: %s", is_pass, sim_output)
     return is_pass, sim_output
 
 
+def check_tb_syntax(tb_path: str, rtl_path: str) -> Tuple[bool, str]:
+    """check_syntax of a testbench, elaborated with the RTL it instantiates"""
+    return check_syntax([tb_path, rtl_path])
+
+
+def check_syntax_batch(
+    rtl_paths: List[str], max_workers: int | None = None
+) -> List[Tuple[bool, str]]:
+    """check_syntax of every file, run in parallel"""
+    if not rtl_paths:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, check_syntax, rtl_path)
+            for rtl_path in rtl_paths
+        ]
+        return [future.result() for future in futures]
+
+
 def sim_review_mismatch_cnt(stdout: str) -> int:
     mismatch_cnt = 0
     if "SIMULATION FAILED" in stdout:
@@ -47,33 +78,49 @@ def sim_review_mismatch_cnt(stdout: str) -> int:
     return mismatch_cnt
 
 
+def is_sim_output_pass(is_pass: bool, sim_output_obj: CommandResult) -> bool:
+    return (
+        is_pass
+        and "SIMULATION PASSED" in sim_output_obj.stdout
+        and (
+            sim_output_obj.stderr == ""
+            or stderr_all_lines_benign(sim_output_obj.stderr)
+        )
+    )
+
+
+def is_golden_sim_output_pass(is_pass: bool, sim_output_obj: CommandResult) -> bool:
+    return (
+        is_pass
+        and "First mismatch occurred at time" not in sim_output_obj.stdout
+        and (
+            sim_output_obj.stderr == ""
+            or stderr_all_lines_benign(sim_output_obj.stderr)
+        )
+    )
+
+
 def sim_review(
     output_path_per_run: str,
     golden_rtl_path: str | None = None,
+    sim_backend: SimBackend | None = None,
 ) -> Tuple[bool, int, str]:
     rtl_path = f"{output_path_per_run}/rtl.sv"
-    vvp_name = f"{output_path_per_run}/sim_output.vvp"
     tb_path = f"{output_path_per_run}/tb.sv"
-    if golden_rtl_path is None:
-        golden_rtl_path = ""
-    if os.path.isfile(vvp_name):
-        os.remove(vvp_name)
-    cmd = "iverilog -Wall -Winfloop -Wno-timescale -g2012 -o {} {} {} {}; vvp -n {}".format(
-        vvp_name, tb_path, rtl_path, golden_rtl_path, vvp_name
+    output_stem = f"{output_path_per_run}/sim_output"
+    sim_backend = sim_backend or get_sim_backend()
+    sources = [tb_path, rtl_path] + ([golden_rtl_path] if golden_rtl_path else [])
+    is_pass, sim_output = sim_backend.run(
+        sources, output_stem=output_stem, dut=rtl_path
     )
-    is_pass, sim_output = run_bash_command(cmd, timeout=60)
     sim_output_obj = CommandResult.model_validate_json(sim_output)
-    is_pass = (
-        is_pass
-        and "SIMULATION PASSED" in sim_output_obj.stdout
-        and (
-            sim_output_obj.stderr == ""
-            or stderr_all_lines_benign(sim_output_obj.stderr)
-        )
-    )
+    is_pass = is_sim_output_pass(is_pass, sim_output_obj)
     mismatch_cnt = sim_review_mismatch_cnt(sim_output_obj.stdout)
     logger.info(
-        f"Simulation is_pass: {is_pass}, mismatch_cnt: {mismatch_cnt}\noutput: {sim_output}"
+        "Simulation is_pass: %s, mismatch_cnt: %s\noutput: %s",
+        is_pass,
+        mismatch_cnt,
+        sim_output,
     )
     assert isinstance(sim_output, str) and isinstance(is_pass, bool)
     return is_pass, mismatch_cnt, sim_output
@@ -84,15 +131,26 @@ class SimReviewer:
         self,
         output_path_per_run: str,
         golden_rtl_path: str | None = None,
+        sim_type: TypeSimulator = TypeSimulator.IVERILOG,
     ):
         self.output_path_per_run = output_path_per_run
         self.golden_rtl_path = golden_rtl_path
+        self.sim_type = sim_type
+        self.sim_backend = get_sim_backend(sim_type)
+
+    def for_dir(self, output_path_per_run: str) -> "SimReviewer":
+        """Reviewer of another workspace, sharing the backend"""
+        reviewer = copy.copy(self)
+        reviewer.output_path_per_run = output_path_per_run
+        return reviewer
 
     def review(self) -> Tuple[bool, int, str]:
-        return sim_review(
-            self.output_path_per_run,
-            self.golden_rtl_path,
-        )
+        with span("sim_review"):
+            return sim_review(
+                self.output_path_per_run,
+                self.golden_rtl_path,
+                self.sim_backend,
+            )
 
 
 def sim_review_golden(
@@ -101,6 +159,7 @@ def sim_review_golden(
     benchmark_type: TypeBenchmark,
     benchmark_path: str,
     output_path_per_run: str,
+    sim_type: TypeSimulator = TypeSimulator.IVERILOG,
 ) -> Tuple[bool, str]:
 
     if (
@@ -114,45 +173,163 @@ def sim_review_golden(
         )
         tb_path = f"{benchmark_path}/{folder}/{task_id}_test.sv"
         ref_path = f"{benchmark_path}/{folder}/{task_id}_ref.sv"
-        vvp_name = f"{output_path_per_run}/sim_golden.vvp"
-        if os.path.isfile(vvp_name):
-            os.remove(vvp_name)
-        cmd = "iverilog -Wall -Winfloop -Wno-timescale -g2012 -s tb -o {} {} {} {}; vvp -n {}".format(
-            vvp_name, tb_path, rtl_path, ref_path, vvp_name
+        is_pass, sim_output = get_sim_backend(sim_type).run(
+            [tb_path, rtl_path, ref_path],
+            output_stem=f"{output_path_per_run}/sim_golden",
+            top="tb",
+            dut=rtl_path,
         )
-        is_pass, sim_output = run_bash_command(cmd, timeout=60)
         sim_output_obj = CommandResult.model_validate_json(sim_output)
-        is_pass = (
-            is_pass
-            and "First mismatch occurred at time" not in sim_output_obj.stdout
-            and (
-                sim_output_obj.stderr == ""
-                or stderr_all_lines_benign(sim_output_obj.stderr)
-            )
-        )
-        logger.info(f"Golden simulation is_pass: {is_pass}, \noutput: {sim_output}")
+        is_pass = is_golden_sim_output_pass(is_pass, sim_output_obj)
+        logger.info("Golden simulation is_pass: %s, \noutput: %s", is_pass, sim_output)
         return is_pass, sim_output
     raise NotImplementedError  # Should not reach here
 
 
+def write_sim_review_output(
+    output_path_per_run: str, is_pass: bool, sim_output: str
+) -> None:
+    os.makedirs(output_path_per_run, exist_ok=True)
+    with open(f"{output_path_per_run}/sim_review_output.json", "w") as f:
+        f.write(
+            json.dumps(
+                {"is_pass": is_pass, "sim_output": json.loads(sim_output)}, indent=4
+            )
+        )
+
+
 def sim_review_golden_benchmark(
     task_id: str,
     output_path: str,
     benchmark_type: TypeBenchmark,
     benchmark_path: str,
+    sim_type: TypeSimulator = TypeSimulator.IVERILOG,
 ) -> Tuple[bool, str]:
     output_path_per_run = f"{output_path}/{benchmark_type.name}_{task_id}"
     rtl_path = f"{output_path_per_run}/rtl.sv"
     is_pass, sim_output = sim_review_golden(
-        rtl_path, task_id, benchmark_type, benchmark_path, output_path_per_run
+        rtl_path,
+        task_id,
+        benchmark_type,
+        benchmark_path,
+        output_path_per_run,
+        sim_type,
     )
-    with open(f"{output_path_per_run}/sim_review_output.json", "w") as f:
-        f.write(
-            json.dumps(
-                {"is_pass": is_pass, "sim_output": json.loads(sim_output)}, indent=4
+    write_sim_review_output(output_path_per_run, is_pass, sim_output)
+    return (is_pass, sim_output)
+
+
+def sim_review_golden_benchmark_logged(
+    task_id: str,
+    log_dir: str,
+    output_path: str,
+    benchmark_type: TypeBenchmark,
+    benchmark_path: str,
+    sim_type: TypeSimulator = TypeSimulator.IVERILOG,
+) -> Tuple[bool, str]:
+    """sim_review_golden_benchmark with its logs routed to log_dir, for pool workers"""
+    with (
+        redirect_log_to_dir(log_dir),
+        span_trace(os.path.join(log_dir, SPAN_FILE_NAME)),
+        span("golden_review"),
+    ):
+        return sim_review_golden_benchmark(
+            task_id,
+            output_path,
+            benchmark_type,
+            benchmark_path,
+            sim_type,
+        )
+
+
+def write_golden_review_summary(
+    results: Dict[str, Tuple[bool, str]], summary_path: str
+) -> Dict[str, object]:
+    summary: Dict[str, object] = {
+        "pass_cnt": sum(is_pass for is_pass, _ in results.values()),
+        "total_cnt": len(results),
+        "is_pass": {task_id: results[task_id][0] for task_id in sorted(results)},
+    }
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=4)
+    return summary
+
+
+def sim_review_golden_benchmark_rounds(
+    task_id_list: List[str],
+    log_path: str,
+    output_path_list: List[str],
+    benchmark_type: TypeBenchmark,
+    benchmark_path: str,
+    sim_type: TypeSimulator = TypeSimulator.IVERILOG,
+    max_workers: int | None = None,
+) -> Dict[str, Dict[str, Tuple[bool, str]]]:
+    """
+    Golden review of task_id_list for every output dir (round) in output_path_list,
+    on a process pool. Each output dir gets its sim_review_output.json files and a
+    golden_review_summary.json; the combined summary goes to log_path.
+    A task whose review raises counts as failed, with the error as its sim output,
+    also in its sim_review_output.json.
+    """
+    ret: Dict[str, Dict[str, Tuple[bool, str]]] = {p: {} for p in output_path_list}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for output_path in output_path_list:
+            round_log_path = (
+                log_path
+                if len(output_path_list) == 1
+                else os.path.join(log_path, os.path.basename(output_path.rstrip("/")))
+            )
+            for task_id in task_id_list:
+                log_dir = (
+                    f"{round_log_path}/golden_review_{benchmark_type.name}_{task_id}"
+                )
+                future = executor.submit(
+                    sim_review_golden_benchmark_logged,
+                    task_id,
+                    log_dir,
+                    output_path,
+                    benchmark_type,
+                    benchmark_path,
+                    sim_type,
+                )
+                futures[future] = (output_path, task_id)
+        for future in as_completed(futures):
+            output_path, task_id = futures[future]
+            try:
+                ret[output_path][task_id] = future.result()
+            except Exception as e:
+                logger.error(f"Golden review {output_path} {task_id} failed: {e!r}")
+                ret[output_path][task_id] = (
+                    False,
+                    CommandResult(stdout="", stderr=repr(e)).model_dump_json(),
+                )
+                write_sim_review_output(
+                    f"{output_path}/{benchmark_type.name}_{task_id}",
+                    *ret[output_path][task_id],
+                )
+            logger.info(
+                f"Golden review {output_path} {task_id}: is_pass = {ret[output_path][task_id][0]}"
             )
+
+    summary: Dict[str, object] = {}
+    for output_path, results in ret.items():
+        summary[output_path] = write_golden_review_summary(
+            results, f"{output_path}/golden_review_summary.json"
         )
-    return (is_pass, sim_output)
+        logger.info(
+            f"Golden review {output_path}: {summary[output_path]['pass_cnt']}/{len(results)}"
+        )
+    os.makedirs(log_path, exist_ok=True)
+    any_pass_cnt = sum(
+        any(ret[p][task_id][0] for p in output_path_list) for task_id in task_id_list
+    )
+    summary["any_round_pass_cnt"] = any_pass_cnt
+    with open(f"{log_path}/golden_review_summary.json", "w") as f:
+        json.dump(summary, f, indent=4)
+    if len(output_path_list) > 1:
+        logger.info(f"Golden review any round: {any_pass_cnt}/{len(task_id_list)}")
+    return ret
 
 
 def sim_review_golden_benchmark_batch(
@@ -161,11 +338,15 @@ def sim_review_golden_benchmark_batch(
     output_path: str,
     benchmark_type: TypeBenchmark,
     benchmark_path: str,
+    sim_type: TypeSimulator = TypeSimulator.IVERILOG,
+    max_workers: int | None = None,
 ) -> Dict[str, Tuple[bool, str]]:
-    ret: Dict[str, Tuple[bool, str]] = {}
-    for task_id in task_id_list:
-        set_log_dir(f"{log_path}/golden_review_{benchmark_type.name}_{task_id}")
-        ret[task_id] = sim_review_golden_benchmark(
-            task_id, output_path, benchmark_type, benchmark_path
-        )
-    return ret
+    return sim_review_golden_benchmark_rounds(
+        task_id_list,
+        log_path,
+        [output_path],
+        benchmark_type,
+        benchmark_path,
+        sim_type,
+        max_workers,
+    )[output_path]
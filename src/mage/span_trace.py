@@ -0,0 +1,136 @@
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterable, Iterator, List
+
+SPAN_FILE_NAME = "spans.jsonl"
+
+
+class SpanTrace:
+    """Append-only JSONL file of the finished spans of a task"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.f = open(path, "w")
+        self.lock = threading.Lock()
+        self.span_ids = itertools.count(1)
+
+    def write(self, span: Dict[str, Any]) -> None:
+        line = json.dumps(span) + "\n"
+        with self.lock:
+            self.f.write(line)
+
+    def close(self) -> None:
+        with self.lock:
+            self.f.close()
+
+
+span_trace_var: ContextVar[SpanTrace | None] = ContextVar("span_trace", default=None)
+parent_span_var: ContextVar[int | None] = ContextVar("parent_span", default=None)
+# Innermost "stage" span, e.g. to attribute LLM calls to stages
+current_stage_var: ContextVar[str | None] = ContextVar("current_stage", default=None)
+
+
+@contextmanager
+def span_trace(path: str) -> Iterator[SpanTrace]:
+    """Record spans of the current context to path"""
+    trace = SpanTrace(path)
+    token = span_trace_var.set(trace)
+    try:
+        yield trace
+    finally:
+        span_trace_var.reset(token)
+        trace.close()
+
+
+@contextmanager
+def span(name: str, category: str = "stage", **attrs: Any) -> Iterator[None]:
+    """
+    Time the enclosed block as a span of the current trace, no-op without one.
+    category is one of "stage", "llm", "subprocess".
+    """
+    stage_token = current_stage_var.set(name) if category == "stage" else None
+    trace = span_trace_var.get()
+    if trace is None:
+        try:
+            yield
+        finally:
+            if stage_token:
+                current_stage_var.reset(stage_token)
+        return
+    span_id = next(trace.span_ids)
+    parent_id = parent_span_var.get()
+    token = parent_span_var.set(span_id)
+    start_wall = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        parent_span_var.reset(token)
+        if stage_token:
+            current_stage_var.reset(stage_token)
+        trace.write(
+            {
+                "id": span_id,
+                "parent": parent_id,
+                "name": name,
+                "category": category,
+                "start": start_wall,
+                "duration": duration,
+                "error": error,
+                **attrs,
+            }
+        )
+
+
+def load_spans(path: str) -> List[Dict[str, Any]]:
+    spans = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                spans.append(json.loads(line))
+            except json.decoder.JSONDecodeError:
+                continue  # Cut by a crash
+    return spans
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Linear interpolation between closest ranks, q in [0, 1]"""
+    pos = (len(sorted_values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+def summarize_spans(paths: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Count, total, p50, p95 and max duration (seconds) per span name"""
+    durations: Dict[str, List[float]] = {}
+    categories: Dict[str, str] = {}
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        for s in load_spans(path):
+            durations.setdefault(s["name"], []).append(s["duration"])
+            categories[s["name"]] = s["category"]
+    summary = {}
+    for name in sorted(durations, key=lambda n: (categories[n], n)):
+        values = sorted(durations[name])
+        summary[name] = {
+            "category": categories[name],
+            "count": len(values),
+            "total": round(sum(values), 3),
+            "p50": round(percentile(values, 0.5), 3),
+            "p95": round(percentile(values, 0.95), 3),
+            "max": round(values[-1], 3),
+        }
+    return summary
@@ -0,0 +1,355 @@
+import re
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from pydantic import BaseModel
+
+from .bash_tools import CommandResult
+from .log_utils import get_logger
+from .sim_reviewer import check_syntax
+
+logger = get_logger(__name__)
+
+DIAGNOSTIC_RE = re.compile(r"^(?P<file>[^\s:]+):(?P<line>\d+):\s*(?P<message>.*)$")
+VERILATOR_DIAGNOSTIC_RE = re.compile(
+    r"^%(?P<severity>Error|Warning)[-\w]*: "
+    r"(?P<file>[^\s:]+):(?P<line>\d+):(?:\d+:)?\s*(?P<message>.*)$"
+)
+DECL_KEYWORDS = {
+    "input",
+    "output",
+    "inout",
+    "wire",
+    "reg",
+    "logic",
+    "signed",
+    "unsigned",
+}
+DEFAULT_NETTYPE_NONE_RE = re.compile(r"^\s*`default_nettype\s+none\b", re.M)
+NUMBER_LITERAL_RE = re.compile(r"(\d+)\s*'([sS]?)([bBoOhH])\s*([0-9a-fA-FxXzZ_?]+)")
+BASE_BITS = {"b": 1, "o": 3, "h": 4}
+
+
+class Diagnostic(BaseModel):
+    """One file:line: message diagnostic of iverilog (or verilator)"""
+
+    file: str
+    line: int
+    message: str
+
+
+def parse_diagnostics(syntax_output: str) -> List[Diagnostic]:
+    try:
+        result = CommandResult.model_validate_json(syntax_output)
+        output = result.stdout + "\n" + result.stderr
+    except ValueError:
+        output = syntax_output
+    diagnostics = []
+    for line in output.splitlines():
+        m = VERILATOR_DIAGNOSTIC_RE.match(line.strip())
+        if m:
+            message = f"{m.group('severity').lower()}: {m.group('message').strip()}"
+        else:
+            m = DIAGNOSTIC_RE.match(line.strip())
+            if m is None:
+                continue
+            message = m.group("message").strip()
+        diagnostics.append(
+            Diagnostic(file=m.group("file"), line=int(m.group("line")), message=message)
+        )
+    return diagnostics
+
+
+def get_declared_names(line: str) -> List[str]:
+    """Names declared by a one-line declaration, empty if it assigns a value"""
+    code = re.sub(r"//.*", "", line)
+    if "=" in code:
+        return []
+    code = re.sub(r"\[[^\]]*\]", " ", code)
+    return [
+        name
+        for name in re.findall(r"[A-Za-z_][\w$]*", code)
+        if name not in DECL_KEYWORDS
+    ]
+
+
+def find_declaration(lines: List[str], name: str, keyword: str) -> int | None:
+    """Index of the line declaring only name with keyword, e.g. reg"""
+    for i, line in enumerate(lines):
+        if re.search(rf"\b{keyword}\b", line) and get_declared_names(line) == [name]:
+            return i
+    return None
+
+
+# Rules get the lines of the code, edited in place, a diagnostic matching their
+# pattern and all diagnostics of the check. Each returns whether it made an edit.
+# Edits keep the line count, so line numbers of later diagnostics stay valid.
+FixRule = Callable[[List[str], re.Match, Diagnostic, List[Diagnostic]], bool]
+
+
+def fix_wire_to_reg(
+    lines: List[str], m: re.Match, diag: Diagnostic, diags: List[Diagnostic]
+) -> bool:
+    """Procedural assignment to a wire: declare it as reg"""
+    name = m.group(1).split(".")[-1]
+    index = next(
+        (
+            d.line - 1
+            for d in diags
+            if re.search(rf"\b{re.escape(name)} is declared here as wire", d.message)
+        ),
+        None,
+    )
+    if index is None or not 0 <= index < len(lines):
+        return False
+    line = lines[index]
+    if get_declared_names(line) != [name]:
+        return False
+    if re.search(r"\bwire\b", line):
+        lines[index] = re.sub(r"\bwire\b", "reg", line, count=1)
+        return True
+    if re.search(r"\boutput\b", line) and not re.search(r"\b(reg|logic)\b", line):
+        lines[index] = re.sub(r"\boutput\b", "output reg", line, count=1)
+        return True
+    return False
+
+
+def fix_reg_to_wire(
+    lines: List[str], m: re.Match, diag: Diagnostic, diags: List[Diagnostic]
+) -> bool:
+    """Continuous assignment to a reg: declare it as wire"""
+    index = find_declaration(lines, m.group(1).split(".")[-1], "reg")
+    if index is None:
+        return False
+    lines[index] = re.sub(r"\breg\b", "wire", lines[index], count=1)
+    return True
+
+
+def fix_implicit_wire(
+    lines: List[str], m: re.Match, diag: Diagnostic, diags: List[Diagnostic]
+) -> bool:
+    """Implicitly declared net: declare it explicitly at the end of the header"""
+    name = m.group(1)
+    module_index = next(
+        (
+            i
+            for i in range(min(diag.line, len(lines)) - 1, -1, -1)
+            if re.match(r"\s*module\b", lines[i])
+        ),
+        None,
+    )
+    if module_index is None:
+        return False
+    for i in range(module_index, len(lines)):
+        code = re.sub(r"//.*", "", lines[i])
+        if ";" in code:
+            if f"wire {name};" not in lines[i]:
+                lines[i] = f"{code.rstrip()} wire {name};"
+            return True
+    return False
+
+
+def fix_default_nettype(
+    lines: List[str], m: re.Match, diag: Diagnostic, diags: List[Diagnostic]
+) -> bool:
+    """Undeclared net under `default_nettype none: drop the directive"""
+    for i, line in enumerate(lines):
+        if DEFAULT_NETTYPE_NONE_RE.match(line):
+            lines[i] = ""
+            return True
+    return False
+
+
+def fix_sized_constant_digits(
+    lines: List[str], m: re.Match, diag: Diagnostic, diags: List[Diagnostic]
+) -> bool:
+    """Sized constant with more digits than its width: drop leading zeros"""
+    index = diag.line - 1
+    if not 0 <= index < len(lines):
+        return False
+
+    def trim(literal: re.Match) -> str:
+        width, signed, base, digits = literal.groups()
+        max_digits = -(-int(width) // BASE_BITS[base.lower()])
+        digits = digits.replace("_", "")
+        extra = len(digits) - max_digits
+        if extra <= 0 or digits[:extra].strip("0"):
+            return literal.group()
+        return f"{width}'{signed}{base}{digits[extra:]}"
+
+    new_line = NUMBER_LITERAL_RE.sub(trim, lines[index])
+    if new_line == lines[index]:
+        return False
+    lines[index] = new_line
+    return True
+
+
+def fix_unsized_concat_operand(
+    lines: List[str], m: re.Match, diag: Diagnostic, diags: List[Diagnostic]
+) -> bool:
+    """Unsized number in a concatenation: size it as the 32 bits it has"""
+    index = diag.line - 1
+    if not 0 <= index < len(lines):
+        return False
+    value = m.group(1)
+    new_line = re.sub(
+        rf"([{{,]\s*){value}(\s*[,}}])", rf"\g<1>32'd{value}\g<2>", lines[index]
+    )
+    if new_line == lines[index]:
+        return False
+    lines[index] = new_line
+    return True
+
+
+def fix_no_sensitivity(
+    lines: List[str], m: re.Match, diag: Diagnostic, diags: List[Diagnostic]
+) -> bool:
+    """Combinational block of constants that never triggers: run it once"""
+    index = diag.line - 1
+    if not 0 <= index < len(lines):
+        return False
+    new_line = re.sub(
+        r"\balways_comb\b|\balways\s*@\s*(?:\(\s*\*\s*\)|\*)",
+        "initial",
+        lines[index],
+        count=1,
+    )
+    if new_line == lines[index]:
+        return False
+    lines[index] = new_line
+    return True
+
+
+# name: (pattern of the diagnostic message, rule)
+FIX_RULES: Dict[str, Tuple[re.Pattern, FixRule]] = {
+    "wire_to_reg": (re.compile(r"(\S+) is not a valid l-value"), fix_wire_to_reg),
+    "reg_to_wire": (
+        re.compile(r"reg (\S+); cannot be driven by primitives or continuous"),
+        fix_reg_to_wire,
+    ),
+    "implicit_wire": (
+        re.compile(r"implicit definition of wire '(\w+)'"),
+        fix_implicit_wire,
+    ),
+    "default_nettype": (
+        re.compile(r"Unable to bind wire/reg/memory|is not declared"),
+        fix_default_nettype,
+    ),
+    "sized_constant_digits": (
+        re.compile(r"extra digits given for sized (binary|octal|hex) constant"),
+        fix_sized_constant_digits,
+    ),
+    "unsized_concat_operand": (
+        re.compile(r"Concatenation operand \"(?:'sd)?(\d+)\" has indefinite width"),
+        fix_unsized_concat_operand,
+    ),
+    "no_sensitivity": (re.compile(r"no sensitivities"), fix_no_sensitivity),
+}
+# name: pattern the code must contain for a rule to match, for rules whose
+# diagnostic also has other causes
+RULE_CODE_PATTERNS: Dict[str, re.Pattern] = {
+    "default_nettype": DEFAULT_NETTYPE_NONE_RE,
+}
+
+
+class SyntaxFixStats:
+    """
+    Per rule counts of matched diagnostics, edits and passed re-checks of a run,
+    and the LLM calls that local syntax repair added (patch requests) or saved
+    (regenerations not needed)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts: Dict[str, Dict[str, int]] = {}
+        self.llm_calls = {"added": 0, "saved": 0}
+
+    def add(self, rule: str, key: str) -> None:
+        with self.lock:
+            counts = self.counts.setdefault(
+                rule, {"matched": 0, "applied": 0, "fixed": 0}
+            )
+            counts[key] += 1
+
+    def add_llm_calls(self, key: str, cnt: int = 1) -> None:
+        with self.lock:
+            self.llm_calls[key] += cnt
+
+    def log_stats(self) -> None:
+        with self.lock:
+            counts = {rule: dict(c) for rule, c in self.counts.items()}
+            llm_calls = dict(self.llm_calls)
+        logger.info(
+            f"{'Syntax fix LLM calls':<40}: added {llm_calls['added']}, "
+            f"saved {llm_calls['saved']}, "
+            f"net saved {llm_calls['saved'] - llm_calls['added']}"
+        )
+        for rule, c in sorted(counts.items()):
+            logger.info(
+                f"{'Syntax fix ' + rule:<40}: matched {c['matched']}, "
+                f"applied {c['applied']}, fixed {c['fixed']}, "
+                f"hit rate {c['fixed'] / c['matched']:.2f}"
+            )
+
+
+def get_error_cnt(diags: List[Diagnostic]) -> int:
+    return sum(
+        "error" in d.message or "warning" in d.message or "sorry" in d.message
+        for d in diags
+    )
+
+
+def fix_syntax_by_rules(
+    rtl_code: str,
+    syntax_output: str,
+    rtl_path: str,
+    stats: SyntaxFixStats,
+    max_passes: int = 3,
+) -> Tuple[bool, str, str]:
+    """
+    Apply FIX_RULES to the iverilog diagnostics of rtl_code and re-check, until
+    it passes or no rule applies. A pass is kept only if it lowers the error
+    count. Return (syntax_correct, rtl_code, syntax_output) like check_syntax.
+    """
+    file_name = rtl_path.split("/")[-1]
+    # Rules of all kept passes, credited if the code passes in the end
+    kept: List[str] = []
+    for _ in range(max_passes):
+        diags = [
+            d
+            for d in parse_diagnostics(syntax_output)
+            if d.file.split("/")[-1] == file_name
+        ]
+        lines = rtl_code.split("\n")
+        applied: List[str] = []
+        for diag in diags:
+            for rule_name, (pattern, rule) in FIX_RULES.items():
+                m = pattern.search(diag.message)
+                if m is None:
+                    continue
+                code_pattern = RULE_CODE_PATTERNS.get(rule_name)
+                if code_pattern and not code_pattern.search(rtl_code):
+                    continue
+                stats.add(rule_name, "matched")
+                if rule(lines, m, diag, diags):
+                    stats.add(rule_name, "applied")
+                    applied.append(rule_name)
+                break
+        if not applied:
+            break
+        fixed_code = "\n".join(lines)
+        with open(rtl_path, "w") as f:
+            f.write(fixed_code)
+        syntax_correct, fixed_output = check_syntax(rtl_path)
+        logger.info(f"Syntax fix rules {applied}, syntax_correct: {syntax_correct}")
+        if syntax_correct:
+            for rule_name in set(kept + applied):
+                stats.add(rule_name, "fixed")
+            return (True, fixed_code, fixed_output)
+        if get_error_cnt(parse_diagnostics(fixed_output)) >= get_error_cnt(diags):
+            with open(rtl_path, "w") as f:
+                f.write(rtl_code)
+            break
+        rtl_code, syntax_output = fixed_code, fixed_output
+        kept.extend(applied)
+    return (False, rtl_code, syntax_output)
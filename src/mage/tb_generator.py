@@ -4,8 +4,16 @@ from typing import Dict, List, Tuple
 from llama_index.core.base.llms.types import ChatMessage, ChatResponse, MessageRole
 from pydantic import BaseModel
 
+from .line_patch import PATCH_EXAMPLE_OUTPUT, apply_line_patches, parse_line_patches
 from .log_utils import get_logger
-from .prompts import FAILED_TRIAL_PROMPT, ORDER_PROMPT, TB_2_SHOT_EXAMPLES
+from .prompt_log import log_prompt_messages
+from .prompts import (
+    FAILED_TRIAL_PROMPT,
+    ORDER_PROMPT,
+    PATCH_ORDER_PROMPT,
+    TB_2_SHOT_EXAMPLES,
+)
+from .sim_reviewer import check_tb_syntax
 from .token_counter import TokenCounter, TokenCounterCached
 from .utils import add_lineno
 
@@ -155,6 +163,30 @@ end
 """
 
 
+TB_REPAIR_PROMPT = r"""
+The testbench below failed simulation, and another agent judged that the testbench needs to be fixed:
+<failed_sim_log>
+{failed_sim_log}
+</failed_sim_log>
+<judge_reasoning>
+{judge_reasoning}
+</judge_reasoning>
+<testbench_with_lineno>
+{testbench_with_lineno}
+</testbench_with_lineno>
+Keep the interface of the tested module unchanged.
+"""
+
+TB_FORMAT_ERROR_PROMPT = r"""
+The patched testbench has the errors below reported by the format tool:
+<format_error>
+{format_error}
+</format_error>
+<testbench_with_lineno>
+{testbench_with_lineno}
+</testbench_with_lineno>
+"""
+
 EXAMPLE_OUTPUT = {
     "reasoning": "Brief one-sentence reasoning",
     "interface": "The IO part of a Verilog module, not containing the module implementation",
@@ -204,6 +236,7 @@ class TBGenerator:
         self.history: List[ChatMessage] = []
         self.golden_tb_path: str | None = None
         self.json_decode_max_trial = 3
+        self.max_patch_trials = 2
         self.gen_display_queue = True
 
     def reset(self):
@@ -225,10 +258,10 @@ class TBGenerator:
         )
 
     def generate(self, messages: List[ChatMessage]) -> ChatResponse:
-        logger.info(f"TB generator input message: {messages}")
+        log_prompt_messages(logger, "TB generator input message", messages)
         resp, token_cnt = self.token_counter.count_chat(messages)
-        logger.info(f"Token count: {token_cnt}")
-        logger.info(f"{resp.message.content}")
+        logger.info("Token count: %s", token_cnt)
+        logger.info("%s", resp.message.content)
         return resp
 
     def get_init_prompt_messages(self, input_spec: str) -> List[ChatMessage]:
@@ -277,6 +310,77 @@ class TBGenerator:
 
         return [order_prompt_message]
 
+    def get_patch_order_prompt_messages(self) -> List[ChatMessage]:
+        return [
+            ChatMessage(
+                content=PATCH_ORDER_PROMPT.format(
+                    output_format=json.dumps(PATCH_EXAMPLE_OUTPUT, indent=4)
+                ),
+                role=MessageRole.USER,
+            ),
+        ]
+
+    def repair(
+        self,
+        input_spec: str,
+        testbench: str,
+        failed_sim_log: str,
+        judge_reasoning: str,
+        tb_path: str,
+        rtl_path: str,
+    ) -> str | None:
+        """
+        Fix testbench with line patches guided by the failed sim log and the judge
+        reasoning, applied and syntax checked locally with the RTL at rtl_path.
+        Return the patched testbench, or None if no patch passes the syntax check,
+        with the original testbench restored at tb_path.
+        """
+        if isinstance(self.token_counter, TokenCounterCached):
+            self.token_counter.set_enable_cache(False)
+        self.token_counter.set_cur_tag(self.__class__.__name__)
+        # Failed trials are left out, the repair prompt has the current one
+        messages = self.get_init_prompt_messages(input_spec)[:2] + [
+            ChatMessage(
+                content=TB_REPAIR_PROMPT.format(
+                    failed_sim_log=failed_sim_log,
+                    judge_reasoning=judge_reasoning,
+                    testbench_with_lineno=add_lineno(testbench),
+                ),
+                role=MessageRole.USER,
+            )
+        ]
+        original_testbench = testbench
+        for i in range(self.max_patch_trials):
+            response = self.generate(messages + self.get_patch_order_prompt_messages())
+            messages.append(response.message)
+            try:
+                patches = parse_line_patches(response.message.content)
+                testbench = apply_line_patches(testbench, patches)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.info(f"TB patch repair: invalid patches, {e}")
+                break
+            with open(tb_path, "w") as f:
+                f.write(testbench)
+            syntax_correct, syntax_output = check_tb_syntax(tb_path, rtl_path)
+            logger.info(
+                f"TB patch repair: trial {i + 1} / {self.max_patch_trials}, "
+                f"{len(patches)} patches, syntax_correct: {syntax_correct}"
+            )
+            if syntax_correct:
+                return testbench
+            messages.append(
+                ChatMessage(
+                    content=TB_FORMAT_ERROR_PROMPT.format(
+                        format_error=syntax_output,
+                        testbench_with_lineno=add_lineno(testbench),
+                    ),
+                    role=MessageRole.USER,
+                )
+            )
+        with open(tb_path, "w") as f:
+            f.write(original_testbench)
+        return None
+
     def parse_output(self, response: ChatResponse) -> TBOutputFormat:
         try:
             output_json_obj: Dict = json.loads(response.message.content, strict=False)
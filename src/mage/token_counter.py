@@ -1,5 +1,7 @@
 import asyncio
+import threading
 import time
+from contextvars import ContextVar
 from typing import Dict, List, Tuple
 
 import tiktoken
@@ -14,12 +16,20 @@ from llama_index.llms.vllm import Vllm  # Add this import for Vllm support
 from pydantic import BaseModel
 from vertexai.preview.generative_models import GenerativeModel
 
+from .background_loop import await_in_background_loop, run_in_background_loop
 from .gen_config import get_exp_setting
+from .llm_ledger import PendingLLMCall
 from .log_utils import get_logger
+from .span_trace import span
 from .utils import reformat_json_string
 
 logger = get_logger(__name__)
 
+# Tag and cache mode of the calling agent. Context-local, so agents sharing one
+# counter from different threads / asyncio tasks don't overwrite each other's.
+token_tag_var: ContextVar[str] = ContextVar("token_tag", default="")
+cache_enabled_var: ContextVar[bool | None] = ContextVar("cache_enabled", default=None)
+
 settings = get_exp_setting()
 setting_args = {
     "temperature": settings.temperature,
@@ -27,6 +37,13 @@ setting_args = {
 }
 
 
+async def achat(llm: LLM, messages: List[ChatMessage], **kwargs) -> ChatResponse:
+    """LLM.achat, or LLM.chat on a worker thread for clients without a real one"""
+    if asyncio.iscoroutinefunction(llm.achat):
+        return await llm.achat(messages, **kwargs)
+    return await asyncio.to_thread(llm.chat, messages, **kwargs)
+
+
 class TokenCount(BaseModel):
     """Token count of an LLM call"""
 
@@ -72,6 +89,63 @@ class TokenCountCached(TokenCount):
         )
 
 
+class TokenTally:
+    """
+    Running token counts of one tag, updated in place on every call.
+    Slotted plain ints, so accounting does not allocate or validate models.
+    """
+
+    __slots__ = (
+        "call_cnt",
+        "in_token_cnt",
+        "out_token_cnt",
+        "cache_write_cnt",
+        "cache_read_cnt",
+    )
+
+    def __init__(self) -> None:
+        self.call_cnt = 0
+        self.in_token_cnt = 0
+        self.out_token_cnt = 0
+        self.cache_write_cnt = 0
+        self.cache_read_cnt = 0
+
+    def add(self, token_cnt: TokenCount) -> None:
+        self.call_cnt += 1
+        self.in_token_cnt += token_cnt.in_token_cnt
+        self.out_token_cnt += token_cnt.out_token_cnt
+        if isinstance(token_cnt, TokenCountCached):
+            self.cache_write_cnt += token_cnt.cache_write_cnt
+            self.cache_read_cnt += token_cnt.cache_read_cnt
+
+    def merge(self, other: "TokenTally") -> None:
+        for field in self.__slots__:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def to_dict(self) -> Dict[str, int]:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, int]) -> "TokenTally":
+        tally = cls()
+        for field in cls.__slots__:
+            setattr(tally, field, d.get(field, 0))
+        return tally
+
+    def to_token_count(self) -> TokenCount:
+        return TokenCount(
+            in_token_cnt=self.in_token_cnt, out_token_cnt=self.out_token_cnt
+        )
+
+    def to_token_count_cached(self) -> TokenCountCached:
+        return TokenCountCached(
+            in_token_cnt=self.in_token_cnt,
+            out_token_cnt=self.out_token_cnt,
+            cache_write_cnt=self.cache_write_cnt,
+            cache_read_cnt=self.cache_read_cnt,
+        )
+
+
 class TokenCost(BaseModel):
     """Token cost of an LLM call"""
 
@@ -118,10 +192,14 @@ class TokenCounter:
 
     def __init__(self, llm: LLM) -> None:
         self.llm = llm
-        self.token_cnts: Dict[str, List[TokenCount]] = {"": []}
-        self.token_cnts_lock = asyncio.Lock()
-        self.cur_tag = ""
+        # Per-tag and total tallies; a thread lock rather than an asyncio one,
+        # since calls may come from event loops of several threads
+        self.token_tallies: Dict[str, TokenTally] = {"": TokenTally()}
+        self.total_tally = TokenTally()
+        self.token_tally_lock = threading.Lock()
         self.max_parallel_requests: int = 10
+        # Limits batch requests of all callers, lives on the background loop
+        self.request_semaphore: asyncio.Semaphore | None = None
         self.enable_reformat_json = isinstance(llm, (Vertex, Ollama, Vllm))
         model = llm.metadata.model_name
         if isinstance(llm, OpenAI):
@@ -171,10 +249,15 @@ class TokenCounter:
             return
         self.token_cost = TOKEN_COSTS[model]
 
+    @property
+    def cur_tag(self) -> str:
+        return token_tag_var.get()
+
     def set_cur_tag(self, tag: str) -> None:
-        self.cur_tag = tag
-        if tag not in self.token_cnts:
-            self.token_cnts[tag] = []
+        token_tag_var.set(tag)
+        with self.token_tally_lock:
+            if tag not in self.token_tallies:
+                self.token_tallies[tag] = TokenTally()
 
     def count(self, string: str) -> int:
         if self.encoding is None:
@@ -182,89 +265,177 @@ class TokenCounter:
         return len(self.encoding.encode(string))
 
     def reset(self) -> None:
-        self.token_cnts = {"": []}
+        with self.token_tally_lock:
+            self.token_tallies = {"": TokenTally()}
+            self.total_tally = TokenTally()
+
+    def add_token_cnt(self, token_cnt: TokenCount, tag: str | None = None) -> None:
+        tag = self.cur_tag if tag is None else tag
+        with self.token_tally_lock:
+            if tag not in self.token_tallies:
+                self.token_tallies[tag] = TokenTally()
+            self.token_tallies[tag].add(token_cnt)
+            self.total_tally.add(token_cnt)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        """Per-tag counts, e.g. to persist and restore() in a resumed run"""
+        with self.token_tally_lock:
+            return {tag: t.to_dict() for tag, t in self.token_tallies.items()}
+
+    def restore(self, snapshot: Dict[str, Dict[str, int]]) -> None:
+        with self.token_tally_lock:
+            for tag, d in snapshot.items():
+                tally = TokenTally.from_dict(d)
+                self.token_tallies.setdefault(tag, TokenTally()).merge(tally)
+                self.total_tally.merge(tally)
+
+    def get_tally(self, tag: str | None = None) -> TokenTally:
+        """Copy of the tally of tag, or of all tags"""
+        tally = TokenTally()
+        with self.token_tally_lock:
+            tally.merge(
+                self.token_tallies.get(tag, TokenTally()) if tag else self.total_tally
+            )
+        return tally
+
+    def get_tag_tallies(self) -> List[Tuple[str, TokenTally]]:
+        with self.token_tally_lock:
+            return [
+                (tag, TokenTally.from_dict(t.to_dict()))
+                for tag, t in self.token_tallies.items()
+            ]
 
     def count_chat(
-        self, messages: List[ChatMessage], llm: LLM | None = None
+        self,
+        messages: List[ChatMessage],
+        llm: LLM | None = None,
+        enqueue_time: float | None = None,
+        tag: str | None = None,
     ) -> Tuple[ChatResponse, TokenCount]:
         llm = llm or self.llm
+        tag = self.cur_tag if tag is None else tag
         in_token_cnt = self.count(llm.messages_to_prompt(messages))
         logger.info(
             "TokenCounter count_chat Triggered at temp: %s, top_p: %s"
             % (settings.temperature, settings.top_p)
         )
-        response = llm.chat(
-            messages, top_p=settings.top_p, temperature=settings.temperature
-        )
+        call = PendingLLMCall(tag, llm.metadata.model_name, messages, enqueue_time)
+        try:
+            with span(f"llm:{tag}", category="llm"):
+                response = llm.chat(
+                    messages, top_p=settings.top_p, temperature=settings.temperature
+                )
+        except Exception as e:
+            call.fail(e)
+            raise
         out_token_cnt = self.count(response.message.content)
         token_cnt = TokenCount(in_token_cnt=in_token_cnt, out_token_cnt=out_token_cnt)
-        self.token_cnts[self.cur_tag].append(token_cnt)
+        self.add_token_cnt(token_cnt, tag)
+        call.finish(response, token_cnt, self.get_call_cost(token_cnt))
         if self.enable_reformat_json:
             response.message.content = reformat_json_string(response.message.content)
         return (response, token_cnt)
 
     async def count_achat(
-        self, messages: List[ChatMessage], llm: LLM | None = None
+        self,
+        messages: List[ChatMessage],
+        llm: LLM | None = None,
+        enqueue_time: float | None = None,
+        tag: str | None = None,
     ) -> Tuple[ChatResponse, TokenCount]:
         llm = llm or self.llm
+        tag = self.cur_tag if tag is None else tag
         in_token_cnt = self.count(llm.messages_to_prompt(messages))
         logger.info(
             "TokenCounter count_achat Triggered at temp: %s, top_p: %s"
             % (settings.temperature, settings.top_p)
         )
-        response = await llm.achat(
-            messages, top_p=settings.top_p, temperature=settings.temperature
-        )
+        call = PendingLLMCall(tag, llm.metadata.model_name, messages, enqueue_time)
+        try:
+            with span(f"llm:{tag}", category="llm"):
+                response = await achat(
+                    llm,
+                    messages,
+                    top_p=settings.top_p,
+                    temperature=settings.temperature,
+                )
+        except Exception as e:
+            call.fail(e)
+            raise
         out_token_cnt = self.count(response.message.content)
         token_cnt = TokenCount(in_token_cnt=in_token_cnt, out_token_cnt=out_token_cnt)
-        async with self.token_cnts_lock:
-            self.token_cnts[self.cur_tag].append(token_cnt)
+        self.add_token_cnt(token_cnt, tag)
+        call.finish(response, token_cnt, self.get_call_cost(token_cnt))
         if self.enable_reformat_json:
             response.message.content = reformat_json_string(response.message.content)
         return (response, token_cnt)
 
     async def count_achat_batch(
-        self, chat_inputs: List[List[ChatMessage]], llm: LLM | None = None
+        self,
+        chat_inputs: List[List[ChatMessage]],
+        llm: LLM | None = None,
+        tag: str | None = None,
     ) -> List[Tuple[ChatResponse, TokenCount]]:
         llm = llm or self.llm
-        results = []
-        for i in range(0, len(chat_inputs), self.max_parallel_requests):
-            batch = chat_inputs[i : i + self.max_parallel_requests]
-            tasks = [
-                self.count_achat(llm=llm, messages=chat_input) for chat_input in batch
-            ]
-            batch_results = await asyncio.gather(*tasks)
-            results.extend(batch_results)
-        return results
+        tag = self.cur_tag if tag is None else tag
+        # Hop to the background loop, where the async clients and the limit live
+        return await await_in_background_loop(
+            self._count_achat_batch(chat_inputs, llm, tag)
+        )
+
+    async def _count_achat_batch(
+        self, chat_inputs: List[List[ChatMessage]], llm: LLM, tag: str
+    ) -> List[Tuple[ChatResponse, TokenCount]]:
+        if self.request_semaphore is None:
+            self.request_semaphore = asyncio.Semaphore(self.max_parallel_requests)
+        semaphore = self.request_semaphore
+        # Requests waiting for a free slot are logged as queue time
+        enqueue_time = time.time()
+
+        async def count_achat_limited(
+            chat_input: List[ChatMessage],
+        ) -> Tuple[ChatResponse, TokenCount]:
+            async with semaphore:
+                return await self.count_achat(
+                    llm=llm, messages=chat_input, enqueue_time=enqueue_time, tag=tag
+                )
+
+        return list(
+            await asyncio.gather(
+                *[count_achat_limited(chat_input) for chat_input in chat_inputs]
+            )
+        )
 
     def count_chat_batch(
-        self, chat_inputs: List[List[ChatMessage]], llm: LLM | None = None
+        self,
+        chat_inputs: List[List[ChatMessage]],
+        llm: LLM | None = None,
+        tag: str | None = None,
     ) -> List[Tuple[ChatResponse, TokenCount]]:
         llm = llm or self.llm
-        try:
-            # Get the current event loop
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            # If there is no current event loop, create a new one
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+        tag = self.cur_tag if tag is None else tag
         start_time = time.time()
-        results = loop.run_until_complete(
-            self.count_achat_batch(llm=llm, chat_inputs=chat_inputs)
-        )
+        with span(f"llm_batch:{tag}", category="llm", size=len(chat_inputs)):
+            results = run_in_background_loop(
+                self._count_achat_batch(chat_inputs, llm, tag)
+            )
         logger.info(f"Total batch chat time: {time.time() - start_time:.2f}s")
         return results
 
+    def get_call_cost(self, token_cnt: TokenCount) -> float:
+        if not self.token_cost:
+            return 0.0
+        return (
+            token_cnt.in_token_cnt * self.token_cost.in_token_cost_per_token
+            + token_cnt.out_token_cnt * self.token_cost.out_token_cost_per_token
+        )
+
     def log_token_stats(self) -> None:
-        total_sum_cnt = TokenCount(in_token_cnt=0, out_token_cnt=0)
-        for tag in self.token_cnts:
-            token_cnt = self.token_cnts[tag]
-            if not token_cnt:
+        for tag, tally in self.get_tag_tallies():
+            if not tally.call_cnt:
                 continue
-            sum_cnt = sum(token_cnt, start=TokenCount(in_token_cnt=0, out_token_cnt=0))
-            assert isinstance(sum_cnt, TokenCount)
-            total_sum_cnt += sum_cnt
-            logger.info(f"{tag + ' cnt':<25}: {sum_cnt}")
+            logger.info(f"{tag + ' cnt':<25}: {tally.to_token_count()}")
+        total_sum_cnt = self.get_tally().to_token_count()
         logger.info((f"{'Total cnt':<25}: {total_sum_cnt}"))
         if self.token_cost:
             total_cost = (
@@ -276,27 +447,12 @@ class TokenCounter:
     def get_sum_count(self, tag: str | None = None) -> TokenCount:
         # If have tag: return sum of token counts with that tag
         # If no tag: return sum of all token counts
-        if tag:
-            token_cnt = self.token_cnts[tag]
-            sum_cnt = sum(token_cnt, start=TokenCount(in_token_cnt=0, out_token_cnt=0))
-        else:
-            sum_cnt = TokenCount(in_token_cnt=0, out_token_cnt=0)
-            for token_cnt in self.token_cnts.values():
-                sum_cnt += sum(
-                    token_cnt, start=TokenCount(in_token_cnt=0, out_token_cnt=0)
-                )
-        assert isinstance(sum_cnt, TokenCount)
-        return sum_cnt
+        return self.get_tally(tag).to_token_count()
 
     def get_total_token(self) -> int:
         """Return token number regarding to token limit"""
-        sum_cnt = TokenCount(in_token_cnt=0, out_token_cnt=0)
-        for token_cnt in self.token_cnts.values():
-            tag_cnt = sum(token_cnt, start=TokenCount(in_token_cnt=0, out_token_cnt=0))
-            assert isinstance(tag_cnt, TokenCount)
-            sum_cnt += tag_cnt
-        assert isinstance(sum_cnt, TokenCount)
-        return sum_cnt.in_token_cnt + sum_cnt.out_token_cnt
+        tally = self.get_tally()
+        return tally.in_token_cnt + tally.out_token_cnt
 
 
 class TokenCounterCached(TokenCounter):
@@ -307,10 +463,16 @@ class TokenCounterCached(TokenCounter):
         assert isinstance(llm, Anthropic)
         self.write_cost_ratio: float = 1.25
         self.read_cost_ratio: float = 0.1
-        self.enable_cache = True
+        self.default_enable_cache = True
+
+    @property
+    def enable_cache(self) -> bool:
+        enable_cache = cache_enabled_var.get()
+        return self.default_enable_cache if enable_cache is None else enable_cache
 
     def set_enable_cache(self, enable_cache: bool) -> None:
-        self.enable_cache = enable_cache
+        """Cache mode of the calling context only"""
+        cache_enabled_var.set(enable_cache)
 
     def equivalent_cost(self, token_count_cached: TokenCountCached) -> TokenCount:
         equi_cost = round(
@@ -323,6 +485,11 @@ class TokenCounterCached(TokenCounter):
             out_token_cnt=token_count_cached.out_token_cnt,
         )
 
+    def get_call_cost(self, token_cnt: TokenCount) -> float:
+        if isinstance(token_cnt, TokenCountCached):
+            token_cnt = self.equivalent_cost(token_cnt)
+        return super().get_call_cost(token_cnt)
+
     @classmethod
     def is_cache_enabled(cls, llm: LLM) -> bool:
         return isinstance(llm, Anthropic)
@@ -331,18 +498,29 @@ class TokenCounterCached(TokenCounter):
         target.additional_kwargs["cache_control"] = {"type": "ephemeral"}
 
     def count_chat(
-        self, messages: List[ChatMessage], llm: LLM | None = None
+        self,
+        messages: List[ChatMessage],
+        llm: LLM | None = None,
+        enqueue_time: float | None = None,
+        tag: str | None = None,
     ) -> Tuple[ChatResponse, TokenCountCached]:
         llm = llm or self.llm
+        tag = self.cur_tag if tag is None else tag
         logger.info(
             "TokenCounterCached count_chat Triggered at temp: %s, top_p: %s"
             % (settings.temperature, settings.top_p)
         )
-        response = llm.chat(
-            messages,
-            top_p=settings.top_p,
-            temperature=settings.temperature,
-        )
+        call = PendingLLMCall(tag, llm.metadata.model_name, messages, enqueue_time)
+        try:
+            with span(f"llm:{tag}", category="llm"):
+                response = llm.chat(
+                    messages,
+                    top_p=settings.top_p,
+                    temperature=settings.temperature,
+                )
+        except Exception as e:
+            call.fail(e)
+            raise
         usage = response.raw["usage"]
         assert isinstance(usage, Usage), f"Unknown usage type: {type(usage)}"
         token_cnt = TokenCountCached(
@@ -359,24 +537,37 @@ class TokenCounterCached(TokenCounter):
                 else 0
             ),
         )
-        self.token_cnts[self.cur_tag].append(token_cnt)
+        self.add_token_cnt(token_cnt, tag)
+        call.finish(response, token_cnt, self.get_call_cost(token_cnt))
         if self.enable_reformat_json:
             response.message.content = reformat_json_string(response.message.content)
         return (response, token_cnt)
 
     async def count_achat(
-        self, messages: List[ChatMessage], llm: LLM | None = None
+        self,
+        messages: List[ChatMessage],
+        llm: LLM | None = None,
+        enqueue_time: float | None = None,
+        tag: str | None = None,
     ) -> Tuple[ChatResponse, TokenCountCached]:
         llm = llm or self.llm
+        tag = self.cur_tag if tag is None else tag
         logger.info(
             "TokenCounterCached count_achat Triggered at temp: %s, top_p: %s"
             % (settings.temperature, settings.top_p)
         )
-        response = await llm.achat(
-            messages,
-            top_p=settings.top_p,
-            temperature=settings.temperature,
-        )
+        call = PendingLLMCall(tag, llm.metadata.model_name, messages, enqueue_time)
+        try:
+            with span(f"llm:{tag}", category="llm"):
+                response = await achat(
+                    llm,
+                    messages,
+                    top_p=settings.top_p,
+                    temperature=settings.temperature,
+                )
+        except Exception as e:
+            call.fail(e)
+            raise
         usage = response.raw["usage"]
         assert isinstance(usage, Usage), f"Unknown usage type: {type(usage)}"
         token_cnt = TokenCountCached(
@@ -393,24 +584,17 @@ class TokenCounterCached(TokenCounter):
                 else 0
             ),
         )
-        async with self.token_cnts_lock:
-            self.token_cnts[self.cur_tag].append(token_cnt)
+        self.add_token_cnt(token_cnt, tag)
+        call.finish(response, token_cnt, self.get_call_cost(token_cnt))
         if self.enable_reformat_json:
             response.message.content = reformat_json_string(response.message.content)
         return (response, token_cnt)
 
     def log_token_stats(self) -> None:
-        total_sum_cnt = TokenCountCached(in_token_cnt=0, out_token_cnt=0)
-        for tag in self.token_cnts:
-            token_cnt = self.token_cnts[tag]
-            if not token_cnt:
+        for tag, tally in self.get_tag_tallies():
+            if not tally.call_cnt:
                 continue
-            sum_cnt = sum(
-                token_cnt, start=TokenCountCached(in_token_cnt=0, out_token_cnt=0)
-            )
-            assert isinstance(sum_cnt, TokenCountCached)
-
-            total_sum_cnt += sum_cnt
+            sum_cnt = tally.to_token_count_cached()
             sum_equal_cnt = self.equivalent_cost(sum_cnt)
 
             if sum_cnt.cache_write_cnt or sum_cnt.cache_read_cnt:
@@ -419,6 +603,7 @@ class TokenCounterCached(TokenCounter):
             else:
                 logger.info(f"{tag + ' cnt':<25}: {sum_equal_cnt}")
 
+        total_sum_cnt = self.get_tally().to_token_count_cached()
         total_sum_equal_cnt = self.equivalent_cost(total_sum_cnt)
         if total_sum_cnt.cache_write_cnt or total_sum_cnt.cache_read_cnt:
             saved_tokens = round(
@@ -443,19 +628,7 @@ class TokenCounterCached(TokenCounter):
     def get_sum_count_cached(self, tag: str | None = None) -> TokenCount:
         # If have tag: return sum of token counts with that tag
         # If no tag: return sum of all token counts
-        if tag:
-            token_cnt = self.token_cnts[tag]
-            sum_cnt = sum(
-                token_cnt, start=TokenCountCached(in_token_cnt=0, out_token_cnt=0)
-            )
-        else:
-            sum_cnt = TokenCountCached(in_token_cnt=0, out_token_cnt=0)
-            for token_cnt in self.token_cnts.values():
-                sum_cnt += sum(
-                    token_cnt, start=TokenCountCached(in_token_cnt=0, out_token_cnt=0)
-                )
-        assert isinstance(sum_cnt, TokenCount)
-        return sum_cnt
+        return self.get_tally(tag).to_token_count_cached()
 
     def get_sum_count(self, tag: str | None = None) -> TokenCount:
         sum_cnt_cached = self.get_sum_count_cached(tag)
@@ -468,10 +641,10 @@ class TokenCounterCached(TokenCounter):
 
     def get_total_token(self) -> int:
         """Return token number regarding to token limit"""
-        sum_cnt_cached = self.get_sum_count_cached()
-        sum_token_cnt = sum_cnt_cached.in_token_cnt + sum_cnt_cached.out_token_cnt
-        if isinstance(sum_cnt_cached, TokenCountCached):
-            sum_token_cnt += (
-                sum_cnt_cached.cache_write_cnt + sum_cnt_cached.cache_read_cnt
-            )
-        return sum_token_cnt
+        tally = self.get_tally()
+        return (
+            tally.in_token_cnt
+            + tally.out_token_cnt
+            + tally.cache_write_cnt
+            + tally.cache_read_cnt
+        )
@@ -0,0 +1,67 @@
+import hashlib
+import os
+
+from mage.benchmark_read_helper import BenchmarkIndex, TypeBenchmark, TypeBenchmarkFile
+
+
+def make_dataset(tmp_path) -> str:
+    folder = tmp_path / "repo" / "dataset_spec-to-rtl"
+    folder.mkdir(parents=True)
+    for task_id in ("Prob001_zero", "Prob002_wire"):
+        (folder / f"{task_id}_prompt.txt").write_text(f"Spec of {task_id}")
+        (folder / f"{task_id}_ref.sv").write_text("module RefModule(); endmodule")
+    return str(folder)
+
+
+def test_index_hashes_on_demand(tmp_path):
+    make_dataset(tmp_path)
+    cache_dir = str(tmp_path / "cache")
+    index = BenchmarkIndex(
+        TypeBenchmark.VERILOG_EVAL_V2, str(tmp_path / "repo"), cache_dir
+    )
+    assert index.task_ids() == ["Prob001_zero", "Prob002_wire"]
+    assert index.get_record("Prob001_zero").files["SPEC"].sha256 is None
+    sha256 = index.get_sha256("Prob001_zero", TypeBenchmarkFile.SPEC)
+    assert sha256 == hashlib.sha256(b"Spec of Prob001_zero").hexdigest()
+    # The hash is kept in the manifest for the next run
+    index = BenchmarkIndex(
+        TypeBenchmark.VERILOG_EVAL_V2, str(tmp_path / "repo"), cache_dir
+    )
+    assert index.get_record("Prob001_zero").files["SPEC"].sha256 == sha256
+
+
+def test_file_edited_in_place_is_refreshed_with_check_files(tmp_path):
+    folder = make_dataset(tmp_path)
+    cache_dir = str(tmp_path / "cache")
+    index = BenchmarkIndex(
+        TypeBenchmark.VERILOG_EVAL_V2, str(tmp_path / "repo"), cache_dir
+    )
+    index.get_sha256("Prob001_zero", TypeBenchmarkFile.SPEC)
+    dir_stat = os.stat(folder)
+    spec_path = os.path.join(folder, "Prob001_zero_prompt.txt")
+    with open(spec_path, "w") as f:
+        f.write("New longer spec of Prob001_zero")
+    os.utime(folder, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+
+    # By default the unchanged dir mtime is trusted
+    index = BenchmarkIndex(
+        TypeBenchmark.VERILOG_EVAL_V2, str(tmp_path / "repo"), cache_dir
+    )
+    file = index.get_record("Prob001_zero").files["SPEC"]
+    assert file.size != os.path.getsize(spec_path)
+    assert file.sha256 is not None
+
+    index = BenchmarkIndex(
+        TypeBenchmark.VERILOG_EVAL_V2,
+        str(tmp_path / "repo"),
+        cache_dir,
+        check_files=True,
+    )
+    file = index.get_record("Prob001_zero").files["SPEC"]
+    assert file.size == os.path.getsize(spec_path)
+    assert file.sha256 is None
+    assert index.get_spec("Prob001_zero") == "New longer spec of Prob001_zero"
+    assert (
+        index.get_sha256("Prob001_zero", TypeBenchmarkFile.SPEC)
+        == hashlib.sha256(b"New longer spec of Prob001_zero").hexdigest()
+    )
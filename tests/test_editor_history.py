@@ -0,0 +1,85 @@
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+
+from mage.editor_history import EditorHistory
+
+
+def count_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+def make_round(i: int, size: int = 400):
+    return [
+        ChatMessage(role=MessageRole.ASSISTANT, content=f"response {i} " + "r" * size),
+        ChatMessage(role=MessageRole.USER, content=f"output {i} " + "o" * size),
+    ]
+
+
+def test_prefix_stays_stable_between_folds():
+    history = EditorHistory(count_tokens, token_budget=1000)
+    prev = history.get_messages()
+    prefix_breaks = 0
+    for i in range(30):
+        history.add_round(make_round(i), f"Round {i + 1}: summary")
+        messages = history.get_messages()
+        fold_cnt = history.fold_cnt
+        if messages[: len(prev)] != prev:
+            prefix_breaks += 1
+        prev = messages
+        assert history.get_token_cnt() <= 1000
+        # Only a fold may change the messages already sent
+        assert prefix_breaks == fold_cnt
+    # Each fold frees half the budget, so folds are rare: every 2-3 rounds here
+    # instead of on every round
+    assert 0 < history.fold_cnt <= 30 // 2
+
+
+def test_fold_summarizes_oldest_rounds_in_order():
+    history = EditorHistory(count_tokens, token_budget=1000)
+    for i in range(4):
+        history.add_round(make_round(i), f"Round {i + 1}")
+    # 4 rounds of ~200 tokens exceed 1000 only with the 5th round
+    assert history.fold_cnt == 0
+    history.add_round(make_round(4), "Round 5")
+    assert history.fold_cnt == 1
+    assert history.summary_lines == ["Round 1", "Round 2", "Round 3"]
+    messages = history.get_messages()
+    assert "Round 1\nRound 2\nRound 3" in str(messages[0].content)
+    assert messages[1:] == make_round(3) + make_round(4)
+
+
+def test_latest_round_is_kept_even_over_budget():
+    history = EditorHistory(count_tokens, token_budget=100)
+    history.add_round(make_round(0), "Round 1")
+    history.add_round(make_round(1, size=2000), "Round 2")
+    assert history.summary_lines == ["Round 1"]
+    assert history.get_messages()[1:] == make_round(1, size=2000)
+
+
+def test_success_folds_failed_rounds():
+    history = EditorHistory(count_tokens, token_budget=1000)
+    history.add_round(make_round(0), "Round 1")
+    history.add_round(make_round(1), "Round 2", is_success=False)
+    history.add_round(make_round(2), "Round 3", is_success=False)
+    assert history.fold_cnt == 0
+    history.add_round(make_round(3), "Round 4")
+    assert history.fold_cnt == 1
+    assert history.summary_lines == ["Round 2", "Round 3"]
+    assert history.get_messages()[1:] == make_round(0) + make_round(3)
+    # Folded rounds stay in round order
+    for i in range(4, 30):
+        history.add_round(make_round(i), f"Round {i + 1}")
+    assert history.summary_lines[:4] == ["Round 1", "Round 2", "Round 3", "Round 4"]
+
+
+def test_summary_holds_state_of_first_kept_round():
+    history = EditorHistory(count_tokens, token_budget=1000, init_state="state 0")
+    history.add_round(make_round(0), "Round 1", is_success=False, state="state 0")
+    history.add_round(make_round(1), "Round 2", state="state 0")
+    # The failed round changed nothing, so the kept rounds start from init_state
+    assert "state" not in str(history.get_messages()[0].content)
+    i = 2
+    while history.fold_cnt < 2:
+        history.add_round(make_round(i), f"Round {i + 1}", state=f"state {i - 1}")
+        i += 1
+    first_kept = len(history.summary_lines)
+    assert str(history.get_messages()[0].content).endswith(f"state {first_kept - 1}")
@@ -0,0 +1,94 @@
+import pytest
+
+from mage.line_patch import LinePatch, apply_line_patches, parse_line_patches
+
+CODE = "module TopModule;\n  wire a;\n  wire b;\n  assign a = b;\nendmodule"
+
+
+def patch(start_line: int, end_line: int, content: str) -> LinePatch:
+    return LinePatch(start_line=start_line, end_line=end_line, content=content)
+
+
+def test_replace_and_delete():
+    assert apply_line_patches(CODE, [patch(2, 3, "  wire a, b;")]) == (
+        "module TopModule;\n  wire a, b;\n  assign a = b;\nendmodule"
+    )
+    assert apply_line_patches(CODE, [patch(4, 4, "")]) == (
+        "module TopModule;\n  wire a;\n  wire b;\nendmodule"
+    )
+
+
+def test_insert_before_line_and_at_end():
+    # end_line = start_line - 1 inserts before start_line
+    assert apply_line_patches(CODE, [patch(2, 1, "  wire c;")]).split("\n")[1:3] == [
+        "  wire c;",
+        "  wire a;",
+    ]
+    assert apply_line_patches(CODE, [patch(6, 5, "// end")]).endswith(
+        "endmodule\n// end"
+    )
+
+
+def test_patches_use_original_line_numbers():
+    patched = apply_line_patches(
+        CODE,
+        [patch(4, 4, "  assign a = ~b;"), patch(2, 2, "  wire a;\n  wire c;")],
+    )
+    assert patched == (
+        "module TopModule;\n  wire a;\n  wire c;\n  wire b;\n"
+        "  assign a = ~b;\nendmodule"
+    )
+    # Insertion before a replaced line
+    assert apply_line_patches(
+        CODE, [patch(2, 2, "  wire x;"), patch(2, 1, "  wire y;")]
+    ).split("\n")[1:3] == ["  wire y;", "  wire x;"]
+
+
+@pytest.mark.parametrize(
+    "patches",
+    [
+        [patch(0, 1, "x")],
+        [patch(7, 6, "x")],
+        [patch(3, 1, "x")],
+        [patch(5, 6, "x")],
+    ],
+)
+def test_out_of_range(patches):
+    with pytest.raises(ValueError, match="out of range"):
+        apply_line_patches(CODE, patches)
+
+
+@pytest.mark.parametrize(
+    "patches",
+    [
+        [patch(2, 3, "x"), patch(3, 4, "y")],
+        [patch(2, 2, "x"), patch(2, 2, "y")],
+        [patch(2, 3, "x"), patch(3, 2, "y")],
+    ],
+)
+def test_overlap(patches):
+    with pytest.raises(ValueError, match="overlaps"):
+        apply_line_patches(CODE, patches)
+
+
+def test_lineno_prefix_stripping():
+    # Copied from the line-numbered code: prefixes are dropped
+    assert apply_line_patches(CODE, [patch(2, 2, "2:   wire c;\n\n3:   wire d;")]) == (
+        "module TopModule;\n  wire c;\n\n  wire d;\n  wire b;\n"
+        "  assign a = b;\nendmodule"
+    )
+    # Only some lines look numbered: content is kept as is
+    assert apply_line_patches(CODE, [patch(4, 4, "1: begin\n  assign a = b;")]) == (
+        "module TopModule;\n  wire a;\n  wire b;\n1: begin\n  assign a = b;\nendmodule"
+    )
+
+
+def test_parse_line_patches():
+    patches = parse_line_patches(
+        '{"reasoning": "r", "patches": [{"start_line": 2, "end_line": 2, "content": "x"}]}'
+    )
+    assert patches == [patch(2, 2, "x")]
+    with pytest.raises(ValueError):
+        parse_line_patches('{"reasoning": "r", "patches": []}')
+    with pytest.raises(KeyError):
+        parse_line_patches('{"reasoning": "r"}')
@@ -0,0 +1,61 @@
+from mage.mutation_repair import generate_mutations, mutate_number
+
+FSM = """module TopModule (
+  input clk,
+  input reset,
+  input in,
+  output [1:0] out
+);
+  localparam A = 2'b00, B = 2'b01, C = 2'b10;
+  reg [1:0] state;
+  reg [3:0] cnt;
+  always @(posedge clk) begin
+    if (reset) state <= A;
+    else if (in) state <= B;
+    else state <= C;
+    cnt <= cnt + 1;
+  end
+  assign out = cnt[0] ? state : 2'b11;
+endmodule
+"""
+
+
+def get_mutated_lines(rtl_code: str) -> dict:
+    """Line number: descriptions of the mutants changing it"""
+    lines: dict = {}
+    for description, _ in generate_mutations(rtl_code):
+        lineno = int(description.split(":")[0].split()[1])
+        lines.setdefault(lineno, []).append(description)
+    return lines
+
+
+def test_mutate_number():
+    assert mutate_number("0") == ["1"]
+    assert mutate_number("7") == ["6", "8"]
+    assert mutate_number("2'b01") == ["2'b11", "2'b00"]
+    assert mutate_number("4'hf") == ["4'he"]
+    assert mutate_number("8'd0") == ["8'd1"]
+    assert mutate_number("1'bx") == []
+
+
+def test_mutations_skip_header_widths_and_params():
+    lines = get_mutated_lines(FSM)
+    # Header, localparam encodings and declaration widths
+    assert not set(lines) & set(range(1, 10))
+    # Edge, conditions, assignments, params and constants in the logic
+    assert "line 10: posedge -> negedge" in lines[10]
+    assert "line 11: invert if condition" in lines[11]
+    assert "line 11: A -> B" in lines[11]
+    assert "line 14: 1 -> 0" in lines[14]
+    assert "line 16: 2'b11 -> 2'b10" in lines[16]
+    # Bit selects outside declarations are still mutated
+    assert "line 16: 0 -> 1" in lines[16]
+
+
+def test_mutations_are_unique_and_change_the_code():
+    mutations = generate_mutations(FSM)
+    codes = [code for _, code in mutations]
+    assert FSM not in codes
+    assert len(codes) == len(set(codes))
+    for description, code in mutations:
+        assert len(code.split("\n")) == len(FSM.split("\n")), description
@@ -0,0 +1,46 @@
+import json
+import sqlite3
+
+from mage.patch_library import PatchLibrary, get_anchor
+
+SIM_LOG = "Mismatches: 3 in 100 samples"
+RTL = """module TopModule (input clk, input [3:0] a, output reg [3:0] q);
+  always @(posedge clk) q <= a - 1;
+endmodule
+"""
+
+
+def test_find_instantiates_mined_patch(tmp_path):
+    library = PatchLibrary(str(tmp_path / "lib.sqlite"))
+    library.add("x <= y - 1;", "x <= y + 1;", SIM_LOG)
+    # Anchor "<=" is missing from the code, so the patch is never matched
+    library.add("if (en) z = 0;", "if (!en) z = 0;", SIM_LOG)
+    matches = library.find(RTL, SIM_LOG, limit=5)
+    assert [(m.old_content, m.new_content) for m in matches] == [
+        ("q <= a - 1;", "q <= a + 1;")
+    ]
+    assert library.find(RTL.replace("<=", "="), SIM_LOG, limit=5) == []
+
+
+def test_library_without_anchors_is_migrated(tmp_path):
+    path = str(tmp_path / "lib.sqlite")
+    pattern = ["$0", "<=", "$1", "-", "1", ";"]
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE patches (pattern_key TEXT PRIMARY KEY, "
+        "old_pattern TEXT NOT NULL, old_content TEXT NOT NULL, "
+        "new_content TEXT NOT NULL, mined_cnt INTEGER NOT NULL DEFAULT 1, "
+        "tried_cnt INTEGER NOT NULL DEFAULT 0, "
+        "helped_cnt INTEGER NOT NULL DEFAULT 0, "
+        "created REAL NOT NULL, last_used REAL NOT NULL)"
+    )
+    conn.execute(
+        "INSERT INTO patches VALUES ('k', ?, 'x <= y - 1;', 'x <= y + 1;', "
+        "1, 0, 0, 0, 0)",
+        (json.dumps(pattern),),
+    )
+    conn.commit()
+    conn.close()
+    library = PatchLibrary(path)
+    assert get_anchor(pattern) == "<="
+    assert [m.pattern_key for m in library.find(RTL, SIM_LOG, limit=5)] == ["k"]
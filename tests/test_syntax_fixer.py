@@ -0,0 +1,158 @@
+from typing import List
+
+import mage.syntax_fixer
+from mage.bash_tools import CommandResult
+from mage.syntax_fixer import (
+    FIX_RULES,
+    SyntaxFixStats,
+    fix_syntax_by_rules,
+    parse_diagnostics,
+)
+
+
+def to_output(stdout: str) -> str:
+    return CommandResult(stdout=stdout, stderr="").model_dump_json()
+
+
+def apply_rules(code: str, stdout: str) -> tuple[str, List[str]]:
+    """Code after the first rule matching each diagnostic, and the applied rules"""
+    diags = parse_diagnostics(to_output(stdout))
+    lines = code.split("\n")
+    applied = []
+    for diag in diags:
+        for name, (pattern, rule) in FIX_RULES.items():
+            m = pattern.search(diag.message)
+            if m is None:
+                continue
+            if rule(lines, m, diag, diags):
+                applied.append(name)
+            break
+    return "\n".join(lines), applied
+
+
+def test_parse_diagnostics():
+    diags = parse_diagnostics(
+        to_output(
+            "rtl.sv:5: error: out is not a valid l-value in TopModule.\n"
+            "%Error-PROCASSWIRE: rtl.sv:7:5: Procedural assignment to wire\n"
+            "1 error(s) during elaboration.\n"
+        )
+    )
+    assert [(d.line, d.message) for d in diags] == [
+        (5, "error: out is not a valid l-value in TopModule."),
+        (7, "error: Procedural assignment to wire"),
+    ]
+
+
+def test_wire_to_reg():
+    code = "module TopModule(input a, output out);\n  wire q;\n  always @* q = a;\n  assign out = q;\nendmodule"
+    fixed, applied = apply_rules(
+        code,
+        "rtl.sv:3: error: q is not a valid l-value in TopModule.\n"
+        "rtl.sv:2:      : q is declared here as wire.\n",
+    )
+    assert applied == ["wire_to_reg"]
+    assert fixed.split("\n")[1] == "  reg q;"
+
+
+def test_wire_to_reg_output_port():
+    code = "module TopModule(\n  input a,\n  output out\n);\n  always @* out = a;\nendmodule"
+    fixed, applied = apply_rules(
+        code,
+        "rtl.sv:5: error: TopModule.out is not a valid l-value in TopModule.\n"
+        "rtl.sv:3:      : out is declared here as wire.\n",
+    )
+    assert applied == ["wire_to_reg"]
+    assert fixed.split("\n")[2] == "  output reg out"
+
+
+def test_reg_to_wire():
+    code = (
+        "module TopModule(input a, output out);\n  reg q;\n  assign q = a;\nendmodule"
+    )
+    fixed, applied = apply_rules(
+        code,
+        "rtl.sv:3: error: reg q; cannot be driven by primitives or continuous assignment.\n",
+    )
+    assert applied == ["reg_to_wire"]
+    assert fixed.split("\n")[1] == "  wire q;"
+
+
+def test_implicit_wire():
+    code = "module TopModule(input a, output out);\n  assign tmp = a;\n  assign out = tmp;\nendmodule"
+    fixed, applied = apply_rules(
+        code, "rtl.sv:2: warning: implicit definition of wire 'tmp'.\n"
+    )
+    assert applied == ["implicit_wire"]
+    assert fixed.split("\n")[0].endswith("); wire tmp;")
+    # Line numbers of later diagnostics stay valid
+    assert len(fixed.split("\n")) == len(code.split("\n"))
+
+
+def test_default_nettype():
+    code = "`default_nettype none\nmodule TopModule(input a, output out);\n  assign out = b;\nendmodule"
+    fixed, applied = apply_rules(
+        code, "rtl.sv:3: error: Unable to bind wire/reg/memory `b' in `TopModule'\n"
+    )
+    assert applied == ["default_nettype"]
+    assert fixed.split("\n")[0] == ""
+
+
+def test_sized_constant_digits():
+    code = "  assign out = 2'b001;\n  assign x = 4'hf;"
+    fixed, applied = apply_rules(
+        code, "rtl.sv:1: warning: extra digits given for sized binary constant.\n"
+    )
+    assert applied == ["sized_constant_digits"]
+    assert fixed == "  assign out = 2'b01;\n  assign x = 4'hf;"
+    # Dropping significant digits would change the value
+    _, applied = apply_rules(
+        "  assign out = 2'b101;",
+        "rtl.sv:1: warning: extra digits given for sized binary constant.\n",
+    )
+    assert applied == []
+
+
+def test_unsized_concat_operand():
+    fixed, applied = apply_rules(
+        "  assign out = {a, 1, b};",
+        'rtl.sv:1: error: Concatenation operand "1" has indefinite width.\n',
+    )
+    assert applied == ["unsized_concat_operand"]
+    assert fixed == "  assign out = {a, 32'd1, b};"
+
+
+def test_no_sensitivity():
+    fixed, applied = apply_rules(
+        "  always @(*) out = 1'b0;",
+        "rtl.sv:1: warning: @* found no sensitivities so it will never trigger.\n",
+    )
+    assert applied == ["no_sensitivity"]
+    assert fixed == "  initial out = 1'b0;"
+
+
+def test_fix_syntax_by_rules_counts_only_applicable_rules(tmp_path, monkeypatch):
+    rtl_path = str(tmp_path / "rtl.sv")
+    syntax_output = to_output(
+        "rtl.sv:3: error: Unable to bind wire/reg/memory `b' in `TopModule'\n"
+        "rtl.sv:2: warning: implicit definition of wire 'c'.\n"
+    )
+    monkeypatch.setattr(
+        mage.syntax_fixer,
+        "check_syntax",
+        lambda paths: (True, to_output("")),
+    )
+    stats = SyntaxFixStats()
+    code = "module TopModule(input a, output out);\n  assign c = a;\n  assign out = b;\nendmodule"
+    is_pass, fixed, _ = fix_syntax_by_rules(code, syntax_output, rtl_path, stats)
+    assert is_pass
+    assert "wire c;" in fixed
+    # No `default_nettype none in the code, so the undeclared b is no match
+    assert stats.counts == {"implicit_wire": {"matched": 1, "applied": 1, "fixed": 1}}
+
+
+def test_llm_calls():
+    stats = SyntaxFixStats()
+    stats.add_llm_calls("added", 2)
+    stats.add_llm_calls("saved")
+    assert stats.llm_calls == {"added": 2, "saved": 1}
@@ -1,20 +1,23 @@
 import argparse
+import functools
 import json
+import multiprocessing
+import threading
 import time
+from concurrent.futures import Future, ProcessPoolExecutor
 from datetime import timedelta
 from typing import Any, Dict
 
 from llama_index.core.llms import LLM
 
 from mage.agent import TopAgent
-from mage.benchmark_read_helper import (
-    TypeBenchmark,
-    TypeBenchmarkFile,
-    get_benchmark_contents,
-)
+from mage.benchmark_read_helper import BenchmarkIndex, TypeBenchmark, TypeBenchmarkFile
 from mage.gen_config import get_llm, set_exp_setting
 from mage.log_utils import get_logger
-from mage.sim_reviewer import sim_review_golden_benchmark
+from mage.run_journal import RunJournal
+from mage.sim_backend import TypeSimulator
+from mage.sim_reviewer import sim_review_golden_benchmark_logged
+from mage.span_trace import SPAN_FILE_NAME, summarize_spans
 from mage.token_counter import TokenCount
 
 logger = get_logger(__name__)
@@ -32,7 +35,7 @@ args_dict = {
     # "model": "qwen2.5-coder:7b",
     # "model": "hf.co/mradermacher/VeriReason-Qwen2.5-7b-RTLCoder-Verilog-GRPO-reasoning-tb-i1-GGUF:Q4_K_M",
     "model": "Qwen/Qwen2.5-Coder-32B-Instruct",  # Use the 32B model we downloaded
-    #"filter_instance": "^(Prob151_review2015_fsm)$",
+    # "filter_instance": "^(Prob151_review2015_fsm)$",
     # "filter_instance": "^(Prob011_norgate)$",
     "filter_instance": "^(.*)$",
     "type_benchmark": "verilog_eval_v2",
@@ -43,6 +46,13 @@ args_dict = {
     "top_p": 0.95,
     "max_token": 1500,  # 降低默认值，避免token超限
     "use_golden_tb_in_mage": False,
+    "sim_type": "iverilog",  # or "verilator"
+    "use_mutation_repair": False,  # Try single-token fixes before the LLM editor
+    "use_patch_library": False,  # Try fixes mined from earlier editor sessions
+    "use_patch_repair": True,  # Fix syntax errors with line patches, not rewrites
+    "editor_speculative_cnt": 1,  # Alternative edits simulated in parallel per round
+    "resume": False,  # Skip tasks already finished in a previous (crashed) run
+    "golden_review_workers": 2,  # Golden review runs in background while next task runs
     "key_cfg_path": "./key.cfg",
     "base_url": "http://localhost:8000",  # VLLM server URL
 }
@@ -51,39 +61,75 @@ args_dict = {
 def run_round(args: argparse.Namespace, llm: LLM):
     total_start_time = time.monotonic()
     type_benchmark = TypeBenchmark[args.type_benchmark.upper()]
-    spec_dict = get_benchmark_contents(
-        type_benchmark,
-        TypeBenchmarkFile.SPEC,
-        args.path_benchmark,
-        args.filter_instance,
+    sim_type = TypeSimulator[args.sim_type.upper()]
+    benchmark_index = BenchmarkIndex(type_benchmark, args.path_benchmark)
+    # Specs are read lazily when each task starts
+    spec_dict = benchmark_index.specs(args.filter_instance)
+    golden_tb_path_dict = benchmark_index.paths(
+        TypeBenchmarkFile.TEST_PATH, args.filter_instance
     )
-    golden_tb_path_dict = get_benchmark_contents(
-        type_benchmark,
-        TypeBenchmarkFile.TEST_PATH,
-        args.path_benchmark,
-        args.filter_instance,
-    )
-    golden_rtl_path_dict = get_benchmark_contents(
-        type_benchmark,
-        TypeBenchmarkFile.GOLDEN_PATH,
-        args.path_benchmark,
-        args.filter_instance,
+    golden_rtl_path_dict = benchmark_index.paths(
+        TypeBenchmarkFile.GOLDEN_PATH, args.filter_instance
     )
 
     agent = TopAgent(llm)
     agent.set_output_path(f"./output_{args.run_identifier}")
     agent.set_log_path(f"./log_{args.run_identifier}")
     agent.set_redirect_log(True)
+    agent.set_sim_type(sim_type)
+    agent.set_use_mutation_repair(args.use_mutation_repair)
+    agent.set_use_patch_library(args.use_patch_library)
+    agent.set_use_patch_repair(args.use_patch_repair)
+    agent.set_editor_speculative_cnt(args.editor_speculative_cnt)
     # agent.set_ablation(True)
     record_file = f"./output_{args.run_identifier}/record.json"
     record_json: Dict[str, Dict[str, Any]] = {"record_per_run": {}, "total_record": {}}
+    # Per-task records are journaled as they complete; totals are rebuilt from it
+    journal = RunJournal(
+        f"./output_{args.run_identifier}/record_journal.jsonl", resume=args.resume
+    )
+    record_json["record_per_run"].update(
+        {
+            task_id: journal.records[task_id]
+            for task_id in spec_dict
+            if task_id in journal
+        }
+    )
 
     ret: dict[str, tuple[bool, str]] = {}
     review_result: dict[str, tuple[bool, str]] = {}
-    pass_cnt = 0
-    token_sum = TokenCount(in_token_cnt=0, out_token_cnt=0)
-    token_limit_cnt = 0
+    # Golden review of a task overlaps with generation of the following tasks.
+    # Spawn workers, so they don't inherit LLM client threads from this process.
+    golden_review_executor = ProcessPoolExecutor(
+        max_workers=args.golden_review_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    # Reviews are folded in by the executor's thread as soon as they finish
+    record_lock = threading.Lock()
+
+    def fold_review(i: int, task_id: str, future: Future) -> None:
+        try:
+            is_pass, golden_sim_log = future.result()
+        except Exception as e:
+            logger.error(f"Golden review of {task_id} failed: {e!r}")
+            is_pass, golden_sim_log = False, repr(e)
+        with record_lock:
+            print(f"({i+1:03d}/{len(spec_dict):03d}) {task_id}: is_pass = {is_pass}")
+            review_result[task_id] = (is_pass, golden_sim_log)
+            record_json["record_per_run"][task_id]["is_pass"] = is_pass
+            journal.append(task_id, record_json["record_per_run"][task_id])
+            json.dump(record_json, open(record_file, "w"), indent=4)
+
+    resumed_cnt = 0
     for i, (task_id, spec) in enumerate(spec_dict.items()):
+        if (
+            args.resume
+            and task_id in journal
+            and agent.is_properly_finished(type_benchmark.name, task_id)
+        ):
+            print(f"({i+1:03d}/{len(spec_dict):03d}) Skip finished task: {task_id}")
+            resumed_cnt += 1
+            continue
         start_time = time.monotonic()
         print(f"({i+1:03d}/{len(spec_dict):03d}) Current task: {task_id}")
         ret[task_id] = agent.run(
@@ -99,17 +145,12 @@ def run_round(args: argparse.Namespace, llm: LLM):
         )
         run_time = timedelta(seconds=time.monotonic() - start_time)
         print(f"{task_id} took {run_time} to execute")
-        is_pass, golden_sim_log = sim_review_golden_benchmark(
-            task_id=task_id,
-            output_path=agent.output_path,
-            benchmark_type=type_benchmark,
-            benchmark_path=args.path_benchmark,
-        )
-        print(f"({i+1:03d}/{len(spec_dict):03d}) {task_id}: is_pass = {is_pass}")
+        # Token counter is reset by the next agent.run, read it now
         run_token_cnt = agent.token_counter.get_sum_count()
         print(
             f"Current problem token count: Input {run_token_cnt.in_token_cnt}, Output {run_token_cnt.out_token_cnt}"
         )
+        run_cost = 0.0
         if agent.token_counter.token_cost:
             run_cost = (
                 run_token_cnt.in_token_cnt
@@ -119,29 +160,46 @@ def run_round(args: argparse.Namespace, llm: LLM):
             )
         run_token_limit_cnt = agent.token_counter.get_total_token()
         print(f"Current problem token limit consumption: {run_token_limit_cnt}")
-        token_limit_cnt += run_token_limit_cnt
         print(f"{'Current problem token cost':<25}: ${run_cost:.2f} USD")
-        token_sum += run_token_cnt
-        pass_cnt += is_pass
-        review_result[task_id] = (is_pass, golden_sim_log)
-        record_json["record_per_run"][task_id] = {
-            "is_pass": is_pass,
-            "run_token_limit_cnt": f"{run_token_limit_cnt:.2f}",
-            "run_token_cost": f"{run_cost:.2f}",
-            "run_time": str(run_time),
-        }
+        with record_lock:
+            record_json["record_per_run"][task_id] = {
+                "is_pass": None,  # Filled in when golden review finishes
+                "run_token_limit_cnt": f"{run_token_limit_cnt:.2f}",
+                "run_token_cost": f"{run_cost:.2f}",
+                "run_time": str(run_time),
+                "in_token_cnt": run_token_cnt.in_token_cnt,
+                "out_token_cnt": run_token_cnt.out_token_cnt,
+            }
+        future = golden_review_executor.submit(
+            sim_review_golden_benchmark_logged,
+            task_id,
+            f"{agent.log_path}/golden_review_{type_benchmark.name}_{task_id}",
+            agent.output_path,
+            type_benchmark,
+            args.path_benchmark,
+            sim_type,
+        )
+        future.add_done_callback(functools.partial(fold_review, i, task_id))
+    # Joins the executor's thread, so all callbacks have run
+    golden_review_executor.shutdown(wait=True)
+
+    # Rebuild totals from per-task records, including the ones from a resumed run
+    records = record_json["record_per_run"].values()
+    pass_cnt = sum(bool(record["is_pass"]) for record in records)
+    token_sum = TokenCount(
+        in_token_cnt=sum(record.get("in_token_cnt", 0) for record in records),
+        out_token_cnt=sum(record.get("out_token_cnt", 0) for record in records),
+    )
+    token_limit_cnt = round(
+        sum(float(record["run_token_limit_cnt"]) for record in records)
+    )
+    total_cost = sum(float(record["run_token_cost"]) for record in records)
     print(f"Pass rate: {pass_cnt}/{len(spec_dict)}")
     print(
         f"Total token count: Input {token_sum.in_token_cnt}, Output {token_sum.out_token_cnt}"
     )
     print(f"Total token limit consumption: {token_limit_cnt}")
     if agent.token_counter.token_cost:
-        total_cost = (
-            token_sum.in_token_cnt
-            * agent.token_counter.token_cost.in_token_cost_per_token
-            + token_sum.out_token_cnt
-            * agent.token_counter.token_cost.out_token_cost_per_token
-        )
         print(f"{'Total cost':<25}: ${total_cost:.2f} USD")
         print(f"{'Avg cost':<25}: ${total_cost / len(spec_dict):.2f} USD")
 
@@ -154,7 +212,14 @@ def run_round(args: argparse.Namespace, llm: LLM):
         "total_cost": f"{total_cost:.2f}",
         "avg_cost": f"{total_cost / len(spec_dict):.2f}",
         "total_run_time": str(total_run_time),
+        "resumed_cnt": resumed_cnt,
     }
+    # p50/p95 per stage, LLM call and subprocess, over tasks and golden reviews
+    record_json["total_record"]["stage_timing"] = summarize_spans(
+        f"{agent.log_path}/{prefix}{type_benchmark.name}_{task_id}/{SPAN_FILE_NAME}"
+        for task_id in spec_dict
+        for prefix in ("", "golden_review_")
+    )
     json.dump(record_json, open(record_file, "w"), indent=4)
 
 